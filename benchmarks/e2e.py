@@ -0,0 +1,330 @@
+"""
+End-to-end benchmark of the pipeline stages, run with the local execution engine on a synthetic dataset.
+
+Reports the time, throughput, peak RSS and bytes read and written of each stage, and compares them with a baseline
+report of a previous run. Usage (from the repository root, in an environment with the runtime binaries, e.g. the
+localhost runtime image):
+
+    python -m benchmarks.e2e --reads 1000000 --fasta-chunks 4 --fastq-chunks 4 --output run.json
+    python -m benchmarks.e2e --reads 1000000 --fasta-chunks 4 --fastq-chunks 4 --baseline run.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from serverlessgenomics.datasource.sources.fasta import generate_faidx_from_s3, get_fasta_byte_ranges
+from serverlessgenomics.mapping.map_caller import run_full_alignment
+from serverlessgenomics.preprocessing import prepare_fastq_chunks, prepare_gem_chunks
+from serverlessgenomics.reducer.reduce_caller import run_reducer
+from serverlessgenomics.variantcalling import VariantCallingPipeline
+
+from .synthetic import SyntheticConfig, generate_dataset
+
+logger = logging.getLogger(__name__)
+
+# Stages in execution order, and the input dataset their throughput is measured against
+STAGES = {
+    "faidx": "fasta",
+    "fasta_chunks": "fasta",
+    "fastq_index": "fastq",
+    "gem_index": "fasta",
+    "align_mapper": "fastq",
+    "index_correction": None,
+    "filtered_index_to_mpileup": None,
+    "reduce": None,
+}
+# Stages that process reads, reported in reads per second
+READ_STAGES = ("fastq_index", "align_mapper", "index_correction", "filtered_index_to_mpileup", "reduce")
+# Metrics compared with the baseline, all of them lower is better
+COMPARED_METRICS = ("seconds", "peak_rss_bytes")
+SAMPLE_INTERVAL = 0.1
+
+
+class ProcessTreeSampler:
+    """
+    Background sampler of the resident memory and I/O bytes (rchar/wchar) of this process and all its descendants
+    (worker processes and the programs they run). I/O counters of each process are kept after it exits, so the
+    sampled totals only grow.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.__interval = interval
+        self.__samples = []
+        self.__io = {}
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__page_size = os.sysconf("SC_PAGE_SIZE")
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+
+    def __run(self):
+        while not self.__stop.is_set():
+            self.__sample()
+            self.__stop.wait(self.__interval)
+        self.__sample()
+
+    def __sample(self):
+        rss = 0
+        for pid in _process_tree(os.getpid()):
+            try:
+                with open(f"/proc/{pid}/statm") as f:
+                    rss += int(f.read().split()[1]) * self.__page_size
+                with open(f"/proc/{pid}/io") as f:
+                    counters = dict(line.split(": ") for line in f.read().splitlines())
+                self.__io[pid] = (int(counters["rchar"]), int(counters["wchar"]))
+            except (FileNotFoundError, ProcessLookupError, PermissionError):
+                # The process exited while sampling
+                continue
+        read_bytes = sum(r for r, _ in self.__io.values())
+        written_bytes = sum(w for _, w in self.__io.values())
+        self.__samples.append((time.time(), rss, read_bytes, written_bytes))
+
+    def window(self, t0: float, t1: float) -> dict:
+        """
+        Peak RSS and bytes read and written between two timestamps
+        """
+        before = [s for s in self.__samples if s[0] <= t0] or self.__samples[:1]
+        inside = [s for s in self.__samples if t0 <= s[0] <= t1]
+        after = [s for s in self.__samples if s[0] >= t1] or self.__samples[-1:]
+        first, last = before[-1], after[0]
+        return {
+            "peak_rss_bytes": max(s[1] for s in inside + [first, last]),
+            "read_bytes": last[2] - first[2],
+            "written_bytes": last[3] - first[3],
+        }
+
+
+def _process_tree(root_pid: int) -> list:
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The process name can contain spaces, fields after it are separated by spaces
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        tree.append(pid)
+        pending.extend(children.get(pid, []))
+    return tree
+
+
+def prepare_inputs(config: SyntheticConfig, workdir: str) -> dict:
+    """
+    Generate the synthetic dataset of a configuration, unless it was already generated in workdir
+    """
+    digest = hashlib.sha256(json.dumps(config.as_dict(), sort_keys=True).encode()).hexdigest()[:16]
+    dataset_dir = os.path.join(workdir, "datasets", digest)
+    files = {
+        "fasta": os.path.join(dataset_dir, "reference.fa"),
+        "fastq": os.path.join(dataset_dir, "reads.fastq.gz"),
+        "variants": os.path.join(dataset_dir, "variants.tsv"),
+    }
+    if not all(os.path.exists(filename) for filename in files.values()):
+        logger.info("Generating synthetic dataset in %s", dataset_dir)
+        os.makedirs(dataset_dir, exist_ok=True)
+        t0 = time.perf_counter()
+        generate_dataset(config, files["fasta"], files["fastq"], files["variants"])
+        logger.info("Generated synthetic dataset in %.1f s", time.perf_counter() - t0)
+    return files
+
+
+def run_benchmark(config: SyntheticConfig, workdir: str, pipeline_params: dict, keep: bool = False) -> dict:
+    """
+    Run every stage of the pipeline on the synthetic dataset of config and measure them.
+    Each benchmark uses a new bucket of the local storage, so that no stage reuses cached data.
+    """
+    inputs = prepare_inputs(config, workdir)
+    storage_root = os.path.join(workdir, "storage")
+    bucket = f"benchmark-{uuid.uuid4().hex[:8]}"
+    bucket_dir = os.path.join(storage_root, bucket)
+    os.makedirs(os.path.join(bucket_dir, "inputs"))
+    for name in ("fasta", "fastq"):
+        os.link(inputs[name], os.path.join(bucket_dir, "inputs", os.path.basename(inputs[name])))
+
+    pipeline = VariantCallingPipeline(
+        run_id=bucket,
+        engine="local",
+        local_storage_root=storage_root,
+        storage_bucket=bucket,
+        fasta_path=f"s3://{bucket}/inputs/{os.path.basename(inputs['fasta'])}",
+        fastq_path=f"s3://{bucket}/inputs/{os.path.basename(inputs['fastq'])}",
+        **pipeline_params,
+    )
+    params, run, lithops = pipeline.parameters, pipeline.state, pipeline.lithops
+    windows = {}
+
+    @contextmanager
+    def _stage(name):
+        logger.info("Running stage %s", name)
+        t0 = time.time()
+        yield
+        windows[name] = (t0, time.time())
+
+    sampler = ProcessTreeSampler()
+    sampler.start()
+    try:
+        with _stage("faidx"):
+            num_sequences = generate_faidx_from_s3(params, lithops)
+        with _stage("fasta_chunks"):
+            run.fasta_chunks = get_fasta_byte_ranges(params, lithops, num_sequences)
+        with _stage("fastq_index"):
+            run.fastq_chunks = prepare_fastq_chunks(params, lithops)
+        with _stage("gem_index"):
+            run.gem_keys, _ = prepare_gem_chunks(params, run.fasta_chunks, lithops)
+
+        alignment_stats = run_full_alignment(params, run, lithops)
+        timers = alignment_stats.dump_dict()["timers"]
+        for name in ("align_mapper", "index_correction", "filtered_index_to_mpileup"):
+            windows[name] = (timers[name]["t0"], timers[name]["t1"])
+
+        with _stage("reduce"):
+            run_reducer(params, run, lithops)
+    finally:
+        sampler.stop()
+        if not keep:
+            shutil.rmtree(bucket_dir, ignore_errors=True)
+
+    input_sizes = {name: os.path.getsize(inputs[name]) for name in ("fasta", "fastq")}
+    stages = {}
+    for name, input_name in STAGES.items():
+        t0, t1 = windows[name]
+        seconds = t1 - t0
+        stage = {"seconds": seconds, **sampler.window(t0, t1)}
+        if input_name is not None:
+            stage["input_mb_per_sec"] = input_sizes[input_name] / 1e6 / seconds if seconds > 0 else None
+        stage["read_mb_per_sec"] = stage["read_bytes"] / 1e6 / seconds if seconds > 0 else None
+        if name in READ_STAGES:
+            stage["reads_per_sec"] = config.num_reads / seconds if seconds > 0 else None
+        stages[name] = stage
+
+    return {
+        "config": config.as_dict(),
+        "pipeline_params": pipeline_params,
+        "host": {"platform": platform.platform(), "cpu_count": os.cpu_count(), "python": platform.python_version()},
+        "timestamp": time.time(),
+        "input_bytes": input_sizes,
+        "variants_file": inputs["variants"],
+        "stages": stages,
+    }
+
+
+def compare_reports(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Stage metrics of a report that are worse than in the baseline by more than tolerance (a fraction).
+    Returns a list of (stage, metric, baseline value, value).
+    """
+    if report["config"] != baseline["config"] or report["pipeline_params"] != baseline["pipeline_params"]:
+        logger.warning("Baseline was run with a different configuration, comparison is not meaningful")
+    regressions = []
+    for name, stage in report["stages"].items():
+        baseline_stage = baseline["stages"].get(name)
+        if baseline_stage is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if baseline_stage.get(metric) and stage[metric] > baseline_stage[metric] * (1 + tolerance):
+                regressions.append((name, metric, baseline_stage[metric], stage[metric]))
+    return regressions
+
+
+def format_report(report: dict, baseline: dict = None) -> str:
+    lines = [
+        f"{'stage':<27}{'seconds':>10}{'reads/s':>12}{'MB/s in':>10}{'MB read':>10}{'MB written':>12}"
+        f"{'peak RSS MB':>13}{'vs baseline':>13}"
+    ]
+    for name, stage in report["stages"].items():
+        change = ""
+        if baseline is not None and baseline["stages"].get(name, {}).get("seconds"):
+            change = f"{stage['seconds'] / baseline['stages'][name]['seconds'] - 1:+.1%}"
+        lines.append(
+            f"{name:<27}{stage['seconds']:>10.2f}{_fmt(stage.get('reads_per_sec'), '.0f'):>12}"
+            f"{_fmt(stage.get('input_mb_per_sec'), '.1f'):>10}{stage['read_bytes'] / 1e6:>10.1f}"
+            f"{stage['written_bytes'] / 1e6:>12.1f}{stage['peak_rss_bytes'] / 1e6:>13.0f}{change:>13}"
+        )
+    return "\n".join(lines)
+
+
+def _fmt(value, spec: str) -> str:
+    return "-" if value is None else format(value, spec)
+
+
+def main(argv=None) -> int:
+    defaults = SyntheticConfig()
+    parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark on a synthetic dataset")
+    parser.add_argument("--genome-size", type=int, default=defaults.genome_size, help="reference size (bases)")
+    parser.add_argument("--num-sequences", type=int, default=defaults.num_sequences, help="reference sequences")
+    parser.add_argument("--variants", type=int, default=defaults.num_variants, help="number of known SNPs")
+    parser.add_argument("--reads", type=int, default=defaults.num_reads, help="number of reads")
+    parser.add_argument("--read-length", type=int, default=defaults.read_length, help="read length (bases)")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="read substitution error rate")
+    parser.add_argument("--seed", type=int, default=defaults.seed, help="random seed of the dataset")
+    parser.add_argument("--fasta-chunks", type=int, default=4, help="number of FASTA chunks")
+    parser.add_argument("--fastq-chunks", type=int, default=4, help="number of FASTQ chunks")
+    parser.add_argument("--workers", type=int, default=None, help="local worker processes (default: CPU count)")
+    parser.add_argument("--workdir", default="benchmark-data", help="directory for datasets and local storage")
+    parser.add_argument("--output", help="write the report as JSON to this file (e.g. to use it as a baseline)")
+    parser.add_argument("--baseline", help="JSON report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown over the baseline")
+    parser.add_argument("--keep", action="store_true", help="keep the storage bucket of the run")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s - %(message)s")
+    config = SyntheticConfig(
+        genome_size=args.genome_size,
+        num_sequences=args.num_sequences,
+        num_variants=args.variants,
+        num_reads=args.reads,
+        read_length=args.read_length,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    pipeline_params = {
+        "fasta_chunks": args.fasta_chunks,
+        "fastq_chunks": args.fastq_chunks,
+        "local_workers": args.workers,
+        "log_level": logging.WARNING,
+    }
+    report = run_benchmark(config, os.path.abspath(args.workdir), pipeline_params, args.keep)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(format_report(report, baseline))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare_reports(report, baseline, args.tolerance)
+        for name, metric, baseline_value, value in regressions:
+            print(f"REGRESSION {name} {metric}: {baseline_value:.4g} -> {value:.4g}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
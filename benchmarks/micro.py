@@ -0,0 +1,375 @@
+"""
+Micro-benchmarks of the pure Python hot paths of the pipeline: chunk planners, partitioners and parsers.
+
+Each benchmark runs on synthetic inputs at several scales (1x, 10x and 100x by default) with an in-memory storage,
+so no external binaries or cloud resources are needed. Reports the best and median time and the peak traced memory
+of each benchmark and scale, flags superlinear growth between scales, and compares with a baseline report of a
+previous run. Usage (from the repository root):
+
+    python -m benchmarks.micro --output micro.json
+    python -m benchmarks.micro --baseline micro.json
+    python -m benchmarks.micro --filter fasta --scales 1,10
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from lithops.storage.utils import StorageNoSuchKeyError
+
+from serverlessgenomics.datasource.sources.fasta import (
+    format_fai,
+    get_faidx_key,
+    get_fasta_byte_ranges,
+    put_faidx,
+    reduce_chunked_indexes,
+    scan_fasta_range,
+)
+from serverlessgenomics.datasource.sources.fastqgz import get_fastqgz_idx_keys, get_ranges_from_line_pairs, read_lines
+from serverlessgenomics.pipeline import Lithops, PipelineParameters
+from serverlessgenomics.reducer.reduce_functions import distribute_indexes, keys_by_fasta_split
+from serverlessgenomics.storage import ObjectStorage
+from serverlessgenomics.utils import S3Path
+
+BUCKET = "benchmark"
+# Minimum total time and number of runs of each measurement
+MIN_TIME = 0.5
+MIN_RUNS = 3
+MAX_RUNS = 100
+# Growth exponent between scales above which a benchmark is flagged as superlinear
+SUPERLINEAR_EXPONENT = 1.3
+# Metrics compared with the baseline, all of them lower is better
+COMPARED_METRICS = ("best_s", "peak_memory_bytes")
+
+
+class MemoryStorage(ObjectStorage):
+    """
+    In-memory object storage. Objects can also be declared with only a size, for inputs that are only HEADed.
+    """
+
+    def __init__(self):
+        self.__objects = {}
+        self.__metadata = {}
+        self.__sizes = {}
+
+    def declare(self, bucket: str, key: str, size: int):
+        self.__sizes[(bucket, key)] = size
+
+    def get_object(self, bucket: str, key: str, stream: bool = False, extra_get_args: dict = None):
+        if (bucket, key) not in self.__objects:
+            raise StorageNoSuchKeyError(bucket, key)
+        body = self.__objects[(bucket, key)]
+        if extra_get_args and "Range" in extra_get_args:
+            first, last = extra_get_args["Range"].replace("bytes=", "").split("-")
+            body = body[int(first) : int(last) + 1 if last else None]
+        return io.BytesIO(body) if stream else body
+
+    def put_object(self, bucket: str, key: str, body, metadata: dict = None):
+        if hasattr(body, "read"):
+            body = body.read()
+        self.__objects[(bucket, key)] = body.encode("utf-8") if isinstance(body, str) else bytes(body)
+        self.__metadata[(bucket, key)] = metadata or {}
+        self.__sizes[(bucket, key)] = len(self.__objects[(bucket, key)])
+
+    def head_object(self, bucket: str, key: str) -> dict:
+        if (bucket, key) not in self.__sizes:
+            raise StorageNoSuchKeyError(bucket, key)
+        head = {"content-length": str(self.__sizes[(bucket, key)])}
+        head.update({f"x-amz-meta-{k}": v for k, v in self.__metadata.get((bucket, key), {}).items()})
+        return head
+
+    def upload_fileobj(self, fileobj, bucket: str, key: str, metadata: dict = None):
+        self.put_object(bucket, key, fileobj, metadata)
+
+    def download_fileobj(self, bucket: str, key: str, fileobj):
+        fileobj.write(self.get_object(bucket, key))
+
+
+def _params(**kwargs) -> PipelineParameters:
+    return PipelineParameters(
+        fasta_path=S3Path.from_uri(f"s3://{BUCKET}/reference.fa"),
+        fastq_path=S3Path.from_uri(f"s3://{BUCKET}/reads.fastq.gz"),
+        storage_bucket=BUCKET,
+        **kwargs,
+    )
+
+
+def _synthetic_fasta(num_sequences: int, rng: np.random.Generator, line_width: int = 60) -> bytes:
+    """
+    FASTA file of short random sequences with headers of varying length
+    """
+    records = []
+    for i in range(num_sequences):
+        length = int(rng.integers(100, 2000))
+        seq = rng.choice(np.frombuffer(b"ACGT", dtype=np.uint8), size=length).tobytes()
+        body = b"\n".join(seq[j : j + line_width] for j in range(0, length, line_width))
+        records.append(b">seq%d description %s\n%s\n" % (i, b"x" * int(rng.integers(0, 40)), body))
+    return b"".join(records)
+
+
+def _fai_entries(num_sequences: int, rng: np.random.Generator, line_width: int = 60) -> list:
+    """
+    FASTA index entries (name, length, offset, line_bases, line_width) of a file of num_sequences sequences
+    """
+    entries, offset = [], 0
+    for i in range(num_sequences):
+        name = f"seq{i}"
+        length = int(rng.integers(10_000, 1_000_000))
+        offset += len(name) + 2
+        entries.append((name, length, offset, line_width, line_width + 1))
+        offset += length + math.ceil(length / line_width)
+    return entries
+
+
+def setup_get_fasta_byte_ranges(scale: int, rng: np.random.Generator):
+    num_sequences, fasta_chunks = 1_000 * scale, 100 * scale
+    params = _params(fasta_chunks=fasta_chunks)
+    storage = MemoryStorage()
+    entries = _fai_entries(num_sequences, rng)
+    name, length, offset, _, line_width = entries[-1]
+    storage.declare(BUCKET, params.fasta_path.key, offset + length + math.ceil(length / (line_width - 1)))
+    put_faidx(storage, BUCKET, get_faidx_key(params), format_fai(entries), num_sequences)
+    lithops = Lithops(storage=storage, invoker=None)
+    return lambda: get_fasta_byte_ranges(params, lithops, num_sequences)
+
+
+def setup_get_ranges_from_line_pairs(scale: int, rng: np.random.Generator):
+    # gztool index windows every ~1 MiB of compressed data, about 20k lines each
+    num_windows, num_pairs = 1_000 * scale, 10 * scale
+    params = _params(fasta_chunks=1)
+    storage = MemoryStorage()
+    lines_per_window = rng.integers(15_000, 25_000, size=num_windows)
+    line_numbers = np.concatenate(([1], 1 + np.cumsum(lines_per_window)[:-1]))
+    compressed = np.arange(num_windows, dtype=np.int64) * 1_048_576
+    df = pd.DataFrame(
+        {
+            "window": np.arange(num_windows),
+            "compressed_byte": compressed,
+            "uncompressed_byte": compressed * 4,
+            "line_number": line_numbers,
+            "window_size": 32_768,
+            "window_offset": 0,
+        }
+    ).set_index("window")
+    out_stream = io.BytesIO()
+    df.to_parquet(out_stream)
+    _, gzip_tab_key = get_fastqgz_idx_keys(params)
+    storage.put_object(BUCKET, gzip_tab_key, out_stream.getvalue())
+    storage.declare(BUCKET, params.fastq_path.key, int(compressed[-1]) + 1_048_576)
+
+    total_lines = int(line_numbers[-1] + lines_per_window[-1]) // 4 * 4
+    step = total_lines // num_pairs // 4 * 4
+    pairs = [(i * step + 1, min((i + 1) * step, total_lines) + 1) for i in range(num_pairs)]
+    return lambda: get_ranges_from_line_pairs(params, pairs, storage)
+
+
+def setup_distribute_indexes(scale: int, rng: np.random.Generator):
+    num_keys, rows_per_key = 5, 2_000 * scale
+    params = _params(fasta_chunks=1)
+    storage = MemoryStorage()
+    keys = []
+    for i in range(num_keys):
+        positions = np.sort(rng.integers(1, 50_000 * scale, size=rows_per_key))
+        rows = "".join(f"seq0\t{pos}\tA\t12\t..,,..,,..,,\tIIIIIIIIIIII\n" for pos in positions)
+        key = f"mpileups/fa0-fq{i}/fq{i}.mpileup"
+        storage.put_object(BUCKET, key, rows)
+        keys.append(key)
+    return lambda: distribute_indexes(params, 0, keys, storage)
+
+
+def _partial_indexes(scale: int, rng: np.random.Generator):
+    fasta = _synthetic_fasta(200 * scale, rng)
+    num_chunks = 10 * scale
+    chunk_size = math.ceil(len(fasta) / num_chunks)
+
+    def _open_stream(start, end):
+        return io.BytesIO(fasta[start:end])
+
+    return fasta, chunk_size, _open_stream, num_chunks
+
+
+def setup_scan_fasta_range(scale: int, rng: np.random.Generator):
+    fasta, _, open_stream, _ = _partial_indexes(scale, rng)
+    return lambda: scan_fasta_range(open_stream, 0, len(fasta), len(fasta))
+
+
+def setup_reduce_chunked_indexes(scale: int, rng: np.random.Generator):
+    fasta, chunk_size, open_stream, num_chunks = _partial_indexes(scale, rng)
+    results = [
+        scan_fasta_range(open_stream, i * chunk_size, min((i + 1) * chunk_size, len(fasta)), len(fasta))
+        for i in range(num_chunks)
+    ]
+    storage = MemoryStorage()
+    os.environ.update({"BUCKET": BUCKET, "FAIDX_KEY": "reference.fa.fai", "FASTA_END": str(len(fasta))})
+    # Stitching modifies the partial indexes, each run gets a copy
+    return lambda: reduce_chunked_indexes([list(r) for r in results], storage)
+
+
+def setup_keys_by_fasta_split(scale: int, rng: np.random.Generator):
+    num_fasta_chunks, num_fastq_chunks = 10 * scale, 100
+    keys = [
+        f"serverless-genomics.tmp.varcall-run/filtered_index_to_mpileup/fa{fa}-fq{fq}/SRR000000_fa{fa}-fq{fq}.mpileup"
+        for fa in range(num_fasta_chunks)
+        for fq in range(num_fastq_chunks)
+    ]
+    return lambda: keys_by_fasta_split(keys)
+
+
+def setup_read_lines(scale: int, rng: np.random.Generator):
+    num_reads = 10_000 * scale
+    read = b"ACGT" * 25
+    fastq = b"".join(b"@read.%d\n%s\n+\n%s\n" % (i, read, b"I" * len(read)) for i in range(num_reads))
+    return lambda: read_lines(io.BytesIO(fastq), num_reads * 4)
+
+
+# Benchmark name -> setup(scale, rng), that returns the function to measure
+BENCHMARKS = {
+    "get_fasta_byte_ranges": setup_get_fasta_byte_ranges,
+    "get_ranges_from_line_pairs": setup_get_ranges_from_line_pairs,
+    "distribute_indexes": setup_distribute_indexes,
+    "scan_fasta_range": setup_scan_fasta_range,
+    "reduce_chunked_indexes": setup_reduce_chunked_indexes,
+    "keys_by_fasta_split": setup_keys_by_fasta_split,
+    "fastqgz_read_lines": setup_read_lines,
+}
+
+
+def measure(func) -> dict:
+    """
+    Best and median time of func over repeated runs, and the peak memory traced in one run
+    """
+    func()
+    times = []
+    while len(times) < MIN_RUNS or (sum(times) < MIN_TIME and len(times) < MAX_RUNS):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"best_s": min(times), "median_s": statistics.median(times), "runs": len(times), "peak_memory_bytes": peak}
+
+
+def run_benchmarks(scales: list, name_filter: str = None, seed: int = 42) -> dict:
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if name_filter is not None and name_filter not in name:
+            continue
+        results[name] = {}
+        for scale in scales:
+            func = setup(scale, np.random.default_rng(seed))
+            results[name][str(scale)] = measure(func)
+            print(f"{name} x{scale}: {results[name][str(scale)]['best_s'] * 1e3:.2f} ms", file=sys.stderr)
+    return {
+        "host": {"platform": platform.platform(), "python": platform.python_version()},
+        "timestamp": time.time(),
+        "scales": scales,
+        "benchmarks": results,
+    }
+
+
+def growth_exponents(benchmark: dict) -> dict:
+    """
+    Growth exponent of the best time between consecutive scales (1 is linear)
+    """
+    scales = sorted(benchmark, key=int)
+    exponents = {}
+    for a, b in zip(scales, scales[1:]):
+        ta, tb = benchmark[a]["best_s"], benchmark[b]["best_s"]
+        exponents[f"{a}->{b}"] = math.log(tb / ta) / math.log(int(b) / int(a)) if ta > 0 and tb > 0 else None
+    return exponents
+
+
+def compare_reports(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Metrics of a report that are worse than in the baseline by more than tolerance (a fraction).
+    Returns a list of (benchmark, scale, metric, baseline value, value).
+    """
+    regressions = []
+    for name, scales in report["benchmarks"].items():
+        for scale, result in scales.items():
+            baseline_result = baseline["benchmarks"].get(name, {}).get(scale)
+            if baseline_result is None:
+                continue
+            for metric in COMPARED_METRICS:
+                if baseline_result[metric] and result[metric] > baseline_result[metric] * (1 + tolerance):
+                    regressions.append((name, scale, metric, baseline_result[metric], result[metric]))
+    return regressions
+
+
+def format_report(report: dict, baseline: dict = None) -> str:
+    lines = [f"{'benchmark':<28}{'scale':>6}{'best ms':>11}{'median ms':>11}{'peak MB':>9}{'growth':>8}{'vs base':>9}"]
+    for name, scales in report["benchmarks"].items():
+        exponents = growth_exponents(scales)
+        previous = None
+        for scale, result in scales.items():
+            growth = exponents.get(f"{previous}->{scale}") if previous is not None else None
+            flag = "!" if growth is not None and growth > SUPERLINEAR_EXPONENT else ""
+            change = ""
+            baseline_result = (baseline or {}).get("benchmarks", {}).get(name, {}).get(scale)
+            if baseline_result is not None and baseline_result["best_s"]:
+                change = f"{result['best_s'] / baseline_result['best_s'] - 1:+.1%}"
+            lines.append(
+                f"{name:<28}{'x' + scale:>6}{result['best_s'] * 1e3:>11.2f}{result['median_s'] * 1e3:>11.2f}"
+                f"{result['peak_memory_bytes'] / 1e6:>9.1f}{'' if growth is None else f'{growth:.2f}{flag}':>8}"
+                f"{change:>9}"
+            )
+            previous = scale
+    lines.append(
+        f"growth: exponent of the time increase from the previous scale (1 is linear, ! above "
+        f"{SUPERLINEAR_EXPONENT})"
+    )
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the pipeline hot paths")
+    parser.add_argument("--scales", default="1,10,100", help="comma separated input scales")
+    parser.add_argument("--filter", help="run only benchmarks whose name contains this string")
+    parser.add_argument("--seed", type=int, default=42, help="random seed of the inputs")
+    parser.add_argument("--output", help="write the report as JSON to this file (e.g. to use it as a baseline)")
+    parser.add_argument("--baseline", help="JSON report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown over the baseline")
+    args = parser.parse_args(argv)
+
+    # Pipeline functions log at info level
+    logging.getLogger("serverlessgenomics").setLevel(logging.WARNING)
+    scales = [int(scale) for scale in args.scales.split(",")]
+    report = run_benchmarks(scales, args.filter, args.seed)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(format_report(report, baseline))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare_reports(report, baseline, args.tolerance)
+        for name, scale, metric, baseline_value, value in regressions:
+            print(f"REGRESSION {name} x{scale} {metric}: {baseline_value:.4g} -> {value:.4g}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+Synthetic datasets for benchmarks: a random reference genome, a set of known SNPs and single-end reads sampled from
+the reference with the SNPs applied.
+"""
+
+from __future__ import annotations
+
+import gzip
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+# Complement of each base, indexed by byte value
+_COMPLEMENT = np.zeros(256, dtype=np.uint8)
+_COMPLEMENT[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.frombuffer(b"TGCA", dtype=np.uint8)
+# Reads are sampled and written in batches of this size
+_READS_BATCH = 100_000
+
+
+@dataclass(frozen=True)
+class SyntheticConfig:
+    # Total number of bases of the reference
+    genome_size: int = 10_000_000
+    # Number of sequences (chromosomes) of the reference
+    num_sequences: int = 4
+    # Bases per FASTA line
+    line_width: int = 60
+    # Fraction of G and C bases
+    gc_content: float = 0.41
+    # Number of known SNPs
+    num_variants: int = 5_000
+    # Number of reads
+    num_reads: int = 1_000_000
+    # Read length (bases)
+    read_length: int = 100
+    # Per base substitution error rate of the reads
+    error_rate: float = 0.001
+    # Random seed, the same configuration and seed always generate the same files
+    seed: int = 42
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def generate_dataset(config: SyntheticConfig, fasta_filename: str, fastq_filename: str, variants_filename: str):
+    """
+    Write a reference genome (FASTA), its known variants (TSV of sequence, 1-based position, ref and alt bases) and
+    reads sampled from the genome with the variants applied (gzip compressed FASTQ)
+    """
+    rng = np.random.default_rng(config.seed)
+    sequences = generate_reference(config, rng)
+    write_fasta(sequences, fasta_filename, config.line_width)
+
+    variants = generate_variants(sequences, config.num_variants, rng)
+    write_variants(variants, variants_filename)
+    sample = apply_variants(sequences, variants)
+
+    write_reads(sample, config, rng, fastq_filename)
+
+
+def generate_reference(config: SyntheticConfig, rng: np.random.Generator) -> dict:
+    """
+    Random sequences of ACGT bases with the configured GC content, as a dict of name -> uint8 array.
+    Sequence lengths vary around genome_size / num_sequences.
+    """
+    weights = rng.uniform(0.5, 1.5, config.num_sequences)
+    lengths = np.maximum((weights / weights.sum() * config.genome_size).astype(np.int64), config.read_length)
+    gc, at = config.gc_content / 2, (1 - config.gc_content) / 2
+    return {f"chr{i + 1}": rng.choice(BASES, size=length, p=[at, gc, gc, at]) for i, length in enumerate(lengths)}
+
+
+def generate_variants(sequences: dict, num_variants: int, rng: np.random.Generator) -> list:
+    """
+    Random SNPs at distinct positions, as a sorted list of (sequence name, 0-based position, ref base, alt base)
+    """
+    names = list(sequences)
+    offsets = np.cumsum([0] + [len(sequences[name]) for name in names])
+    positions = np.sort(rng.choice(offsets[-1], size=min(num_variants, offsets[-1]), replace=False))
+    variants = []
+    for position in positions:
+        i = np.searchsorted(offsets, position, side="right") - 1
+        name, pos = names[i], int(position - offsets[i])
+        ref = int(sequences[name][pos])
+        alt = int(rng.choice(BASES[BASES != ref]))
+        variants.append((name, pos, chr(ref), chr(alt)))
+    return variants
+
+
+def apply_variants(sequences: dict, variants: list) -> dict:
+    sample = {name: seq.copy() for name, seq in sequences.items()}
+    for name, pos, _, alt in variants:
+        sample[name][pos] = ord(alt)
+    return sample
+
+
+def write_fasta(sequences: dict, filename: str, line_width: int):
+    with open(filename, "wb") as f:
+        for name, seq in sequences.items():
+            f.write(f">{name} synthetic\n".encode())
+            for i in range(0, len(seq), line_width):
+                f.write(seq[i : i + line_width].tobytes() + b"\n")
+
+
+def write_variants(variants: list, filename: str):
+    with open(filename, "w") as f:
+        f.write("#sequence\tposition\tref\talt\n")
+        for name, pos, ref, alt in variants:
+            f.write(f"{name}\t{pos + 1}\t{ref}\t{alt}\n")
+
+
+def write_reads(sample: dict, config: SyntheticConfig, rng: np.random.Generator, filename: str):
+    """
+    Sample reads uniformly from both strands of the genome, with random substitution errors
+    """
+    names = list(sample)
+    lengths = np.array([len(sample[name]) for name in names])
+    probabilities = lengths / lengths.sum()
+    read_length = config.read_length
+    offsets = np.arange(read_length)
+    quality = b"I" * read_length
+
+    with gzip.open(filename, "wb", compresslevel=6) as f:
+        for batch_start in range(0, config.num_reads, _READS_BATCH):
+            batch_size = min(_READS_BATCH, config.num_reads - batch_start)
+            seq_ids = rng.choice(len(names), size=batch_size, p=probabilities)
+            reads = np.empty((batch_size, read_length), dtype=np.uint8)
+            for i, name in enumerate(names):
+                selected = np.flatnonzero(seq_ids == i)
+                starts = rng.integers(0, lengths[i] - read_length + 1, size=len(selected))
+                reads[selected] = sample[name][starts[:, None] + offsets]
+
+            # Reverse strand reads
+            reverse = rng.random(batch_size) < 0.5
+            reads[reverse] = _COMPLEMENT[reads[reverse][:, ::-1]]
+
+            # Substitution errors
+            errors = rng.random(reads.shape) < config.error_rate
+            reads[errors] = rng.choice(BASES, size=int(errors.sum()))
+
+            f.write(
+                b"".join(
+                    b"@synthetic.%d\n%s\n+\n%s\n" % (batch_start + j + 1, read.tobytes(), quality)
+                    for j, read in enumerate(reads)
+                )
+            )
@@ -1 +1,3 @@
-from .variantcalling import VariantCallingPipeline
+from .variantcalling import VariantCallingPipeline, VariantCallingBatch
+
+__all__ = ["VariantCallingPipeline", "VariantCallingBatch"]
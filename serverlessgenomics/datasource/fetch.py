@@ -1,19 +1,30 @@
 from __future__ import annotations
 
-import re
+import os
 import math
+import shutil
+import tempfile
+import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, BinaryIO
 
 from .datasources import FASTQSource
+from .sources.bgzf import open_compressed_range
 from .sources.fastqgz import fetch_fastq_chunk_s3_fastqgzip
-from .sources.gem import get_gem_chunk_storage_key
-from .sources.sra import fetch_fastq_chunk_sra
+from .sources.sra import fetch_fastq_chunk_sra, get_sra_storage_key
 
 if TYPE_CHECKING:
     from lithops import Storage
+    from ..stats import Stats
     from ..utils import S3Path
 from ..pipeline import PipelineParameters
+from ..storage import get_pipeline_storage
+
+# Block size for reading the body of ranged GET responses
+_READ_BLOCK_SIZE = 1024 * 1024
+# Directory (in the temporary directory) for .sra files downloaded from the storage bucket, kept between invocations
+# that reuse the container
+SRA_LOCAL_CACHE_DIR = "sra-cache"
 
 
 def fetch_fastq_chunk(
@@ -26,24 +37,53 @@ def fetch_fastq_chunk(
     if fastq_chunk["source"] == FASTQSource.S3_GZIP:
         fetch_fastq_chunk_s3_fastqgzip(fastq_chunk, target_filename, pipeline_params, storage)
     elif fastq_chunk["source"] == FASTQSource.SRA:
-        fetch_fastq_chunk_sra(pipeline_params.sra_accession, fastq_chunk, target_filename)
+        sra_filename = fetch_sra_file(pipeline_params, storage)
+        fetch_fastq_chunk_sra(pipeline_params, fastq_chunk, target_filename, sra_filename)
     else:
         raise KeyError(fastq_chunk["source"])
 
 
+def fetch_sra_file(pipeline_params: PipelineParameters, storage: Storage) -> str:
+    """
+    Local path of the .sra file prefetched in the storage bucket, downloaded the first time it is used in the container
+    """
+    sra_filename = os.path.join(tempfile.gettempdir(), SRA_LOCAL_CACHE_DIR, pipeline_params.sra_accession + ".sra")
+    sra_key = get_sra_storage_key(pipeline_params)
+    size = int(storage.head_object(pipeline_params.storage_bucket, sra_key)["content-length"])
+    if not os.path.exists(sra_filename) or os.path.getsize(sra_filename) != size:
+        os.makedirs(os.path.dirname(sra_filename), exist_ok=True)
+        download_file_parallel(pipeline_params, storage, sra_key, sra_filename + ".part")
+        os.replace(sra_filename + ".part", sra_filename)
+    return sra_filename
+
+
 def fetch_fasta_chunk(fasta_chunk: dict, target_filename: str, storage: Storage, fasta_path: S3Path):
-    # Get header data
-    extra_args = {"Range": f"bytes={fasta_chunk['offset_head']}-{fasta_chunk['offset_base']}"}
-    header_body = storage.get_object(bucket=fasta_path.bucket, key=fasta_path.key, extra_get_args=extra_args)
-    chunk_body = list(re.finditer(r">.+\n", header_body.decode("utf-8")))[0].group()
+    with open(target_filename, "wb") as target_file:
+        write_fasta_chunk(fasta_chunk, target_file, storage, fasta_path)
+
 
-    # Get chunk body and append to header
-    extra_args = {"Range": f"bytes={fasta_chunk['offset_base']}-{fasta_chunk['last_byte']}"}
-    base = storage.get_object(bucket=fasta_path.bucket, key=fasta_path.key, extra_get_args=extra_args).decode("utf-8")
-    chunk_body += base[1::] if base[0:1] == "\n" else base
+def write_fasta_chunk(fasta_chunk: dict, target_file: BinaryIO, storage: Storage, fasta_path: S3Path):
+    """
+    Write a FASTA chunk to a binary file object (a file, or the stdin pipe of a process): the header line of its
+    first sequence, built from the sequence name in the FAIDX, followed by the chunk bytes streamed from a single
+    ranged GET without decoding them. For BGZF compressed files, only the blocks that contain the chunk are fetched
+    and inflated.
+    """
+    target_file.write(b">" + fasta_chunk["seq_name"].encode("utf-8") + b"\n")
 
-    with open(target_filename, "w") as target_file:
-        target_file.writelines(chunk_body)
+    if "bgzf_range" in fasta_chunk:
+        body = open_compressed_range(
+            storage, fasta_path, fasta_chunk["bgzf_range"], fasta_chunk["offset_base"], fasta_chunk["last_byte"] + 1
+        )
+    else:
+        extra_args = {"Range": f"bytes={fasta_chunk['offset_base']}-{fasta_chunk['last_byte']}"}
+        body = storage.get_object(bucket=fasta_path.bucket, key=fasta_path.key, stream=True, extra_get_args=extra_args)
+
+    # Chunks that split a sequence may start at the end of a line
+    first = body.read(1)
+    if first != b"\n":
+        target_file.write(first)
+    shutil.copyfileobj(body, target_file, _READ_BLOCK_SIZE)
 
 
 def fetch_gem_chunk(
@@ -51,6 +91,94 @@ def fetch_gem_chunk(
     fasta_chunk: dict,
     target_filename: str,
     storage: Storage,
+    stats: Stats = None,
+):
+    download_file_parallel(pipeline_parameters, storage, fasta_chunk["gem_key"], target_filename, stats, "gem_chunk")
+
+
+def download_file_parallel(
+    pipeline_params: PipelineParameters,
+    storage: Storage,
+    key: str,
+    target_filename: str,
+    stats: Stats = None,
+    stats_prefix: str = "download",
 ):
-    key = get_gem_chunk_storage_key(pipeline_parameters, fasta_chunk["chunk_id"])
-    storage.download_file(bucket=pipeline_parameters.storage_bucket, key=key, file_name=target_filename)
+    """
+    Download an object from the storage bucket to a file, using concurrent ranged GETs of
+    pipeline_params.download_part_size bytes each. Parts are written in place into a preallocated file.
+    """
+    t0 = time.perf_counter()
+    size = int(storage.head_object(pipeline_params.storage_bucket, key)["content-length"])
+
+    fd = os.open(target_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+
+        def _write(offset, block):
+            while block:
+                written = os.pwrite(fd, block, offset)
+                offset += written
+                block = block[written:]
+
+        _download_ranges(pipeline_params, storage, key, size, _write)
+    finally:
+        os.close(fd)
+
+    _record_download_stats(stats, stats_prefix, size, time.perf_counter() - t0)
+
+
+def get_object_parallel(
+    pipeline_params: PipelineParameters,
+    storage: Storage,
+    key: str,
+    stats: Stats = None,
+    stats_prefix: str = "download",
+) -> bytearray:
+    """
+    Same as download_file_parallel, but the object is downloaded into a preallocated memory buffer
+    """
+    t0 = time.perf_counter()
+    size = int(storage.head_object(pipeline_params.storage_bucket, key)["content-length"])
+
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+
+    def _write(offset, block):
+        view[offset : offset + len(block)] = block
+
+    _download_ranges(pipeline_params, storage, key, size, _write)
+
+    _record_download_stats(stats, stats_prefix, size, time.perf_counter() - t0)
+    return buffer
+
+
+def _download_ranges(pipeline_params: PipelineParameters, storage: Storage, key: str, size: int, write):
+    part_size = pipeline_params.download_part_size
+    storage = get_pipeline_storage(storage, pipeline_params)
+
+    def _download_range(start):
+        end = min(start + part_size, size) - 1
+        body = storage.get_range(pipeline_params.storage_bucket, key, start, end + 1)
+        offset = start
+        for block in iter(lambda: body.read(_READ_BLOCK_SIZE), b""):
+            write(offset, block)
+            offset += len(block)
+        if offset != end + 1:
+            raise IOError(f"Incomplete download of {key} range {start}-{end} ({offset - start} bytes)")
+
+    parts = range(0, size, part_size)
+    if len(parts) <= 1:
+        for start in parts:
+            _download_range(start)
+    else:
+        with ThreadPoolExecutor(max_workers=min(pipeline_params.download_concurrency, len(parts))) as pool:
+            # Consume results to propagate exceptions
+            list(pool.map(_download_range, parts))
+
+
+def _record_download_stats(stats: Stats, stats_prefix: str, size: int, elapsed: float):
+    if stats is None:
+        return
+    stats.set_value(f"{stats_prefix}_bytes", size)
+    stats.set_value(f"{stats_prefix}_bytes_per_sec", size / elapsed if elapsed > 0 else None)
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import bisect
+import logging
+from collections import defaultdict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Dict, List, Tuple
+    from lithops import Storage
+    from ...pipeline import PipelineParameters
+
+logger = logging.getLogger(__name__)
+
+
+def load_regions(pipeline_params: PipelineParameters, storage: Storage) -> Dict[str, List[Tuple[int, int]]]:
+    """
+    Read target regions BED file from storage.
+    Returns a dict of sequence name -> sorted, merged list of 1-based inclusive (start, end) intervals
+    """
+    body = storage.get_object(bucket=pipeline_params.regions.bucket, key=pipeline_params.regions.key)
+    regions = parse_bed(body.decode("utf-8"))
+    logger.info(
+        "Read %d target intervals in %d sequences from %s",
+        sum(len(intervals) for intervals in regions.values()),
+        len(regions),
+        pipeline_params.regions.as_uri(),
+    )
+    return regions
+
+
+def parse_bed(text: str) -> Dict[str, List[Tuple[int, int]]]:
+    """
+    Parse BED text (0-based, half-open) into merged 1-based inclusive intervals grouped by sequence name
+    """
+    intervals = defaultdict(list)
+    for line in text.splitlines():
+        if not line or line.startswith(("#", "track", "browser")):
+            continue
+        fields = line.split("\t")
+        name, start, end = fields[0], int(fields[1]), int(fields[2])
+        if end > start:
+            intervals[name].append((start + 1, end))
+
+    return {name: merge_intervals(ivs) for name, ivs in intervals.items()}
+
+
+def merge_intervals(intervals: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Sort and merge overlapping or adjacent inclusive intervals
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def intersect_intervals(intervals: List[Tuple[int, int]], start: int, end: int) -> List[Tuple[int, int]]:
+    """
+    Clip a sorted, merged list of inclusive intervals to the inclusive range [start, end]
+    """
+    i = bisect.bisect_left(intervals, (start, start))
+    if i > 0 and intervals[i - 1][1] >= start:
+        i -= 1
+    clipped = []
+    while i < len(intervals) and intervals[i][0] <= end:
+        clipped.append((max(intervals[i][0], start), min(intervals[i][1], end)))
+        i += 1
+    return clipped
+
+
+def overlaps(intervals: List[Tuple[int, int]], start: int, end: int) -> bool:
+    """
+    Check if the inclusive range [start, end] overlaps any interval of a sorted, merged list
+    """
+    i = bisect.bisect_right(intervals, (end, float("inf")))
+    return i > 0 and intervals[i - 1][1] >= start
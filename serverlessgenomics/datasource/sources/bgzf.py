@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import zlib
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from typing import Tuple
+    from lithops import Storage
+    from ...utils import S3Path
+
+# Empty block that marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# File name suffixes of BGZF compressed FASTA files
+BGZF_SUFFIXES = (".gz", ".bgz")
+# Size of the compressed blocks read when inflating a BGZF range
+_READ_BLOCK_SIZE = 1024 * 1024
+
+
+def is_bgzf(fasta_path: S3Path) -> bool:
+    return fasta_path.key.endswith(BGZF_SUFFIXES)
+
+
+def get_gzi_key(fasta_path: S3Path) -> str:
+    return fasta_path.key + ".gzi"
+
+
+def parse_gzi(body: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Parse a bgzip index (.gzi). Returns the compressed and uncompressed offsets of the start of each block,
+    including the first block at (0, 0) that is implicit in the file.
+    """
+    (num_entries,) = np.frombuffer(body[:8], dtype="<u8")
+    entries = np.frombuffer(body[8 : 8 + 16 * int(num_entries)], dtype="<u8").reshape(-1, 2).astype(np.int64)
+    compressed_offsets = np.concatenate(([0], entries[:, 0]))
+    uncompressed_offsets = np.concatenate(([0], entries[:, 1]))
+    return compressed_offsets, uncompressed_offsets
+
+
+def load_bgzf_index(storage: Storage, fasta_path: S3Path) -> Tuple[Tuple[np.ndarray, np.ndarray], int, int]:
+    """
+    Read the bgzip index of a BGZF FASTA file.
+    Returns the block offsets (see parse_gzi), the end of the compressed data (without the EOF block) and the
+    uncompressed size of the file.
+    """
+    try:
+        gzi = storage.get_object(fasta_path.bucket, get_gzi_key(fasta_path))
+    except Exception as e:
+        raise FileNotFoundError(
+            f"BGZF index {get_gzi_key(fasta_path)} not found, compress the FASTA file with 'bgzip -i' "
+            f"or index it with 'bgzip -r'"
+        ) from e
+    compressed_offsets, uncompressed_offsets = parse_gzi(gzi)
+    compressed_size = int(storage.head_object(fasta_path.bucket, fasta_path.key)["content-length"])
+
+    # The uncompressed size of the last data block (ISIZE) is stored in its last 4 bytes
+    tail_size = min(len(BGZF_EOF) + 4, compressed_size)
+    tail = storage.get_object(
+        fasta_path.bucket,
+        fasta_path.key,
+        extra_get_args={"Range": f"bytes={compressed_size - tail_size}-{compressed_size - 1}"},
+    )
+    if tail.endswith(BGZF_EOF):
+        data_end, tail = compressed_size - len(BGZF_EOF), tail[: -len(BGZF_EOF)]
+    else:
+        data_end = compressed_size
+    last_block = np.searchsorted(compressed_offsets, data_end, side="left") - 1
+    uncompressed_size = int(uncompressed_offsets[last_block]) + int.from_bytes(tail[-4:], "little")
+
+    # Drop the entry of the EOF block, if indexed
+    block_offsets = (compressed_offsets[: last_block + 1], uncompressed_offsets[: last_block + 1])
+    return block_offsets, data_end, uncompressed_size
+
+
+def get_compressed_range(
+    block_offsets: Tuple[np.ndarray, np.ndarray], compressed_end: int, start: int, end: int
+) -> Tuple[int, int, int]:
+    """
+    Compressed byte range [compressed_start, compressed_end) of the blocks that contain the uncompressed byte range
+    [start, end), and the uncompressed offset of the first of these blocks
+    """
+    compressed_offsets, uncompressed_offsets = block_offsets
+    b0 = np.searchsorted(uncompressed_offsets, start, side="right") - 1
+    b1 = np.searchsorted(uncompressed_offsets, max(end - 1, start), side="right")
+    c1 = int(compressed_offsets[b1]) if b1 < len(compressed_offsets) else compressed_end
+    return int(compressed_offsets[b0]), c1, int(uncompressed_offsets[b0])
+
+
+class BgzfRangeReader:
+    """
+    File-like reader of the uncompressed bytes [start, end) of a BGZF file, from a stream of the compressed blocks
+    that contain them, starting at the block at uncompressed offset block_start
+    """
+
+    def __init__(self, compressed_stream, block_start: int, start: int, end: int):
+        self.__stream = compressed_stream
+        self.__skip = start - block_start
+        self.__remaining = end - start
+        self.__decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self.__buf = b""
+
+    def __inflate(self) -> bool:
+        compressed = self.__stream.read(_READ_BLOCK_SIZE)
+        data = []
+        # Each BGZF block is a gzip member, start a new decompressor at the end of each one
+        while compressed:
+            data.append(self.__decompressor.decompress(compressed))
+            if not self.__decompressor.eof:
+                break
+            compressed = self.__decompressor.unused_data
+            self.__decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        if not data:
+            return False
+        inflated = b"".join(data)
+        if self.__skip:
+            skipped = min(self.__skip, len(inflated))
+            inflated = inflated[skipped:]
+            self.__skip -= skipped
+        self.__buf += inflated
+        return True
+
+    def read(self, n: int = -1) -> bytes:
+        if n < 0:
+            n = self.__remaining
+        n = min(n, self.__remaining)
+        while len(self.__buf) < n and self.__inflate():
+            pass
+        data, self.__buf = self.__buf[:n], self.__buf[n:]
+        self.__remaining -= len(data)
+        return data
+
+
+def open_bgzf_range(
+    storage: Storage,
+    fasta_path: S3Path,
+    block_offsets: Tuple[np.ndarray, np.ndarray],
+    compressed_end: int,
+    start: int,
+    end: int,
+) -> BgzfRangeReader:
+    """
+    Open a reader of the uncompressed bytes [start, end) of a BGZF file, that fetches only the blocks containing them
+    """
+    compressed_range = get_compressed_range(block_offsets, compressed_end, start, end)
+    return open_compressed_range(storage, fasta_path, compressed_range, start, end)
+
+
+def open_compressed_range(
+    storage: Storage, fasta_path: S3Path, compressed_range: Tuple[int, int, int], start: int, end: int
+) -> BgzfRangeReader:
+    """
+    Open a reader of the uncompressed bytes [start, end) of a BGZF file, from the compressed range returned by
+    get_compressed_range for them, with a single ranged GET
+    """
+    c0, c1, block_start = compressed_range
+    stream = storage.get_object(
+        bucket=fasta_path.bucket, key=fasta_path.key, stream=True, extra_get_args={"Range": f"bytes={c0}-{c1 - 1}"}
+    )
+    return BgzfRangeReader(stream, block_start, start, end)
@@ -1,73 +1,215 @@
-import bz2
 import itertools
 import logging
 import math
 import os
-import re
-from functools import reduce
+from functools import partial, reduce
+from typing import List, Optional, Tuple
+
+import numpy as np
 
 from serverlessgenomics.pipeline import PipelineParameters, Lithops
+from serverlessgenomics.storage import get_pipeline_storage
 from serverlessgenomics.utils import try_head_object
+from .bed import intersect_intervals
+from .bgzf import is_bgzf, load_bgzf_index, get_compressed_range, open_bgzf_range
 
 logger = logging.getLogger(__name__)
 
 
+# Format of the FASTA indexes stored in the bucket, older indexes are generated again
+FAIDX_FORMAT = "fai"
+# Columns of a FASTA index loaded with parse_fai
+FAIDX_DTYPE = np.dtype(
+    [
+        ("name", object),
+        ("length", np.int64),
+        ("offset", np.int64),
+        ("line_bases", np.int64),
+        ("line_width", np.int64),
+        ("offset_head", np.int64),
+    ]
+)
+
+# Size of the blocks read when scanning a FASTA byte range
+FAIDX_BLOCK_SIZE = 4 * 1024 * 1024
+# A chunk starting with a longer line does not start in the middle of a header
+_MAX_HEADER_LENGTH = 64 * 1024
+
+
+class _RangeScanner:
+    """
+    Scan a byte range of an object in blocks, keeping in memory only the bytes that have not been released.
+    Searches can continue past the end of the range (up to the end of the object) to complete a line.
+    """
+
+    def __init__(self, open_stream, start: int, range_end: int, size: int):
+        self.__open_stream = open_stream
+        self.__stream = open_stream(start, range_end)
+        self.__stream_end = range_end
+        self.__size = size
+        self.__buf = bytearray()
+        self.__buf_start = start
+
+    def __load(self) -> bool:
+        block = self.__stream.read(FAIDX_BLOCK_SIZE)
+        if not block and self.__stream_end < self.__size:
+            self.__stream = self.__open_stream(self.__stream_end, self.__size)
+            self.__stream_end = self.__size
+            block = self.__stream.read(FAIDX_BLOCK_SIZE)
+        self.__buf += block
+        return len(block) > 0
+
+    def __loaded_end(self) -> int:
+        return self.__buf_start + len(self.__buf)
+
+    def release(self, pos: int):
+        """
+        Drop buffered bytes before absolute position pos
+        """
+        if pos > self.__buf_start:
+            del self.__buf[: pos - self.__buf_start]
+            self.__buf_start = pos
+
+    def find(self, sub: bytes, start: int, limit: int, keep: bool = True) -> int:
+        """
+        Absolute position of the first occurrence of sub that starts at or after start and before limit, -1 if none.
+        Bytes before the searched position are released, unless keep is set.
+        """
+        while start < limit:
+            i = self.__buf.find(sub, max(start - self.__buf_start, 0))
+            if i >= 0:
+                pos = self.__buf_start + i
+                return pos if pos < limit else -1
+            loaded_end = self.__loaded_end()
+            if loaded_end >= limit + len(sub) - 1:
+                return -1
+            start = max(start, loaded_end - len(sub) + 1)
+            if not keep:
+                self.release(start)
+            if not self.__load():
+                return -1
+        return -1
+
+    def get(self, start: int, end: int) -> bytes:
+        """
+        Bytes between absolute positions start and end (not released), loading them if needed
+        """
+        while self.__loaded_end() < end and self.__load():
+            pass
+        return bytes(self.__buf[start - self.__buf_start : end - self.__buf_start])
+
+    def line_geometry(self, line_start: int) -> Tuple[int, int]:
+        """
+        Bases and bytes of the line starting at line_start, or (0, 0) if there is no sequence line there
+        """
+        if line_start >= self.__size or self.get(line_start, line_start + 1) == b">":
+            return 0, 0
+        line_end = self.find(b"\n", line_start, self.__size, keep=False)
+        if line_end < 0:
+            # Last line of the file without newline
+            return self.__size - line_start, self.__size - line_start + 1
+        return line_end - line_start, line_end - line_start + 1
+
+
 def create_index_chunked(storage, id, fasta_path, chunk_size, fasta_size, num_chunks):
     """
     Lithops callee function (map)
-    Generate partial index of a chunk of a FASTA file
+    Generate partial index of a chunk of a FASTA file.
+    The chunk is streamed in blocks of bytes, keeping only the state of the current header or line between blocks.
+    Entries are "name offset_head offset_base line_bases line_width", plus the markers that reduce_chunked_indexes
+    uses to stitch headers split between chunks.
     """
+    fasta_size = int(fasta_size)
     min_range = id * chunk_size
-    max_range = int(fasta_size) if id == num_chunks - 1 else (id + 1) * chunk_size
-    data = storage.get_object(
-        bucket=fasta_path.bucket,
-        key=fasta_path.key,
-        extra_get_args={"Range": f"bytes={min_range}-{max_range - 1}"},
-    ).decode("utf-8")
+    max_range = fasta_size if id == num_chunks - 1 else (id + 1) * chunk_size
+
+    return scan_fasta_range(open_fasta_stream_factory(storage, fasta_path), min_range, max_range, fasta_size)
+
+
+def open_fasta_stream_factory(storage, fasta_path):
+    """
+    Returns a function open_stream(start, end) that opens a file-like object to read the bytes [start, end) of a FASTA
+    file. Offsets of BGZF compressed files are uncompressed offsets, only the blocks that contain them are fetched.
+    """
+    if is_bgzf(fasta_path):
+        block_offsets, compressed_end, _ = load_bgzf_index(storage, fasta_path)
+        return partial(open_bgzf_range, storage, fasta_path, block_offsets, compressed_end)
+
+    def _open_stream(start, end):
+        extra_args = {"Range": f"bytes={start}-{end - 1}"}
+        return storage.get_object(bucket=fasta_path.bucket, key=fasta_path.key, stream=True, extra_get_args=extra_args)
+
+    return _open_stream
+
+
+def get_fasta_size(storage, fasta_path) -> int:
+    """
+    Size of a FASTA file, the uncompressed size for BGZF compressed files
+    """
+    if is_bgzf(fasta_path):
+        _, _, uncompressed_size = load_bgzf_index(storage, fasta_path)
+        return uncompressed_size
+    return int(storage.head_object(fasta_path.bucket, fasta_path.key)["content-length"])
+
+
+def scan_fasta_range(open_stream, min_range: int, max_range: int, fasta_size: int) -> List[str]:
+    """
+    Generate the partial index entries of the FASTA byte range [min_range, max_range).
+    open_stream(start, end) must return a file-like object to read the FASTA bytes [start, end).
+    """
     content = []
-    # If it were '>' it would also find the ones inside the head information
-    ini_heads = list(re.finditer(r"\n>", data))
-    heads = list(re.finditer(r">.+\n", data))
-
-    if ini_heads or data[0] == ">":  # If the list is not empty or there is > in the first byte
-        first_sequence = True
-        prev = -1
-        for m in heads:
-            start = min_range + m.start()
-            end = min_range + m.end()
-            if first_sequence:
-                first_sequence = False
-                if id > 0 and start - 1 > min_range:
-                    # If it is not the worker of the first part of the file and in addition it
-                    # turns out that the partition begins in the middle of the base of a sequence.
-                    # (start-1): avoid having a split sequence in the index that only has '\n'.
-                    match_text = list(re.finditer(".*\n", data[0 : m.start()]))
-                    if match_text and len(match_text) > 1:
-                        text = match_text[0].group().split(" ")[0].replace("\n", "")
-                        offset = match_text[1].start() + min_range
-                        # >> offset_head offset_bases_split ^first_line_before_space_or_\n^
-                        content.append(f">> <Y> {str(offset)} ^{text}^")  # Split sequences
-                    else:
-                        # When the first header found is false, when in a split stream there is a split header
-                        # that has a '>' inside (ex: >tr|...o-alpha-(1->5)-L-e...\n)
-                        first_sequence = True
-            if prev != start:  # When if the current sequence base is not empty
-                # name_id offset_head offset_bases
-                id_name = m.group().replace("\n", "").split(" ")[0].replace(">", "")
-                content.append(f"{id_name} {str(start)} {str(end)}")
-            prev = end
-
-        # Check if the last head of the current one is cut. (ini_heads[-1].start() + 1): ignore '\n'
-        if len(heads) != 0 and len(ini_heads) != 0 and ini_heads[-1].start() + 1 > heads[-1].start():
-            last_seq_start = ini_heads[-1].start() + min_range + 1  # (... + 1): ignore '\n'
-            text = data[last_seq_start - min_range : :]
-            # [<->|<_>]name_id_split offset_head
-            # if '<->' there is all id
-            content.append(f"{'<-' if ' ' in text else '<_'}{text.split(' ')[0]} {str(last_seq_start)}")
+    # Start one byte before the range to know if it starts at the beginning of a line
+    scan_start = max(min_range - 1, 0)
+    scanner = _RangeScanner(open_stream, scan_start, max_range, fasta_size)
+
+    if min_range == 0:
+        head = 0 if scanner.get(0, 1) == b">" else _find_head(scanner, 0, max_range)
+    else:
+        head = _find_head(scanner, scan_start, max_range)
+        if head != min_range:
+            # The range starts in the middle of a line, that may be the end of a header split with the previous
+            # range: >> offset_bases_split ^first_line_before_space^ line_bases line_width
+            first_line_end = scanner.find(b"\n", min_range, min(max_range, min_range + _MAX_HEADER_LENGTH))
+            if first_line_end >= 0:
+                text = scanner.get(min_range, first_line_end).decode("utf-8").split(" ")[0]
+                line_bases, line_width = scanner.line_geometry(first_line_end + 1)
+                content.append(f">> <Y> {first_line_end + 1} ^{text}^ {line_bases} {line_width}")
+            else:
+                content.append(f">> <Y> {min_range} ^^ 0 0")
+
+    while head is not None:
+        header_end = scanner.find(b"\n", head, max_range)
+        if header_end < 0:
+            # Header cut at the end of the range: [<->|<_>]name_id_split offset_head ('<->' if there is all id)
+            text = scanner.get(head, max_range).decode("utf-8")
+            content.append(f"{'<-' if ' ' in text else '<_'}{text.split(' ')[0]} {head}")
+            break
+
+        # name_id offset_head offset_bases line_bases line_width
+        name = scanner.get(head + 1, header_end).decode("utf-8").rstrip("\r").split(" ")[0]
+        line_bases, line_width = scanner.line_geometry(header_end + 1)
+        content.append(f"{name} {head} {header_end + 1} {line_bases} {line_width}")
+
+        head = _find_head(scanner, header_end, max_range, keep=False)
 
     return content
 
 
+def _find_head(scanner: _RangeScanner, start: int, max_range: int, keep: bool = True) -> Optional[int]:
+    # Position of the next header that starts before max_range (a '>' at the beginning of a line)
+    pos = scanner.find(b"\n>", start, max_range - 1, keep)
+    return pos + 1 if pos >= 0 else None
+
+
+def sequence_length(body_bytes: int, line_bases: int, line_width: int) -> int:
+    """
+    Number of bases of a sequence from the bytes of its body (including newlines) and its line geometry
+    """
+    if line_width == 0:
+        return 0
+    return body_bytes - math.ceil(body_bytes / line_width) * (line_width - line_bases)
+
+
 def reduce_chunked_indexes(results, storage):
     """
     Lithops callee function (reduce)
@@ -104,14 +246,16 @@ def reduce_chunked_indexes(results, storage):
 
     num_sequences = reduce(lambda x, y: x + y, map(lambda r: len(r), results))
 
-    index_result = bz2.compress(b"\n".join(s.encode("utf-8") for s in itertools.chain(*results)))
-    s3 = storage.get_client()
-    s3.put_object(
-        Bucket=bucket,
-        Key=faidx_key,
-        Body=index_result,
-        Metadata={"num_sequences": str(num_sequences)},
-    )
+    # Sequence length from the bytes up to the next header (or the end of the file)
+    fasta_end = int(os.getenv("FASTA_END"))
+    entries = [s.split(" ") for s in itertools.chain(*results)]
+    fai_entries = []
+    for i, (name, offset_head, offset_base, line_bases, line_width) in enumerate(entries):
+        seq_end = int(entries[i + 1][1]) if i + 1 < len(entries) else fasta_end
+        length = sequence_length(seq_end - int(offset_base), int(line_bases), int(line_width))
+        fai_entries.append((name, length, int(offset_base), int(line_bases), int(line_width)))
+
+    put_faidx(storage, bucket, faidx_key, format_fai(fai_entries), num_sequences)
     return num_sequences
 
 
@@ -130,13 +274,24 @@ def generate_faidx_from_s3(pipeline_params: PipelineParameters, lithops: Lithops
 
     faidx_key = get_faidx_key(pipeline_params)
     faidx_head = try_head_object(lithops.storage, pipeline_params.storage_bucket, faidx_key)
+    if faidx_head is not None and faidx_head.get("x-amz-meta-faidx_format") != FAIDX_FORMAT:
+        logger.info("Faidx for %s has an old format, it will be generated again", pipeline_params.fasta_path.stem)
+        faidx_head = None
+    source_fai_key = pipeline_params.fasta_path.key + ".fai"
+    source_fai_head = try_head_object(lithops.storage, pipeline_params.fasta_path.bucket, source_fai_key)
+
     if faidx_head is not None:
         logger.debug("Faidx for %s found", pipeline_params.fasta_path.stem)
         num_sequences = int(faidx_head["x-amz-meta-num_sequences"])
+    elif source_fai_head is not None:
+        # Import the .fai that comes with the reference, no need to scan the FASTA file
+        logger.info("Importing faidx for %s from %s", pipeline_params.fasta_path.stem, source_fai_key)
+        fai = lithops.storage.get_object(pipeline_params.fasta_path.bucket, source_fai_key)
+        num_sequences = len(parse_fai(fai))
+        put_faidx(lithops.storage, pipeline_params.storage_bucket, faidx_key, fai, num_sequences)
     else:
         logger.info("Faidx for %s not found, generating fasta index file", pipeline_params.fasta_path.stem)
-        fasta_head = lithops.storage.head_object(pipeline_params.fasta_path.bucket, pipeline_params.fasta_path.key)
-        fasta_file_sz = int(fasta_head["content-length"])
+        fasta_file_sz = get_fasta_size(lithops.storage, pipeline_params.fasta_path)
         chunk_size = math.ceil(fasta_file_sz / pipeline_params.fasta_chunks)
 
         map_iterdata = [{"fasta_path": pipeline_params.fasta_path}] * pipeline_params.fasta_chunks
@@ -145,7 +300,11 @@ def generate_faidx_from_s3(pipeline_params: PipelineParameters, lithops: Lithops
             "fasta_size": fasta_file_sz,
             "num_chunks": pipeline_params.fasta_chunks,
         }
-        extra_env = {"BUCKET": pipeline_params.storage_bucket, "FAIDX_KEY": faidx_key}
+        # Sequence lengths assume newline terminated lines, count a missing newline at the end of the file
+        open_stream = open_fasta_stream_factory(lithops.storage, pipeline_params.fasta_path)
+        last_byte = open_stream(fasta_file_sz - 1, fasta_file_sz).read()
+        fasta_end = fasta_file_sz if last_byte == b"\n" else fasta_file_sz + 1
+        extra_env = {"BUCKET": pipeline_params.storage_bucket, "FAIDX_KEY": faidx_key, "FASTA_END": str(fasta_end)}
         num_sequences = lithops.invoker.map_reduce(
             map_function=create_index_chunked,
             map_iterdata=map_iterdata,
@@ -166,67 +325,126 @@ def generate_faidx_from_s3(pipeline_params: PipelineParameters, lithops: Lithops
 
 def get_fasta_byte_ranges(pipeline_params: PipelineParameters, lithops: Lithops, num_sequences):
     """
-    Generate chunks according to the number of fasta chunks requested
+    Generate chunks according to the number of fasta chunks requested.
+    Chunks are split at byte boundaries, moved back to the start of the header when they fall inside one.
+    For BGZF compressed files, boundaries are uncompressed offsets and each chunk includes the compressed range of the
+    blocks that contain it.
     """
-    fasta_chunks = []
-    fasta_file_head = lithops.storage.head_object(pipeline_params.fasta_path.bucket, pipeline_params.fasta_path.key)
-    fasta_file_sz = int(fasta_file_head["content-length"])
-    fa_chunk_size = int(fasta_file_sz / int(pipeline_params.fasta_chunks))
-    faidx_key = get_faidx_key(pipeline_params)
-    compressed_faidx = lithops.storage.get_object(pipeline_params.storage_bucket, faidx_key)
-    faidx = bz2.decompress(compressed_faidx).decode("utf-8").split("\n")
-
-    i = j = 0
-    min = fa_chunk_size * j
-    max = fa_chunk_size * (j + 1)
-    while max <= fasta_file_sz:
-        # Find first full/half sequence of the chunk
-        if int(faidx[i].split(" ")[1]) <= min < int(faidx[i].split(" ")[2]):  # In the head
-            fa_chunk = {
-                "offset_head": int(faidx[i].split(" ")[1]),
-                "offset_base": int(faidx[i].split(" ")[2]),
-            }
-        elif i == num_sequences - 1 or min < int(faidx[i + 1].split(" ")[1]):  # In the base
-            fa_chunk = {"offset_head": int(faidx[i].split(" ")[1]), "offset_base": min}
-        elif i < num_sequences:
-            i += 1
-            while i + 1 < num_sequences and min > int(faidx[i + 1].split(" ")[1]):
-                i += 1
-            if min < int(faidx[i].split(" ")[2]):
-                fa_chunk = {
-                    "offset_head": int(faidx[i].split(" ")[1]),
-                    "offset_base": int(faidx[i].split(" ")[2]),
-                }
-            else:
-                fa_chunk = {
-                    "offset_head": int(faidx[i].split(" ")[1]),
-                    "offset_base": min,
-                }
-        else:
-            raise Exception("ERROR: there was a problem getting the first byte of a fasta chunk.")
-
-        # Find last full/half sequence of the chunk
-        if i == num_sequences - 1 or max < int(faidx[i + 1].split(" ")[1]):
-            fa_chunk["last_byte"] = max - 1 if fa_chunk_size * (j + 2) <= fasta_file_sz else fasta_file_sz - 1
-        else:
-            if max < int(faidx[i + 1].split(" ")[2]):  # Split in the middle of head
-                fa_chunk["last_byte"] = int(faidx[i + 1].split(" ")[1]) - 1
-                i += 1
-            elif i < num_sequences:
-                i += 1
-                while i + 1 < num_sequences and max > int(faidx[i + 1].split(" ")[1]):
-                    i += 1
-                fa_chunk["last_byte"] = max - 1
-            else:
-                raise Exception("ERROR: there was a problem getting the last byte of a fasta chunk.")
+    fasta_path = pipeline_params.fasta_path
+    if is_bgzf(fasta_path):
+        block_offsets, compressed_end, fasta_file_sz = load_bgzf_index(lithops.storage, fasta_path)
+    else:
+        fasta_file_sz = get_fasta_size(lithops.storage, fasta_path)
+    fa_chunk_size = max(int(fasta_file_sz / int(pipeline_params.fasta_chunks)), 1)
+    faidx = load_faidx(pipeline_params, lithops.storage)
+    assert len(faidx) == num_sequences
+
+    # Sequence that contains the first byte of each chunk
+    boundaries = fa_chunk_size * np.arange(fasta_file_sz // fa_chunk_size)
+    seq = np.searchsorted(faidx["offset_head"], boundaries, side="right") - 1
+    in_header = boundaries < faidx["offset"][seq]
+    first_bytes = np.where(in_header, faidx["offset_head"][seq], boundaries)
+    offset_bases = np.where(in_header, faidx["offset"][seq], boundaries)
+    last_bytes = np.append(first_bytes[1:] - 1, fasta_file_sz - 1)
 
-        fa_chunk["chunk_id"] = j
-        fasta_chunks.append(fa_chunk)
-        j += 1
-        min = fa_chunk_size * j
-        max = fa_chunk_size * (j + 1)
+    fasta_chunks = []
+    for j in range(len(boundaries)):
+        fasta_chunk = {
+            "offset_head": int(faidx["offset_head"][seq[j]]),
+            "offset_base": int(offset_bases[j]),
+            # Name of the first sequence, to write its header line when fetching the chunk
+            "seq_name": faidx["name"][seq[j]],
+            "last_byte": int(last_bytes[j]),
+            "chunk_id": j,
+        }
+        if is_bgzf(fasta_path):
+            # (compressed start, compressed end, uncompressed offset of the first block) of the chunk bytes
+            fasta_chunk["bgzf_range"] = get_compressed_range(
+                block_offsets, compressed_end, fasta_chunk["offset_base"], fasta_chunk["last_byte"] + 1
+            )
+        fasta_chunks.append(fasta_chunk)
     return fasta_chunks
 
 
 def get_faidx_key(pipeline_params: PipelineParameters):
     return os.path.join(pipeline_params.faidx_prefix, pipeline_params.fasta_path.key + ".fai")
+
+
+def put_faidx(storage, bucket: str, faidx_key: str, fai: bytes, num_sequences: int):
+    get_pipeline_storage(storage).put_object(
+        bucket, faidx_key, fai, metadata={"num_sequences": str(num_sequences), "faidx_format": FAIDX_FORMAT}
+    )
+
+
+def load_faidx(pipeline_params: PipelineParameters, storage) -> np.ndarray:
+    """
+    Read the FASTA index of the pipeline reference, see parse_fai
+    """
+    return parse_fai(storage.get_object(pipeline_params.storage_bucket, get_faidx_key(pipeline_params)))
+
+
+def format_fai(entries: List[Tuple[str, int, int, int, int]]) -> bytes:
+    """
+    Format (name, length, offset, line_bases, line_width) entries as a samtools FASTA index (.fai)
+    """
+    return "".join("\t".join(str(field) for field in entry) + "\n" for entry in entries).encode("utf-8")
+
+
+def parse_fai(body: bytes) -> np.ndarray:
+    """
+    Parse a samtools FASTA index (.fai) into a structured array with the fai columns (name, length, offset,
+    line_bases, line_width) and the offset of the header line of each sequence (offset_head), which is derived
+    from the end of the previous sequence
+    """
+    rows = [line.split("\t")[:5] for line in body.decode("utf-8").splitlines() if line]
+    faidx = np.zeros(len(rows), dtype=FAIDX_DTYPE)
+    if not rows:
+        return faidx
+    names, *columns = zip(*rows)
+    faidx["name"] = names
+    for field, column in zip(("length", "offset", "line_bases", "line_width"), columns):
+        faidx[field] = np.array(column, dtype=np.int64)
+
+    # Bytes of each sequence body: full lines plus the last partial line with its newline
+    line_bases = np.maximum(faidx["line_bases"], 1)
+    full_lines, rem = np.divmod(faidx["length"], line_bases)
+    body_bytes = full_lines * faidx["line_width"] + np.where(rem > 0, rem + faidx["line_width"] - line_bases, 0)
+    faidx["offset_head"][1:] = faidx["offset"][:-1] + body_bytes[:-1]
+    return faidx
+
+
+def _bases_before(offset: int, line_bases: int, line_width: int) -> int:
+    # Number of bases between the start of a sequence body and a relative byte offset
+    if line_width == 0:
+        return 0
+    full_lines, rem = divmod(offset, line_width)
+    return full_lines * line_bases + min(rem, line_bases)
+
+
+def get_fasta_chunk_targets(fasta_chunk: dict, faidx: np.ndarray, regions: dict) -> dict:
+    """
+    Intersect target regions with the sequences covered by a FASTA chunk.
+    Returns a dict of sequence name -> list of inclusive intervals, in chunk-local coordinates
+    (positions are relative to the chunk start when the chunk splits a sequence, as indexed by GEM).
+    """
+    targets = {}
+    i0 = np.searchsorted(faidx["offset_head"], fasta_chunk["offset_head"], side="left")
+    i1 = np.searchsorted(faidx["offset_head"], fasta_chunk["last_byte"], side="right")
+    for i in range(i0, i1):
+        name, offset_base = faidx["name"][i], int(faidx["offset"][i])
+        line_bases, line_width = int(faidx["line_bases"][i]), int(faidx["line_width"][i])
+        seq_end = int(faidx["offset_head"][i + 1]) - 1 if i + 1 < len(faidx) else fasta_chunk["last_byte"]
+        first_byte = max(offset_base, fasta_chunk["offset_base"])
+        last_byte = min(seq_end, fasta_chunk["last_byte"])
+        if first_byte > last_byte or name not in regions:
+            continue
+
+        # 1-based positions in the whole sequence for the bases included in this chunk
+        pos_0 = _bases_before(first_byte - offset_base, line_bases, line_width) + 1
+        pos_1 = _bases_before(last_byte - offset_base + 1, line_bases, line_width)
+        shift = pos_0 - 1
+        intervals = [(s - shift, e - shift) for s, e in intersect_intervals(regions[name], pos_0, pos_1)]
+        if intervals:
+            targets[name] = intervals
+
+    return targets
@@ -14,6 +14,7 @@ import numpy as np
 import pandas as pd
 
 from ...pipeline import PipelineParameters, Lithops
+from ...storage import get_pipeline_storage
 from ...utils import try_head_object, S3Path, force_delete_local_path
 
 if TYPE_CHECKING:
@@ -158,11 +159,8 @@ def generate_idx_from_gzip(pipeline_params: PipelineParameters, gzip_file_path:
 
         tab_sz = out_stream.tell()
         out_stream.seek(0)
-        storage.get_client().upload_fileobj(
-            Bucket=pipeline_params.storage_bucket,
-            Key=gzip_tab_key,
-            Fileobj=out_stream,
-            ExtraArgs={"Metadata": {"total_lines": str(total_lines)}},
+        get_pipeline_storage(storage, pipeline_params).upload_fileobj(
+            out_stream, pipeline_params.storage_bucket, gzip_tab_key, metadata={"total_lines": str(total_lines)}
         )
 
         return total_lines, idx_sz, tab_sz
@@ -179,7 +177,7 @@ def get_ranges_from_line_pairs(pipeline_params: PipelineParameters, pairs: List[
 
     # Download gzip tab into an in-memory buffer and read dataframe into Pandas
     buff = io.BytesIO()
-    storage.get_client().download_fileobj(Bucket=pipeline_params.storage_bucket, Key=gzip_tab_key, Fileobj=buff)
+    get_pipeline_storage(storage, pipeline_params).download_fileobj(pipeline_params.storage_bucket, gzip_tab_key, buff)
     buff.seek(0)
     df = pd.read_parquet(buff)
     del buff
@@ -228,7 +226,6 @@ def fetch_fastq_chunk_s3_fastqgzip(
     tmp_index_file = tempfile.mktemp()
     gzip_idx_key, _ = get_fastqgz_idx_keys(pipeline_parameters)
     gztool = get_gztool_path()
-    lines = []
     lines_to_read = fastq_chunk["line_1"] - fastq_chunk["line_0"] + 1
 
     try:
@@ -281,34 +278,9 @@ def fetch_fastq_chunk_s3_fastqgzip(
         writer_thread = threading.Thread(target=_writer_feeder)
         writer_thread.start()
 
-        output_chunk = proc.stdout.read(CHUNK_SIZE)
-        last_line = None
-        while output_chunk != b"":
-            # logger.debug('Read %d bytes from pipe', len(chunk))
-            text = output_chunk.decode("utf-8")
-            chunk_lines = text.splitlines()
-
-            if last_line is not None:
-                last_line = last_line + chunk_lines.pop(0)
-                lines.append(last_line)
-                last_line = None
-
-            if text[-1] != "\n":
-                last_line = chunk_lines.pop()
-
-            lines.extend(chunk_lines)
-
-            # Stop decompressing lines if number of lines to read in this chunk is reached
-            if len(lines) > lines_to_read:
-                proc.stdout.close()
-                break
-
-            # Try to read next decompressed chunk
-            # a ValueError is raised if the pipe is closed, meaning the writer or the subprocess closed it
-            try:
-                output_chunk = proc.stdout.read(CHUNK_SIZE)
-            except ValueError:
-                output_chunk = b""
+        lines = read_lines(proc.stdout, lines_to_read)
+        # Stop decompressing if there are lines left
+        proc.stdout.close()
 
         try:
             proc.wait()
@@ -330,6 +302,42 @@ def fetch_fastq_chunk_s3_fastqgzip(
         force_delete_local_path(tmp_index_file)
 
 
+def read_lines(stream, lines_to_read: int) -> List[str]:
+    """
+    Read lines from a stream of decompressed bytes, in blocks of CHUNK_SIZE, until more than lines_to_read lines
+    are read or the stream ends
+    """
+    lines = []
+    output_chunk = stream.read(CHUNK_SIZE)
+    last_line = None
+    while output_chunk != b"":
+        # logger.debug('Read %d bytes from pipe', len(chunk))
+        text = output_chunk.decode("utf-8")
+        chunk_lines = text.splitlines()
+
+        if last_line is not None:
+            last_line = last_line + chunk_lines.pop(0)
+            lines.append(last_line)
+            last_line = None
+
+        if text[-1] != "\n":
+            last_line = chunk_lines.pop()
+
+        lines.extend(chunk_lines)
+
+        # Stop decompressing lines if number of lines to read in this chunk is reached
+        if len(lines) > lines_to_read:
+            break
+
+        # Try to read next decompressed chunk
+        # a ValueError is raised if the pipe is closed, meaning the writer or the subprocess closed it
+        try:
+            output_chunk = stream.read(CHUNK_SIZE)
+        except ValueError:
+            output_chunk = b""
+    return lines
+
+
 def get_fastqgz_idx_keys(pipeline_params: PipelineParameters) -> Tuple[str, str]:
     """
     Helper function to format fastqgz index keys in storage as tuple (index file key, tab data key)
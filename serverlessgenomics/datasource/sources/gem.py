@@ -1,24 +1,66 @@
 from __future__ import annotations
 
+import hashlib
 import os
 from typing import TYPE_CHECKING
 
+from ...minimizers import KMER_SIZE, WINDOW_SIZE
+
 if TYPE_CHECKING:
     from ...pipeline import PipelineParameters
 
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+# Version of the GEM indexing process (gem-indexer and its options), included in the content hash of GEM chunks.
+# Change it to stop reusing GEM files indexed differently
+GEM_INDEX_VERSION = "gem3-indexer-1"
+
+
+def get_gem_chunk_storage_key(pipeline_params: PipelineParameters, chunk_hash: str) -> str:
+    """
+    GEM files are content addressed: stored by the hash of the FASTA chunk they index (see hash_fasta_chunk_file),
+    so identical chunks share the GEM file across references and chunkings
+    """
+    return os.path.join(pipeline_params.gem_index_prefix, "objects", chunk_hash + ".gem")
+
 
-def get_gem_chunk_storage_key(pipeline_params: PipelineParameters, fasta_chunk_id: int) -> str:
+def get_gem_manifest_key(pipeline_params: PipelineParameters) -> str:
+    """
+    Manifest of the GEM files for the chunks of a reference with a number of chunks
+    """
     return os.path.join(
         pipeline_params.gem_index_prefix,
+        "manifests",
+        pipeline_params.fasta_path.bucket,
         pipeline_params.fasta_path.key,
-        f"{pipeline_params.fasta_chunks}-chunks",
-        "chunk" + str(fasta_chunk_id).zfill(4) + ".gem",
+        f"{pipeline_params.fasta_chunks}-chunks.json",
     )
 
 
-def get_gem_chunk_storage_prefix(pipeline_params: PipelineParameters) -> str:
+def hash_fasta_chunk_file(fasta_chunk_filename: str) -> str:
+    """
+    Content hash of a fetched FASTA chunk, used as its GEM file identity
+    """
+    return hash_file(fasta_chunk_filename, GEM_INDEX_VERSION.encode("utf-8"))
+
+
+def hash_file(filename: str, salt: bytes = b"") -> str:
+    """
+    SHA-256 hex digest of the contents of a file, preceded by salt
+    """
+    sha256 = hashlib.sha256(salt)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_sketch_chunk_storage_key(pipeline_params: PipelineParameters, chunk_hash: str) -> str:
+    """
+    Minimizer sketches are content addressed like the GEM files, by the hash of the FASTA chunk and the sketch
+    parameters
+    """
     return os.path.join(
-        pipeline_params.gem_index_prefix,
-        pipeline_params.fasta_path.key,
-        f"{pipeline_params.fasta_chunks}-chunks",
+        pipeline_params.gem_index_prefix, "objects", f"{chunk_hash}.k{KMER_SIZE}w{WINDOW_SIZE}.sketch.npy"
     )
@@ -1,82 +1,220 @@
+from __future__ import annotations
+
+import math
+import multiprocessing
 import os
+import shutil
 import subprocess
-import xml
+import tempfile
+import time
+import json
 import logging
+from typing import TYPE_CHECKING
+from xml.etree import ElementTree
 
 import requests
 
 from serverlessgenomics.pipeline import PipelineParameters
+from serverlessgenomics.storage import get_pipeline_storage
+from serverlessgenomics.utils import force_delete_local_path, try_head_object
+
+if TYPE_CHECKING:
+    from typing import List
+    from lithops import Storage
 
 logger = logging.getLogger(__name__)
 
 SRA_EFETCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+SRA_EFETCH_TIMEOUT = 30
+SRA_EFETCH_RETRIES = 3
+# Default local metadata directory (in the temporary directory), see get_sra_metadata_batch
+SRA_METADATA_LOCAL_DIR = "sra-metadata"
 
+# vdb-config is run once per container
+_vdb_configured = False
 
-def get_sra_metadata(pipeline_params: PipelineParameters) -> int:
-    params = {"db": "sra", "id": pipeline_params.sra_accession, "retmode": "xml"}
 
-    response = requests.get(SRA_EFETCH_URL, params=params)
+def get_sra_metadata(pipeline_params: PipelineParameters, storage: Storage) -> dict:
+    """
+    Metadata of the pipeline SRA accession, see get_sra_metadata_batch
+    """
+    return get_sra_metadata_batch(pipeline_params, storage, [pipeline_params.sra_accession])[
+        pipeline_params.sra_accession
+    ]
 
-    if response.status_code == 200:
-        xml_data = response.text
-        root = xml.etree.ElementTree.fromstring(xml_data)
 
-        for run in root.iter("RUN"):
-            reads = int(run.get("total_spots"))
-            logger.debug(
-                "Read %d total reads from efetch for sequence %s",
-                reads,
-                pipeline_params.sra_accession,
+def get_sra_metadata_batch(pipeline_params: PipelineParameters, storage: Storage, accessions: List[str]) -> dict:
+    """
+    Metadata (spots, bases and layout) of many SRA run accessions. Returns a dict of accession -> metadata.
+    Metadata is looked up in the local metadata directory, then in the storage bucket cache, and the remaining
+    accessions are fetched from NCBI efetch in a single request. Fetched metadata is cached in both places.
+    The local directory can contain fixtures for offline runs: <accession>.json files with the metadata, or
+    <accession>.xml files with an efetch response.
+    """
+    local_dir = pipeline_params.sra_metadata_dir or os.path.join(tempfile.gettempdir(), SRA_METADATA_LOCAL_DIR)
+    metadata = {}
+
+    for accession in dict.fromkeys(accessions):
+        json_filename = os.path.join(local_dir, accession + ".json")
+        xml_filename = os.path.join(local_dir, accession + ".xml")
+        metadata_key = _get_sra_metadata_key(pipeline_params, accession)
+        if os.path.exists(json_filename):
+            with open(json_filename, "r") as json_file:
+                metadata[accession] = json.load(json_file)
+        elif os.path.exists(xml_filename):
+            with open(xml_filename, "rb") as xml_file:
+                metadata.update(parse_sra_efetch(xml_file, [accession]))
+        elif try_head_object(storage, pipeline_params.storage_bucket, metadata_key) is not None:
+            metadata[accession] = json.loads(storage.get_object(pipeline_params.storage_bucket, metadata_key))
+        if accession in metadata:
+            logger.debug("Using cached metadata for %s", accession)
+
+    missing = [accession for accession in dict.fromkeys(accessions) if accession not in metadata]
+    if missing:
+        fetched = fetch_sra_metadata(missing)
+        for accession, acc_metadata in fetched.items():
+            body = json.dumps(acc_metadata)
+            storage.put_object(
+                pipeline_params.storage_bucket, _get_sra_metadata_key(pipeline_params, accession), body.encode("utf-8")
             )
-            return reads
-    else:
-        raise Exception(f"Error fetching metadata for {pipeline_params.sra_accession}: {response.status_code}")
+            os.makedirs(local_dir, exist_ok=True)
+            with open(os.path.join(local_dir, accession + ".json"), "w") as json_file:
+                json_file.write(body)
+        metadata.update(fetched)
+
+    return metadata
 
 
-def fetch_fastq_chunk_sra(seq_name: str, fastq_chunk: dict, target_filename: str):
+def fetch_sra_metadata(accessions: List[str]) -> dict:
     """
-    Function to retrieve the relevant SRA chunk using fastq-dump and save it to object storage
+    Fetch the metadata of SRA run accessions from NCBI efetch, in a single request
     """
+    params = {"db": "sra", "id": ",".join(accessions), "retmode": "xml"}
+    for attempt in range(SRA_EFETCH_RETRIES):
+        try:
+            response = requests.get(SRA_EFETCH_URL, params=params, timeout=SRA_EFETCH_TIMEOUT, stream=True)
+            response.raise_for_status()
+            response.raw.decode_content = True
+            metadata = parse_sra_efetch(response.raw, accessions)
+            break
+        except requests.RequestException as e:
+            if attempt == SRA_EFETCH_RETRIES - 1:
+                raise Exception(f"Error fetching metadata for {', '.join(accessions)}: {e}") from e
+            logger.warning("Error fetching SRA metadata (%s), retrying", e)
+            time.sleep(2**attempt)
+
+    missing = set(accessions) - set(metadata)
+    if missing:
+        raise KeyError(f"No SRA metadata found for {', '.join(sorted(missing))}")
+    for accession, acc_metadata in metadata.items():
+        logger.debug("Read %d total reads from efetch for sequence %s", acc_metadata["spots"], accession)
+    return metadata
+
+
+def parse_sra_efetch(xml_file, accessions: List[str]) -> dict:
+    """
+    Read the spots, bases and library layout of the requested runs from an efetch XML response, parsing it
+    incrementally one experiment package at a time
+    """
+    metadata = {}
+    layout = None
+    for event, elem in ElementTree.iterparse(xml_file, events=("end",)):
+        if elem.tag == "LIBRARY_LAYOUT":
+            layout = elem[0].tag if len(elem) else None
+        elif elem.tag == "RUN" and elem.get("accession") in accessions:
+            metadata[elem.get("accession")] = {
+                "spots": int(elem.get("total_spots")),
+                "bases": int(elem.get("total_bases")),
+                "layout": layout,
+            }
+        elif elem.tag == "EXPERIMENT_PACKAGE":
+            layout = None
+            elem.clear()
+    return metadata
+
+
+def _get_sra_metadata_key(pipeline_params: PipelineParameters, accession: str) -> str:
+    return os.path.join(pipeline_params.sra_metadata_prefix, accession + ".json")
 
-    start_read = int(fastq_chunk["read_0"])
-    end_read = int(fastq_chunk["read_1"])
 
+def get_sra_storage_key(pipeline_params: PipelineParameters) -> str:
+    return os.path.join(pipeline_params.sra_prefix, pipeline_params.sra_accession + ".sra")
+
+
+def configure_vdb():
+    """
+    Configure sra-tools once per container
+    """
+    global _vdb_configured
+    if _vdb_configured:
+        return
     # To suppress a warning that appears the first time vdb-config is used
-    proc = subprocess.run(["vdb-config", "-i"], check=True, capture_output=True, text=True)
-    print(proc.stdout)
-    print(proc.stderr)
-    # Report cloud identity so it can take data from s3 needed to be executed only once per vm
-    proc = subprocess.run(
-        ["vdb-config", "--report-cloud-identity", "yes"],
-        check=True,
-        capture_output=True,
-        text=True,
-    )
-    print(proc.stdout)
-    print(proc.stderr)
-
-    # Run fastq-dump with the specified range of reads, splits files in two files if paired end
-    proc = subprocess.run(
-        [
-            "fastq-dump",
-            "--split-files",
-            seq_name,
-            "-X",
-            str(start_read),
-            "-N",
-            str(end_read),
-        ],
-        check=True,
-        capture_output=True,
-        text=True,
-    )
-    print(proc.stdout)
-    print(proc.stderr)
-
-    fastqdump_output_filename = f"{seq_name}_1.fastq"
-
-    os.rename(fastqdump_output_filename, target_filename)
-
-    # Save the output file to the desired target filename in object storage
-
-    print(f"Finished fetching chunk {fastq_chunk['chunk_id']} and saved to {target_filename}")
+    subprocess.run(["vdb-config", "-i"], check=True, capture_output=True, text=True)
+    # Report cloud identity so it can take data from s3
+    subprocess.run(["vdb-config", "--report-cloud-identity", "yes"], check=True, capture_output=True, text=True)
+    _vdb_configured = True
+
+
+def prefetch_sra(pipeline_params: PipelineParameters, storage: Storage) -> str:
+    """
+    Lithops callee function
+    Download the .sra file of the pipeline accession with prefetch and store it in the storage bucket.
+    Returns its storage key.
+    """
+    configure_vdb()
+    sra_key = get_sra_storage_key(pipeline_params)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        subprocess.run(
+            ["prefetch", "--max-size", "u", "--output-directory", tmp_dir, pipeline_params.sra_accession],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        sra_filename = os.path.join(tmp_dir, pipeline_params.sra_accession, pipeline_params.sra_accession + ".sra")
+        # Multipart upload of the (usually large) .sra file
+        get_pipeline_storage(storage, pipeline_params).upload_file(
+            sra_filename, pipeline_params.storage_bucket, sra_key
+        )
+        logger.debug("Stored %s (%d bytes) in %s", sra_filename, os.path.getsize(sra_filename), sra_key)
+    finally:
+        force_delete_local_path(tmp_dir)
+    return sra_key
+
+
+def fetch_fastq_chunk_sra(
+    pipeline_params: PipelineParameters, fastq_chunk: dict, target_filename: str, sra_filename: str
+):
+    """
+    Extract the reads of an SRA chunk from a local copy of the .sra file.
+    The read range is split between parallel fastq-dump processes, their outputs are concatenated in order into
+    the target file.
+    """
+    configure_vdb()
+
+    start_read = int(fastq_chunk["read_0"])
+    end_read = int(fastq_chunk["read_1"])
+    num_workers = min(pipeline_params.sra_dump_threads or multiprocessing.cpu_count(), end_read - start_read + 1)
+    step = math.ceil((end_read - start_read + 1) / num_workers)
+    sub_ranges = [(r0, min(r0 + step - 1, end_read)) for r0 in range(start_read, end_read + 1, step)]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Run fastq-dump with the specified range of reads, splits files in two files if paired end
+        procs = []
+        for i, (r0, r1) in enumerate(sub_ranges):
+            out_dir = os.path.join(tmp_dir, str(i))
+            cmd = ["fastq-dump", "--split-files", "-O", out_dir, "-N", str(r0), "-X", str(r1), sra_filename]
+            procs.append((subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE), out_dir))
+
+        with open(target_filename, "wb") as target_file:
+            for proc, out_dir in procs:
+                _, stderr = proc.communicate()
+                if proc.returncode != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=stderr)
+                with open(os.path.join(out_dir, f"{pipeline_params.sra_accession}_1.fastq"), "rb") as part_file:
+                    shutil.copyfileobj(part_file, target_file)
+    finally:
+        force_delete_local_path(tmp_dir)
+
+    logger.debug("Finished fetching chunk %d and saved to %s", fastq_chunk["chunk_id"], target_filename)
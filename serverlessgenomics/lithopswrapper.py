@@ -1,18 +1,42 @@
 from __future__ import annotations
 
 import logging
+import statistics
+import time
 from typing import TYPE_CHECKING
 
 import lithops
+from lithops.wait import ANY_COMPLETED
 
+from .stats import invocation_env
 
 logger = logging.getLogger(__name__)
 
+# Seconds between straggler checks while waiting for speculative map results
+SPECULATIVE_POLL_INTERVAL = 5
+
 
 class LithopsInvokerWrapper:
-    def __init__(self, lithops_config: dict):
+    def __init__(
+        self,
+        lithops_config: dict,
+        speculative_fraction: float = None,
+        speculative_multiplier: float = 3.0,
+        stage_profiles: dict = None,
+        resource_sampling_interval: float = None,
+    ):
         config = lithops_config or {}
         self.__fexec = lithops.FunctionExecutor(**config)
+        self.__speculative_fraction = speculative_fraction
+        self.__speculative_multiplier = speculative_multiplier
+        self.__stage_profiles = stage_profiles or {}
+        self.__resource_sampling_interval = resource_sampling_interval
+
+    def __profile(self, func) -> dict:
+        """
+        Resource profile of the stage run by func (keyed by function name), empty if there is none
+        """
+        return self.__stage_profiles.get(func.__name__, {})
 
     def call(
         self,
@@ -25,12 +49,13 @@ class LithopsInvokerWrapper:
         include_modules=[],
         exclude_modules=[],
     ):
+        profile = self.__profile(func)
         fut = self.__fexec.call_async(
             func,
             data,
-            extra_env,
-            runtime_memory,
-            timeout,
+            invocation_env(func.__name__, extra_env, self.__resource_sampling_interval),
+            runtime_memory or profile.get("runtime_memory"),
+            timeout or profile.get("timeout"),
             include_modules,
             exclude_modules,
         )
@@ -51,23 +76,111 @@ class LithopsInvokerWrapper:
         timeout=None,
         include_modules=[],
         exclude_modules=[],
+        speculative=False,
     ):
-        fut = self.__fexec.map(
-            map_function,
-            map_iterdata,
-            chunksize,
-            extra_args,
-            extra_env,
-            runtime_memory,
-            obj_chunk_size,
-            obj_chunk_number,
-            obj_newline,
-            timeout,
-            include_modules,
-            exclude_modules,
-        )
-        result = self.__fexec.get_result(fs=fut)
-        return result
+        profile = self.__profile(map_function)
+
+        def _map(iterdata):
+            return self.__fexec.map(
+                map_function,
+                iterdata,
+                chunksize,
+                extra_args,
+                invocation_env(map_function.__name__, extra_env, self.__resource_sampling_interval),
+                runtime_memory or profile.get("runtime_memory"),
+                obj_chunk_size,
+                obj_chunk_number,
+                obj_newline,
+                timeout or profile.get("timeout"),
+                include_modules,
+                exclude_modules,
+            )
+
+        map_iterdata = list(map_iterdata)
+        max_concurrency = profile.get("max_concurrency")
+        speculative = speculative and self.__speculative_fraction is not None and len(map_iterdata) > 1
+        if not speculative and (not max_concurrency or max_concurrency >= len(map_iterdata)):
+            fut = _map(map_iterdata)
+            return self.__fexec.get_result(fs=fut)
+        return self.__get_map_result(_map, map_iterdata, max_concurrency, speculative)
+
+    def __get_map_result(self, map_fn, map_iterdata, max_concurrency=None, speculative=False):
+        """
+        Wait for the results of a map, keeping at most max_concurrency tasks running: tasks are invoked as others
+        finish. If speculative, stragglers are relaunched: once speculative_fraction of the tasks are finished,
+        tasks running for longer than speculative_multiplier x the median task time are launched again, and the
+        first copy to finish wins. Functions must write deterministic outputs, so duplicate writes are safe.
+        """
+        n = len(map_iterdata)
+        max_concurrency = max_concurrency or n
+        futures = {}
+        tasks = {}
+        launched = {}
+        pending = set()
+        results = {}
+        errors = {}
+        durations = []
+        next_task = 0
+
+        def _launch(indexes):
+            now = time.time()
+            for i, f in zip(indexes, map_fn([map_iterdata[i] for i in indexes])):
+                futures.setdefault(i, []).append(f)
+                tasks[f] = i
+                pending.add(f)
+                launched.setdefault(i, now)
+
+        while len(results) < n:
+            # New tasks get the free slots first, then the copies of stragglers
+            if next_task < n and len(pending) < max_concurrency:
+                last_task = min(next_task + max_concurrency - len(pending), n)
+                _launch(list(range(next_task, last_task)))
+                next_task = last_task
+
+            if speculative and len(results) >= self.__speculative_fraction * n and durations:
+                threshold = self.__speculative_multiplier * statistics.median(durations)
+                now = time.time()
+                stragglers = [
+                    i
+                    for i, fs in futures.items()
+                    if i not in results and len(fs) == 1 and now - launched[i] > threshold
+                ][: max(max_concurrency - len(pending), 0)]
+                if stragglers:
+                    logger.info(
+                        "Relaunching %d straggler tasks (running for more than %.1f s)", len(stragglers), threshold
+                    )
+                    _launch(stragglers)
+
+            # Wake up periodically, stragglers must be detected even if no task finishes
+            done, _ = self.__fexec.wait(
+                fs=list(pending),
+                return_when=ANY_COMPLETED,
+                throw_except=False,
+                download_results=False,
+                timeout=SPECULATIVE_POLL_INTERVAL,
+                show_progressbar=False,
+            )
+
+            for f in done:
+                if f not in pending:
+                    continue
+                pending.discard(f)
+                i = tasks[f]
+                if i in results:
+                    continue
+                try:
+                    results[i] = f.result()
+                except Exception as e:
+                    errors.setdefault(i, e)
+                    if not any(other in pending for other in futures[i]):
+                        # All copies failed, raise the exception of the first one
+                        raise errors[i]
+                    continue
+                durations.append(time.time() - launched[i])
+                # The other copies of the task are not waited for
+                pending.difference_update(futures[i])
+
+        return [results[i] for i in range(n)]
 
     def map_reduce(
         self,
@@ -89,6 +202,7 @@ class LithopsInvokerWrapper:
         include_modules=[],
         exclude_modules=[],
     ):
+        map_profile = self.__profile(map_function)
         fut = self.__fexec.map_reduce(
             map_function,
             map_iterdata,
@@ -96,10 +210,10 @@ class LithopsInvokerWrapper:
             chunksize,
             extra_args,
             extra_args_reduce,
-            extra_env,
-            map_runtime_memory,
-            reduce_runtime_memory,
-            timeout,
+            invocation_env(map_function.__name__, extra_env, self.__resource_sampling_interval),
+            map_runtime_memory or map_profile.get("runtime_memory"),
+            reduce_runtime_memory or self.__profile(reduce_function).get("runtime_memory"),
+            timeout or map_profile.get("timeout"),
             obj_chunk_size,
             obj_chunk_number,
             obj_newline,
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import inspect
+import logging
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import TYPE_CHECKING
+
+from .stats import invocation_env
+
+if TYPE_CHECKING:
+    from .storage import LocalStorage
+
+logger = logging.getLogger(__name__)
+
+
+class LocalInvoker:
+    """
+    Drop-in replacement of LithopsInvokerWrapper that runs the pipeline functions in a pool of local processes.
+    Functions get a LocalStorage instance as their storage argument, so their inputs and outputs stay on the local
+    disk. Cloud-only options (memory, timeouts, speculative execution) are accepted and ignored.
+    """
+
+    def __init__(
+        self,
+        storage: LocalStorage,
+        workers: int = None,
+        stage_profiles: dict = None,
+        resource_sampling_interval: float = None,
+    ):
+        self.__storage = storage
+        self.__workers = workers or multiprocessing.cpu_count()
+        self.__stage_profiles = stage_profiles or {}
+        self.__resource_sampling_interval = resource_sampling_interval
+        self.__pool = None
+
+    def __get_pool(self) -> ProcessPoolExecutor:
+        if self.__pool is None:
+            logger.debug("Starting local process pool with %d workers", self.__workers)
+            self.__pool = ProcessPoolExecutor(max_workers=self.__workers)
+        return self.__pool
+
+    def call(self, func, data, /, extra_env=None, **kwargs):
+        return self.map(func, [data], extra_env=extra_env)[0]
+
+    def map(self, map_function, map_iterdata, extra_args=None, extra_env=None, **kwargs):
+        map_iterdata = list(map_iterdata)
+        # Run at most max_concurrency functions at a time, as in the cloud
+        max_concurrency = self.__stage_profiles.get(map_function.__name__, {}).get("max_concurrency")
+
+        def _submit(call_id):
+            args, kwargs = self.__function_args(map_function, map_iterdata[call_id], extra_args, call_id)
+            env = invocation_env(map_function.__name__, extra_env, self.__resource_sampling_interval)
+            return self.__get_pool().submit(_run_function, map_function, args, kwargs, env)
+
+        futures = []
+        running = set()
+        for call_id in range(len(map_iterdata)):
+            if max_concurrency and len(running) >= max_concurrency:
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+            futures.append(_submit(call_id))
+            running.add(futures[-1])
+        return [f.result() for f in futures]
+
+    def map_reduce(self, map_function, map_iterdata, reduce_function, extra_args=None, extra_env=None, **kwargs):
+        results = self.map(map_function, map_iterdata, extra_args=extra_args, extra_env=extra_env)
+        return self.call(reduce_function, {"results": results}, extra_env=extra_env)
+
+    def __function_args(self, func, data, extra_args: dict, call_id: int):
+        """
+        Positional and keyword arguments of a function call, following the Lithops conventions: dict data are keyword
+        arguments, tuples and lists are positional, extra_args are added as keyword arguments, and the storage and
+        id parameters are set if the function has them
+        """
+        if isinstance(data, dict):
+            args, kwargs = (), dict(data)
+        elif isinstance(data, (tuple, list)):
+            args, kwargs = tuple(data), {}
+        else:
+            args, kwargs = (data,), {}
+        kwargs.update(extra_args or {})
+
+        params = inspect.signature(func).parameters
+        if "storage" in params:
+            kwargs["storage"] = self.__storage
+        if "id" in params:
+            kwargs["id"] = call_id
+        return args, kwargs
+
+
+def _run_function(func, args: tuple, kwargs: dict, extra_env: dict = None):
+    # Worker processes run one function at a time, so the environment can be set for the duration of the call
+    saved_env = dict(os.environ)
+    os.environ.update({k: str(v) for k, v in (extra_env or {}).items()})
+    cwd = os.getcwd()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
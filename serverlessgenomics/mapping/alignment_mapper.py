@@ -1,19 +1,24 @@
+import io
 import logging
 import os
 import multiprocessing
 import pathlib
+import re
 import shutil
 import subprocess as sp
 import tempfile
 from functools import partial
-from typing import Tuple
+from typing import List, Tuple
+import numpy as np
 import pandas as pd
 from numpy import int64
 from pathlib import PurePosixPath
 from time import time
 
 from ..datasource import fetch_fasta_chunk, fetch_fastq_chunk
-from ..datasource.fetch import fetch_gem_chunk
+from ..datasource.fetch import fetch_gem_chunk, download_file_parallel, get_object_parallel
+from ..datasource.sources.bed import overlaps
+from .read_router import renumber_map_lines
 from ..utils import force_delete_local_path, get_storage_tmp_prefix
 from ..pipeline import PipelineParameters
 from ..stats import Stats
@@ -23,6 +28,28 @@ import zipfile
 
 logger = logging.getLogger(__name__)
 
+RE_CIGAR_INDEL = re.compile(r">(\d+)[+-]")
+
+
+def get_align_mapper_keys(pipeline_params: PipelineParameters, run_id: str, mapper_id: str) -> Tuple[str, str]:
+    """
+    Returns the storage keys of the outputs of an align mapper as tuple (map index key, filtered map key)
+    """
+    mapper_storage_tmp_prefix = partial(get_storage_tmp_prefix, run_id, "align_mapper", mapper_id)
+    return (
+        mapper_storage_tmp_prefix(pipeline_params.sra_accession + "_map.index.txt.bz2"),
+        mapper_storage_tmp_prefix(pipeline_params.sra_accession + "_filt_wline_no.map.bz2"),
+    )
+
+
+def get_index_correction_key(run_id: str, mapper_id: str) -> str:
+    return get_storage_tmp_prefix(run_id, "index_correction", mapper_id, "reads_bitmap.npz")
+
+
+def get_mpileup_key(pipeline_params: PipelineParameters, run_id: str, mapper_id: str) -> str:
+    mpileup_file = f"{pipeline_params.sra_accession}_{mapper_id}_filt_wline_no_corrected.map.mpileup"
+    return get_storage_tmp_prefix(run_id, "filtered_index_to_mpileup", mapper_id, mpileup_file)
+
 
 def align_mapper(
     pipeline_params: PipelineParameters,
@@ -38,16 +65,12 @@ def align_mapper(
     are uploaded into the cloud storage for subsequent index correction, after which
     the final part of the map function (map_alignment2) can be executed.
     """
-    print("starting align_mapper")
+    logger.debug("Starting align_mapper %s", mapper_id)
     stats = Stats()
     stats.set_value("mapper_id", mapper_id)
     stats.start_timer("function")
 
-    # tmp prefix generator for this mapper
-    mapper_storage_tmp_prefix = partial(get_storage_tmp_prefix, run_id, "align_mapper", mapper_id)
-
-    map_index_key = mapper_storage_tmp_prefix(pipeline_params.sra_accession + "_map.index.txt.bz2")
-    filtered_map_key = mapper_storage_tmp_prefix(pipeline_params.sra_accession + "_filt_wline_no.map.bz2")
+    map_index_key, filtered_map_key = get_align_mapper_keys(pipeline_params, run_id, mapper_id)
 
     # Check if output files already exist in storage
     try:
@@ -64,18 +87,26 @@ def align_mapper(
     tmp_dir = tempfile.mkdtemp()
     pwd = os.getcwd()
     os.chdir(tmp_dir)
-    print("Working directory: ", os.getcwd())
+    logger.debug("Working directory: %s", os.getcwd())
     try:
         # Get fastq chunk and store it to disk in tmp directory
         fastq_chunk_filename = f"chunk_{fastq_chunk['chunk_id']}.fastq"
         with stats.timeit("fetch_fastq_chunk"):
-            fetch_fastq_chunk(pipeline_params, fastq_chunk, fastq_chunk_filename, storage)
+            if "routed_reads_key" in fastq_chunk:
+                # Only the reads routed to this FASTA chunk
+                storage.download_file(
+                    bucket=pipeline_params.storage_bucket,
+                    key=fastq_chunk["routed_reads_key"],
+                    file_name=fastq_chunk_filename,
+                )
+            else:
+                fetch_fastq_chunk(pipeline_params, fastq_chunk, fastq_chunk_filename, storage)
         stats.set_value("fastq_chunk_size", os.path.getsize(fastq_chunk_filename))
 
         # Fetch gem file and store it to disk in tmp directory
         gem_index_filename = os.path.join(f"chunk_{fasta_chunk['chunk_id']}.gem")
         with stats.timeit("fetch_gem_chunk"):
-            fetch_gem_chunk(pipeline_params, fasta_chunk, gem_index_filename, storage)
+            fetch_gem_chunk(pipeline_params, fasta_chunk, gem_index_filename, storage, stats)
         stats.set_value("gem_chunk_size", os.path.getsize(gem_index_filename))
 
         # GENERATE ALIGNMENT AND ALIGNMENT INDEX (FASTQ TO MAP)
@@ -94,11 +125,11 @@ def align_mapper(
             "single-end",
             str(pipeline_params.gem_mapper_threads or multiprocessing.cpu_count()),
         ]
-        print(" ".join(cmd))
+        logger.debug(" ".join(cmd))
         with stats.timeit("map_index_and_filter"):
             out = sp.run(cmd, capture_output=True)
-        print(out.stdout.decode("utf-8"))
-        print(os.listdir())
+        logger.debug(out.stdout.decode("utf-8"))
+        logger.debug("Working directory files: %s", os.listdir())
 
         # Reorganize file names
         map_index_filename = os.path.join(tmp_dir, pipeline_params.sra_accession + "_map.index.txt")
@@ -108,6 +139,16 @@ def align_mapper(
             pipeline_params.sra_accession + "_" + str(mapper_id) + "_filt_wline_no.map",
         )
         shutil.move(pipeline_params.sra_accession + "_filt_wline_no.map", filtered_map_filename)
+
+        # Line numbers of a routed read subset must refer to the reads in the whole FASTQ chunk for index correction
+        if "routed_ordinals_key" in fastq_chunk:
+            with stats.timeit("renumber_map_lines"):
+                ordinals_body = storage.get_object(
+                    bucket=pipeline_params.storage_bucket, key=fastq_chunk["routed_ordinals_key"]
+                )
+                ordinals = np.load(io.BytesIO(ordinals_body))
+                renumber_map_lines(map_index_filename, ordinals)
+                renumber_map_lines(filtered_map_filename, ordinals)
         stats.set_value("map_index_size", os.path.getsize(map_index_filename))
         stats.set_value("filtered_map_size", os.path.getsize(filtered_map_filename))
 
@@ -146,7 +187,7 @@ def align_mapper(
         stats.stop_timer("function")
         return (mapper_id, map_index_key, filtered_map_key), stats
     finally:
-        print("Cleaning up")
+        logger.debug("Cleaning up %s", tmp_dir)
         os.chdir(pwd)
         shutil.rmtree(tmp_dir)
 
@@ -155,28 +196,23 @@ def index_correction(
     pipeline_params: PipelineParameters,
     run_id: str,
     mapper_id: str,
+    align_mapper_ids: Tuple[str],
     map_index_keys: Tuple[str],
     storage: Storage,
 ):
     """
     Lithops callee function
     Corrects the index after the first map iteration.
-    All the set files must have the prefix "map_index_files/".
-    Corrected indices will be stored with the prefix "corrected_index/".
+    Merges the map indexes of all FASTA chunks for a FASTQ chunk to find the best index of every read, and
+    publishes a compact reads bitmap: for every align mapper, a bitset over read line numbers marking the
+    reads worth keeping in that FASTA chunk (index below best index + tolerance), plus the best index per read.
     """
     stats = Stats()
     stats.set_value("mapper_id", mapper_id)
     stats.start_timer("function")
 
-    mapper_storage_tmp_prefix = partial(get_storage_tmp_prefix, run_id, "index_correction", mapper_id)
-
-    pwd = os.getcwd()
-
-    # TODO replace with a proper file name (maybe indicating fastq chunk id)
-    output_file = "merged_filtered_index.txt"
-    zipped_output_file = output_file + ".bz2"
-
-    corrected_index_key = mapper_storage_tmp_prefix(zipped_output_file)
+    output_file = "reads_bitmap.npz"
+    corrected_index_key = get_index_correction_key(run_id, mapper_id)
 
     # Check if output files already exist in storage
     try:
@@ -189,81 +225,117 @@ def index_correction(
         pass
 
     # Download all map files for this fastq chunk
-    input_temp_dir = tempfile.mkdtemp()
-    output_temp_dir = tempfile.mkdtemp()
+    temp_dir = tempfile.mkdtemp()
     try:
+        map_indexes = []
         for i, map_index_key in enumerate(map_index_keys):
             map_index_stat = Stats()
             map_index_stat.set_value("map_index_key", map_index_key)
 
-            local_compressed_map_path = os.path.join(input_temp_dir, f"map_{i}.map.bz2")
+            local_compressed_map_path = os.path.join(temp_dir, f"map_{i}.map.bz2")
 
-            with map_index_stat.timeit(f"download_map_index"):
-                storage.download_file(
-                    bucket=pipeline_params.storage_bucket, key=map_index_key, file_name=local_compressed_map_path
+            with map_index_stat.timeit("download_map_index"):
+                download_file_parallel(
+                    pipeline_params, storage, map_index_key, local_compressed_map_path, map_index_stat, "map_index"
                 )
             map_index_stat.set_value("map_index_size", os.path.getsize(local_compressed_map_path))
 
             with zipfile.ZipFile(local_compressed_map_path, "r", compression=zipfile.ZIP_BZIP2, compresslevel=9) as zf:
-                with map_index_stat.timeit(f"extract_map_index"):
-                    zf.extractall(input_temp_dir)
+                with map_index_stat.timeit("extract_map_index"):
+                    zf.extractall(temp_dir)
+            os.remove(local_compressed_map_path)
 
             # TODO set proper map index file name
-            os.rename(
-                os.path.join(input_temp_dir, f"{pipeline_params.sra_accession}_map.index.txt"),
-                os.path.join(input_temp_dir, f"{i}_map.index.txt"),
-            )
-            os.remove(local_compressed_map_path)
+            map_index_filename = os.path.join(temp_dir, f"{pipeline_params.sra_accession}_map.index.txt")
+            with map_index_stat.timeit("read_map_index"):
+                map_indexes.append(read_map_index(map_index_filename))
+            os.remove(map_index_filename)
 
             stats.set_value(map_index_key, map_index_stat.dump_dict())
-        print(os.listdir(input_temp_dir))
-
-        # TODO chdir required or binary_reducer.sh
-        os.chdir(output_temp_dir)
-
-        # Execute correction scripts
-        intermediate_file = f"{mapper_id}.intermediate.txt"
-        # TODO binary_reducer.sh could be more efficiently implemented using python and consuming files from storage as a generator
-        cmd = f"/function/bin/binary_reducer.sh /function/bin/merge_gem_alignment_metrics.sh 4 {input_temp_dir}/* > {intermediate_file}"
-        print(cmd)
-        with stats.timeit("merge_gem_alignment_metrics"):
-            proc = sp.run(cmd, shell=True, universal_newlines=True, capture_output=True)
-        print(proc.stdout)
-        print(proc.stderr)
-        proc.check_returncode()
-
-        # timestamps.store_size_data("filter_merged", time())
-        cmd = f"/function/bin/filter_merged_index.sh {intermediate_file} {output_file}"
-        print(cmd)
-        with stats.timeit("filter_merged_index"):
-            proc = sp.run(cmd, shell=True, check=True, universal_newlines=True)
-        print(proc.stdout)
-        print(proc.stderr)
-        proc.check_returncode()
-
-        print(os.listdir())
-
-        stats.set_value("output_file_size", os.path.getsize(output_file))
-
-        # Compress output
-        with zipfile.ZipFile(zipped_output_file, "w", compression=zipfile.ZIP_BZIP2, compresslevel=9) as zf:
-            with stats.timeit("compress_output"):
-                zf.write(output_file, arcname=output_file)
-        stats.set_value("zipped_output_file_size", os.path.getsize(zipped_output_file))
+
+        with stats.timeit("build_reads_bitmap"):
+            best_index, bitmaps = build_reads_bitmap(map_indexes, pipeline_params.tolerance)
+        stats.set_value("num_lines", len(best_index))
+        stats.set_value("kept_alignments", [int(bitmap.sum()) for bitmap in bitmaps])
+
+        output_path = os.path.join(temp_dir, output_file)
+        with stats.timeit("compress_output"):
+            np.savez_compressed(
+                output_path,
+                align_mapper_ids=np.array(align_mapper_ids),
+                best_index=best_index,
+                bitmaps=np.packbits(np.array(bitmaps, dtype=bool).reshape(len(bitmaps), -1), axis=1),
+            )
+        stats.set_value("output_file_size", os.path.getsize(output_path))
 
         # Upload corrected index to storage
         with stats.timeit("upload_corrected_index"):
-            storage.upload_file(
-                bucket=pipeline_params.storage_bucket, key=corrected_index_key, file_name=zipped_output_file
-            )
+            storage.upload_file(bucket=pipeline_params.storage_bucket, key=corrected_index_key, file_name=output_path)
 
-        os.chdir(pwd)
         stats.stop_timer("function")
         return (mapper_id, corrected_index_key), stats
     finally:
-        os.chdir(pwd)
-        force_delete_local_path(input_temp_dir)
-        force_delete_local_path(output_temp_dir)
+        force_delete_local_path(temp_dir)
+
+
+def read_map_index(map_index_filename: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read a map index file (line number, best index) as a tuple of arrays
+    """
+    if os.path.getsize(map_index_filename) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)
+    df = pd.read_csv(map_index_filename, sep="\t", header=None, names=["line", "index"], dtype=np.int64)
+    return df["line"].to_numpy(), df["index"].to_numpy().astype(np.uint8)
+
+
+def build_reads_bitmap(map_indexes: List[Tuple[np.ndarray, np.ndarray]], tolerance: int):
+    """
+    Compute the best (lowest) index of every read among all map indexes of a FASTQ chunk, and for each map index
+    a bitset over line numbers with the reads that are within best index + tolerance.
+    Returns (best index per line number, list of boolean bitsets), arrays are indexed by line number.
+    """
+    num_lines = max((int(lines.max()) for lines, _ in map_indexes if len(lines)), default=0) + 1
+
+    best_index = np.full(num_lines, np.iinfo(np.uint8).max, dtype=np.uint8)
+    for lines, indexes in map_indexes:
+        np.minimum.at(best_index, lines, indexes)
+
+    bitmaps = []
+    for lines, indexes in map_indexes:
+        bitmap = np.zeros(num_lines, dtype=bool)
+        bitmap[lines] = indexes.astype(np.int64) <= best_index[lines].astype(np.int64) + tolerance
+        bitmaps.append(bitmap)
+
+    return best_index, bitmaps
+
+
+def correct_map_file(filtered_map_filename: str, corrected_map_filename: str, best_index, bitmap, tolerance: int):
+    """
+    Write the corrected map file from a filtered map file (line number, index, map record), skipping records that
+    are not set in the reads bitmap, and trimming the alignments below the best index + tolerance strata
+    """
+    kept_reads = filtered_reads = 0
+    with open(filtered_map_filename, "r") as filtered_file, open(corrected_map_filename, "w") as corrected_file:
+        for line in filtered_file:
+            line_number, _, record = line.split("\t", 2)
+            line_number = int(line_number)
+            if line_number >= len(bitmap) or not bitmap[line_number]:
+                continue
+            name, seq, qual, summary, alignments = record.rstrip("\n").split("\t")[:5]
+
+            # Number of alignments in strata up to threshold
+            threshold = int(best_index[line_number]) + tolerance
+            strata = summary.split("+")[0].split(":")
+            ok_aln = sum(int(stratum) for stratum in strata[:threshold])
+            aligns = alignments.split(",")
+            if len(aligns) > ok_aln:
+                alignments = ",".join(aligns[:ok_aln])
+                filtered_reads += 1
+
+            corrected_file.write(f"{name}\t{seq}\t{qual}\t{summary}\t{alignments}\n")
+            kept_reads += 1
+
+    return kept_reads, filtered_reads
 
 
 def filtered_index_to_mpileup(
@@ -280,12 +352,11 @@ def filtered_index_to_mpileup(
     stats.start_timer("function")
 
     temp_dir = tempfile.mkdtemp()
-    mapper_storage_tmp_prefix = partial(get_storage_tmp_prefix, run_id, "filtered_index_to_mpileup", mapper_id)
     pwd = os.getcwd()
     # TODO get base name from params
     corrected_map_file = f"{pipeline_params.sra_accession}_{mapper_id}_filt_wline_no_corrected.map"
     mpileup_file = corrected_map_file + ".mpileup"
-    mpileup_key = mapper_storage_tmp_prefix(mpileup_file)
+    mpileup_key = get_mpileup_key(pipeline_params, run_id, mapper_id)
 
     # Check if output file already exists in storage
     try:
@@ -309,8 +380,8 @@ def filtered_index_to_mpileup(
         # Recover filtered map file
         bz2_filt_map_filename = pathlib.PurePosixPath(filtered_map_key).name
         with stats.timeit("download_filtered_map"):
-            storage.download_file(
-                bucket=pipeline_params.storage_bucket, key=filtered_map_key, file_name=bz2_filt_map_filename
+            download_file_parallel(
+                pipeline_params, storage, filtered_map_key, bz2_filt_map_filename, stats, "filtered_map"
             )
         stats.set_value("bz2_filt_map_size", os.path.getsize(bz2_filt_map_filename))
 
@@ -319,43 +390,33 @@ def filtered_index_to_mpileup(
                 zf.extractall()
         os.remove(bz2_filt_map_filename)
 
-        # Get corrected map index for this fastq chunk
-        try:
-            bz2_corrected_index_filename = pathlib.PurePosixPath(corrected_index_key).name
-        except:
-            raise ValueError(corrected_index_key)
-
+        # Get reads bitmap for this fastq chunk
         with stats.timeit("download_corrected_index"):
-            storage.download_file(
-                bucket=pipeline_params.storage_bucket, key=corrected_index_key, file_name=bz2_corrected_index_filename
+            corrected_index = np.load(
+                io.BytesIO(get_object_parallel(pipeline_params, storage, corrected_index_key, stats, "corrected_index"))
             )
-        stats.set_value("bz2_corrected_index_size", os.path.getsize(bz2_corrected_index_filename))
-        with zipfile.ZipFile(bz2_corrected_index_filename, "r", compression=zipfile.ZIP_BZIP2, compresslevel=9) as zf:
-            with stats.timeit("extract_corrected_index"):
-                zf.extractall()
-        os.remove(bz2_corrected_index_filename)
-
-        print(os.listdir(temp_dir))
+            row = list(corrected_index["align_mapper_ids"]).index(mapper_id)
+            best_index = corrected_index["best_index"]
+            bitmap = np.unpackbits(corrected_index["bitmaps"][row], count=len(best_index)).astype(bool)
 
-        # Filter aligments with corrected map file
-        # timestamps.store_size_data("map_file_index_correction", time())
+        # Filter aligments with reads bitmap and corrected index
         filt_map_filename = f"{pipeline_params.sra_accession}_{mapper_id}_filt_wline_no.map"
-        # TODO replace with a proper file name (maybe indicating fastq chunk id)
-        corrected_index_filename = "merged_filtered_index.txt"
-
-        cmd = [
-            "/function/bin/map_file_index_correction.sh",
-            corrected_index_filename,
-            filt_map_filename,
-            str(pipeline_params.tolerance),
-        ]
-        print(" ".join(cmd))
         with stats.timeit("map_file_index_correction"):
-            proc = sp.run(cmd, capture_output=True)  # change to _v3.sh and runtime 20
-        print(proc.stdout.decode("utf-8"))
-        print(proc.stderr.decode("utf-8"))
+            kept_reads, filtered_reads = correct_map_file(
+                filt_map_filename, corrected_map_file, best_index, bitmap, pipeline_params.tolerance
+            )
+        os.remove(filt_map_filename)
+        stats.set_value("kept_reads", kept_reads)
+        stats.set_value("filtered_reads", filtered_reads)
 
-        print(os.listdir(temp_dir))
+        logger.debug("Working directory files: %s", os.listdir(temp_dir))
+
+        # Drop alignments outside target regions before generating mpileup
+        if "targets" in fasta_chunk:
+            with stats.timeit("filter_map_by_targets"):
+                kept_reads, dropped_alignments = filter_map_by_targets(corrected_map_file, fasta_chunk["targets"])
+            stats.set_value("target_kept_reads", kept_reads)
+            stats.set_value("target_dropped_alignments", dropped_alignments)
 
         # Generate mpileup
         # timestamps.store_size_data("gempileup_run", time())
@@ -364,11 +425,11 @@ def filtered_index_to_mpileup(
             corrected_map_file,
             fasta_chunk_filename,
         ]
-        print(" ".join(cmd))
+        logger.debug(" ".join(cmd))
         with stats.timeit("gempileup_run"):
             proc = sp.run(cmd, capture_output=True)
-        print(proc.stdout.decode("utf-8"))
-        print(proc.stderr.decode("utf-8"))
+        logger.debug(proc.stdout.decode("utf-8"))
+        logger.debug(proc.stderr.decode("utf-8"))
 
         # Store output to storage
         stats.set_value("mpileup_size", os.path.getsize(mpileup_file))
@@ -382,6 +443,41 @@ def filtered_index_to_mpileup(
         force_delete_local_path(temp_dir)
 
 
+def filter_map_by_targets(map_filename: str, targets: dict) -> Tuple[int, int]:
+    """
+    Rewrite a MAP file keeping only the alignments that overlap target intervals.
+    Reads left with no alignments are removed. Returns (kept reads, dropped alignments).
+    """
+    kept_reads = dropped_alignments = 0
+    filtered_filename = map_filename + ".targets"
+
+    with open(map_filename, "r") as map_file, open(filtered_filename, "w") as filtered_file:
+        for line in map_file:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5 or fields[4] == "-":
+                continue
+            read_len = len(fields[1])
+
+            kept = []
+            for alignment in fields[4].split(","):
+                chr_name, _, pos, cigar = alignment.split(":")[:4]
+                intervals = targets.get(chr_name)
+                # Reference span is bounded by read length plus indel lengths
+                span = read_len + sum(int(n) for n in RE_CIGAR_INDEL.findall(cigar))
+                if intervals is not None and overlaps(intervals, int(pos), int(pos) + span):
+                    kept.append(alignment)
+                else:
+                    dropped_alignments += 1
+
+            if kept:
+                fields[4] = ",".join(kept)
+                filtered_file.write("\t".join(fields) + "\n")
+                kept_reads += 1
+
+    os.replace(filtered_filename, map_filename)
+    return kept_reads, dropped_alignments
+
+
 def mpileup_conversion(
     self,
     mpileup_file: str,
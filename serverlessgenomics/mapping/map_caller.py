@@ -4,12 +4,21 @@ import collections
 import logging
 from typing import TYPE_CHECKING
 
-from .alignment_mapper import align_mapper, index_correction, filtered_index_to_mpileup
+from .alignment_mapper import (
+    align_mapper,
+    filtered_index_to_mpileup,
+    get_align_mapper_keys,
+    get_index_correction_key,
+    get_mpileup_key,
+    index_correction,
+)
+from .read_router import read_router
 from ..pipeline import PipelineParameters, Lithops, PipelineRun
 from ..stats import Stats
+from ..utils import get_storage_tmp_prefix
 
 if TYPE_CHECKING:
-    from typing import Tuple
+    from typing import List, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -34,37 +43,76 @@ def unformat_index_correction_mapper_id(index_correction_mapper_id: str) -> int:
     return int(index_correction_mapper_id.replace("fq", ""))
 
 
-def generate_align_mapping_iterdata(pipeline_params: PipelineParameters, pipeline_run: PipelineRun):
+def generate_read_router_iterdata(pipeline_params: PipelineParameters, pipeline_run: PipelineRun):
     iterdata = [
         {
             "pipeline_params": pipeline_params,
             "run_id": pipeline_run.run_id,
-            "mapper_id": format_align_mapper_id(fa_ch["chunk_id"], fq_ch["chunk_id"]),
-            "fasta_chunk": fa_ch,
+            "mapper_id": format_index_correction_mapper_id(fq_ch["chunk_id"]),
             "fastq_chunk": fq_ch,
+            "fasta_chunks": pipeline_run.fasta_chunks,
         }
         for fq_ch in pipeline_run.fastq_chunks
-        for fa_ch in pipeline_run.fasta_chunks
     ]
 
     return iterdata
 
 
+def generate_align_mapping_iterdata(pipeline_params: PipelineParameters, pipeline_run: PipelineRun):
+    if pipeline_run.routed_reads is None:
+        iterdata = [
+            {
+                "pipeline_params": pipeline_params,
+                "run_id": pipeline_run.run_id,
+                "mapper_id": format_align_mapper_id(fa_ch["chunk_id"], fq_ch["chunk_id"]),
+                "fasta_chunk": fa_ch,
+                "fastq_chunk": fq_ch,
+            }
+            for fq_ch in pipeline_run.fastq_chunks
+            for fa_ch in pipeline_run.fasta_chunks
+        ]
+        return iterdata
+
+    # Only (fasta, fastq) pairs with routed reads
+    iterdata = []
+    for fq_ch in pipeline_run.fastq_chunks:
+        routes = pipeline_run.routed_reads[format_index_correction_mapper_id(fq_ch["chunk_id"])]
+        for fa_ch in pipeline_run.fasta_chunks:
+            if fa_ch["chunk_id"] not in routes:
+                continue
+            routed_reads_key, routed_ordinals_key = routes[fa_ch["chunk_id"]]
+            params = {
+                "pipeline_params": pipeline_params,
+                "run_id": pipeline_run.run_id,
+                "mapper_id": format_align_mapper_id(fa_ch["chunk_id"], fq_ch["chunk_id"]),
+                "fasta_chunk": fa_ch,
+                "fastq_chunk": {
+                    **fq_ch,
+                    "routed_reads_key": routed_reads_key,
+                    "routed_ordinals_key": routed_ordinals_key,
+                },
+            }
+            iterdata.append(params)
+
+    return iterdata
+
+
 def generate_index_correction_iterdata(pipeline_params, pipeline_run):
     # Group gem mapper output by fastq chunk id
     grouped_fastq_mappers = collections.defaultdict(list)
     for mapper_id, (map_key, _) in pipeline_run.alignment_maps.items():
         _, fastq_chunk_id = unformat_align_mapper_id(mapper_id)
-        format_index_correction_mapper_id(fastq_chunk_id)
-        grouped_fastq_mappers[fastq_chunk_id].append(map_key)
+        grouped_fastq_mappers[fastq_chunk_id].append((mapper_id, map_key))
 
     iterdata = []
 
-    for fq_id, map_keys in grouped_fastq_mappers.items():
+    for fq_id, mappers in grouped_fastq_mappers.items():
+        align_mapper_ids, map_keys = zip(*mappers)
         params = {
             "pipeline_params": pipeline_params,
             "run_id": pipeline_run.run_id,
             "mapper_id": format_index_correction_mapper_id(fq_id),
+            "align_mapper_ids": align_mapper_ids,
             "map_index_keys": map_keys,
         }
         iterdata.append(params)
@@ -79,6 +127,9 @@ def generate_index_to_mpileup_iterdata(pipeline_params, pipeline_run):
         corrected_index_key = pipeline_run.corrected_indexes[format_index_correction_mapper_id(fq_ch["chunk_id"])]
         for fa_ch in pipeline_run.fasta_chunks:
             mapper_id = format_align_mapper_id(fa_ch["chunk_id"], fq_ch["chunk_id"])
+            if mapper_id not in pipeline_run.alignment_maps:
+                # No reads routed to this FASTA chunk
+                continue
             _, filtered_map_key = pipeline_run.alignment_maps[mapper_id]
             params = {
                 "pipeline_params": pipeline_params,
@@ -97,39 +148,135 @@ def run_full_alignment(pipeline_params: PipelineParameters, pipeline_run: Pipeli
     """
     Execute the map phase
     """
-    stats = Stats()
+    (stats,) = run_batch_alignment([(pipeline_params, pipeline_run)], lithops)
+    return stats
+
+
+def run_batch_alignment(runs: List[Tuple[PipelineParameters, PipelineRun]], lithops: Lithops) -> List[Stats]:
+    """
+    Execute the map phase for many pipeline runs at once, packing the invocations of every run into shared map calls.
+    Returns a Stats instance for each run.
+    """
+    runs_stats = [Stats() for _ in runs]
+
+    # MAP: Read routing
+    routed_runs = [i for i, (params, _) in enumerate(runs) if params.read_routing]
+    if routed_runs:
+        logger.debug("PROCESSING READ ROUTING")
+        iterdata = [generate_read_router_iterdata(*runs[i]) for i in routed_runs]
+        results = _batch_map(lithops, read_router, iterdata, [runs_stats[i] for i in routed_runs], "read_router")
+        for i, run_results in zip(routed_runs, results):
+            read_router_result, read_router_stats = zip(*run_results)
+            runs[i][1].routed_reads = {mapper_id: routes for mapper_id, routes in read_router_result}
+            runs_stats[i].set_value("read_router_stats", [s.dump_dict() for s in read_router_stats])
 
     # MAP: Stage 1
     logger.debug("PROCESSING MAP: STAGE 1")
-    iterdata = generate_align_mapping_iterdata(pipeline_params, pipeline_run)
-    with stats.timeit("align_mapper"):
-        results = lithops.invoker.map(align_mapper, iterdata)
-    align_mapper_result, align_mapper_stats = zip(*results)
-    pipeline_run.alignment_maps = {
-        mapper_id: (map_index_key, filtered_map_key)
-        for mapper_id, map_index_key, filtered_map_key in align_mapper_result
-    }
-    stats.set_value("align_mapper_stats", [s.dump_dict() for s in align_mapper_stats])
+    iterdata = [generate_align_mapping_iterdata(params, run) for params, run in runs]
+    completed = _completed_outputs(
+        runs,
+        lithops,
+        "align_mapper",
+        lambda d: get_align_mapper_keys(d["pipeline_params"], d["run_id"], d["mapper_id"]),
+    )
+    results = _batch_map(lithops, align_mapper, iterdata, runs_stats, "align_mapper", completed, speculative=True)
+    for (_, pipeline_run), stats, run_results in zip(runs, runs_stats, results):
+        align_mapper_result, align_mapper_stats = zip(*run_results)
+        pipeline_run.alignment_maps = {
+            mapper_id: (map_index_key, filtered_map_key)
+            for mapper_id, map_index_key, filtered_map_key in align_mapper_result
+        }
+        stats.set_value("align_mapper_stats", [s.dump_dict() for s in align_mapper_stats])
 
     # MAP: Index correction
     logger.debug("PROCESSING INDEX CORRECTION")
-
-    iterdata = generate_index_correction_iterdata(pipeline_params, pipeline_run)
-    with stats.timeit("index_correction"):
-        result = lithops.invoker.map(index_correction, iterdata)
-    index_correction_result, index_correction_stats = zip(*result)
-    pipeline_run.corrected_indexes = {
-        mapper_id: corrected_index_key for mapper_id, corrected_index_key in index_correction_result
-    }
-    stats.set_value("index_correction_stats", [s.dump_dict() for s in index_correction_stats])
+    iterdata = [generate_index_correction_iterdata(params, run) for params, run in runs]
+    completed = _completed_outputs(
+        runs, lithops, "index_correction", lambda d: (get_index_correction_key(d["run_id"], d["mapper_id"]),)
+    )
+    results = _batch_map(lithops, index_correction, iterdata, runs_stats, "index_correction", completed)
+    for (_, pipeline_run), stats, run_results in zip(runs, runs_stats, results):
+        index_correction_result, index_correction_stats = zip(*run_results)
+        pipeline_run.corrected_indexes = {
+            mapper_id: corrected_index_key for mapper_id, corrected_index_key in index_correction_result
+        }
+        stats.set_value("index_correction_stats", [s.dump_dict() for s in index_correction_stats])
 
     # Map: Stage 2
     logger.debug("PROCESSING MAP: STAGE 2")
-    iterdata = generate_index_to_mpileup_iterdata(pipeline_params, pipeline_run)
-    with stats.timeit("filtered_index_to_mpileup"):
-        results = lithops.invoker.map(filtered_index_to_mpileup, iterdata)
-    index_to_mpileup_result, index_to_mpileup_stats = zip(*results)
-    pipeline_run.aligned_mpileups = {mapper_id: mpileup_key for mapper_id, mpileup_key in index_to_mpileup_result}
-    stats.set_value("filtered_index_to_mpileup_stats", [s.dump_dict() for s in index_to_mpileup_stats])
+    iterdata = [generate_index_to_mpileup_iterdata(params, run) for params, run in runs]
+    completed = _completed_outputs(
+        runs,
+        lithops,
+        "filtered_index_to_mpileup",
+        lambda d: (get_mpileup_key(d["pipeline_params"], d["run_id"], d["mapper_id"]),),
+    )
+    results = _batch_map(
+        lithops, filtered_index_to_mpileup, iterdata, runs_stats, "filtered_index_to_mpileup", completed
+    )
+    for (_, pipeline_run), stats, run_results in zip(runs, runs_stats, results):
+        index_to_mpileup_result, index_to_mpileup_stats = zip(*run_results)
+        pipeline_run.aligned_mpileups = {mapper_id: mpileup_key for mapper_id, mpileup_key in index_to_mpileup_result}
+        stats.set_value("filtered_index_to_mpileup_stats", [s.dump_dict() for s in index_to_mpileup_stats])
 
-    return stats
+    return runs_stats
+
+
+def _completed_outputs(runs: List[Tuple[PipelineParameters, PipelineRun]], lithops: Lithops, stage: str, output_keys):
+    """
+    Build the completion manifest of a stage with one prefix LIST per run. Returns a function that gives the result
+    of an iterdata entry if all of its output keys (computed by output_keys) are already in storage, or None.
+    """
+    completed_keys = set()
+    for pipeline_params, pipeline_run in runs:
+        prefix = get_storage_tmp_prefix(pipeline_run.run_id, stage)
+        completed_keys.update(lithops.storage.list_keys(bucket=pipeline_params.storage_bucket, prefix=prefix))
+
+    def _completed_result(data):
+        keys = output_keys(data)
+        if not all(key in completed_keys for key in keys):
+            return None
+        stats = Stats()
+        stats.set_value("mapper_id", data["mapper_id"])
+        stats.set_value("cached", True)
+        return (data["mapper_id"], *keys), stats
+
+    return _completed_result
+
+
+def _batch_map(
+    lithops: Lithops,
+    map_function,
+    runs_iterdata: List[list],
+    runs_stats: List[Stats],
+    key: str,
+    completed_result=None,
+    speculative: bool = False,
+):
+    """
+    Invoke map_function once over the concatenated iterdata of all runs, and split the results back by run.
+    Entries for which completed_result returns a result are not invoked.
+    """
+    iterdata = [data for run_iterdata in runs_iterdata for data in run_iterdata]
+    results = [completed_result(data) if completed_result is not None else None for data in iterdata]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if len(pending) < len(iterdata):
+        logger.info(
+            "Skipping %d of %d %s invocations already completed", len(iterdata) - len(pending), len(iterdata), key
+        )
+
+    for stats in runs_stats:
+        stats.start_timer(key)
+    if pending:
+        pending_results = lithops.invoker.map(map_function, [iterdata[i] for i in pending], speculative=speculative)
+        for i, result in zip(pending, pending_results):
+            results[i] = result
+    for stats in runs_stats:
+        stats.stop_timer(key)
+
+    runs_results = []
+    offset = 0
+    for run_iterdata in runs_iterdata:
+        runs_results.append(results[offset : offset + len(run_iterdata)])
+        offset += len(run_iterdata)
+    return runs_results
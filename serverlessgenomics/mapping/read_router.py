@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import io
+import logging
+import os
+import tempfile
+from functools import partial
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from ..datasource import fetch_fastq_chunk
+from ..datasource.sources.gem import get_sketch_chunk_storage_key
+from ..minimizers import route_reads
+from ..stats import Stats
+from ..utils import force_delete_local_path, get_storage_tmp_prefix, try_head_object
+
+if TYPE_CHECKING:
+    from typing import List
+    from lithops import Storage
+    from ..pipeline import PipelineParameters
+
+logger = logging.getLogger(__name__)
+
+# Number of reads routed at once, bounds the memory used by read k-mer hashes
+ROUTING_BATCH_READS = 100_000
+
+
+def read_router(
+    pipeline_params: PipelineParameters,
+    run_id: str,
+    mapper_id: str,
+    fastq_chunk: dict,
+    fasta_chunks: List[dict],
+    storage: Storage,
+):
+    """
+    Lithops callee function
+    Split a FASTQ chunk into read subsets for each FASTA chunk, according to the minimizer sketches of the FASTA
+    chunks. Routing is lossy, which is why it is opt-in (read_routing parameter): a read is only sent to the chunks
+    whose sketch has one of its k-mers, so an alignment to a chunk without an exact k-mer hit (e.g. a read with
+    mismatches in every k-mer of that locus) is lost if another chunk has a hit. Reads that do not hit any sketch
+    are sent to all FASTA chunks.
+    For each subset, stores the FASTQ reads and the original read ordinals (1-based) in the FASTQ chunk.
+    Returns a dict of fasta chunk id -> (subset fastq key, ordinals key), only for non-empty subsets.
+    """
+    stats = Stats()
+    stats.set_value("mapper_id", mapper_id)
+    stats.start_timer("function")
+
+    router_storage_tmp_prefix = partial(get_storage_tmp_prefix, run_id, "read_router", mapper_id)
+    manifest_key = router_storage_tmp_prefix("routes.npy")
+
+    def _subset_keys(fasta_chunk_id):
+        return (
+            router_storage_tmp_prefix(f"fa{str(fasta_chunk_id).zfill(4)}.fastq"),
+            router_storage_tmp_prefix(f"fa{str(fasta_chunk_id).zfill(4)}.ordinals.npy"),
+        )
+
+    # Check if output files already exist in storage
+    if try_head_object(storage, pipeline_params.storage_bucket, manifest_key) is not None:
+        routed_ids = np.load(io.BytesIO(storage.get_object(pipeline_params.storage_bucket, manifest_key)))
+        stats.stop_timer("function")
+        return (mapper_id, {int(fa_id): _subset_keys(fa_id) for fa_id in routed_ids}), stats
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fastq_chunk_filename = os.path.join(tmp_dir, f"chunk_{fastq_chunk['chunk_id']}.fastq")
+        with stats.timeit("fetch_fastq_chunk"):
+            fetch_fastq_chunk(pipeline_params, fastq_chunk, fastq_chunk_filename, storage)
+        stats.set_value("fastq_chunk_size", os.path.getsize(fastq_chunk_filename))
+
+        with stats.timeit("fetch_sketches"):
+            sketches = []
+            for fa_ch in fasta_chunks:
+                sketch_key = get_sketch_chunk_storage_key(pipeline_params, fa_ch["chunk_hash"])
+                sketches.append(np.load(io.BytesIO(storage.get_object(pipeline_params.storage_bucket, sketch_key))))
+
+        with open(fastq_chunk_filename, "rb") as fastq_file:
+            lines = fastq_file.read().splitlines(keepends=True)
+        num_reads = len(lines) // 4
+        stats.set_value("num_reads", num_reads)
+
+        with stats.timeit("route_reads"):
+            routes = np.zeros((len(fasta_chunks), num_reads), dtype=bool)
+            for r0 in range(0, num_reads, ROUTING_BATCH_READS):
+                r1 = min(r0 + ROUTING_BATCH_READS, num_reads)
+                sequences = [line.rstrip() for line in lines[r0 * 4 + 1 : r1 * 4 : 4]]
+                routes[:, r0:r1] = route_reads(sequences, sketches)
+            unrouted = ~routes.any(axis=0)
+            routes |= unrouted
+        stats.set_value("unrouted_reads", int(unrouted.sum()))
+
+        routed = {}
+        with stats.timeit("upload_subsets"):
+            for fa_ch, fa_routes in zip(fasta_chunks, routes):
+                read_ids = np.flatnonzero(fa_routes)
+                if len(read_ids) == 0:
+                    continue
+                subset_key, ordinals_key = _subset_keys(fa_ch["chunk_id"])
+                subset = b"".join(line for i in read_ids for line in lines[i * 4 : i * 4 + 4])
+                storage.put_object(bucket=pipeline_params.storage_bucket, key=subset_key, body=subset)
+
+                buff = io.BytesIO()
+                np.save(buff, (read_ids + 1).astype(np.uint32))
+                storage.put_object(bucket=pipeline_params.storage_bucket, key=ordinals_key, body=buff.getvalue())
+                routed[fa_ch["chunk_id"]] = (subset_key, ordinals_key)
+        stats.set_value("routed_pairs", len(routed))
+        stats.set_value("routed_reads", int(routes.sum()))
+
+        # Manifest is written last, it marks this chunk as completely routed
+        buff = io.BytesIO()
+        np.save(buff, np.array(list(routed), dtype=np.int64))
+        storage.put_object(bucket=pipeline_params.storage_bucket, key=manifest_key, body=buff.getvalue())
+
+        stats.stop_timer("function")
+        return (mapper_id, routed), stats
+    finally:
+        force_delete_local_path(tmp_dir)
+
+
+def renumber_map_lines(map_filename: str, ordinals: np.ndarray):
+    """
+    Replace the line number (first column) of a map index or filtered map file, which refers to the read order in
+    a routed subset, with the original read ordinal in the FASTQ chunk
+    """
+    renumbered_filename = map_filename + ".renumbered"
+    with open(map_filename, "r") as map_file, open(renumbered_filename, "w") as renumbered_file:
+        for line in map_file:
+            line_number, rest = line.split("\t", 1)
+            renumbered_file.write(f"{ordinals[int(line_number) - 1]}\t{rest}")
+    os.replace(renumbered_filename, map_filename)
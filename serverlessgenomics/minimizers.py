@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+if TYPE_CHECKING:
+    from typing import List
+
+logger = logging.getLogger(__name__)
+
+# k-mer length and number of consecutive k-mers per minimizer window
+KMER_SIZE = 21
+WINDOW_SIZE = 25
+# Bases processed at once when sketching long sequences (bounds memory usage)
+BLOCK_SIZE = 8 * 1024 * 1024
+
+INVALID_HASH = np.uint32(0xFFFFFFFF)
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+# Lookup table from ASCII byte to 2-bit base code, any other symbol (N, IUPAC...) is 4
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, (_upper, _lower) in enumerate(zip(b"ACGT", b"acgt")):
+    _BASE_CODES[_upper] = _BASE_CODES[_lower] = _i
+
+
+def encode_bases(seq: bytes) -> np.ndarray:
+    """
+    Encode a DNA sequence as an array of 2-bit base codes (4 for unknown bases)
+    """
+    return _BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+
+
+def kmer_hashes(codes: np.ndarray, k: int = KMER_SIZE) -> np.ndarray:
+    """
+    Returns the 32-bit hash of the canonical k-mer starting at each position of an encoded sequence.
+    K-mers that contain unknown bases get INVALID_HASH.
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint32)
+
+    fwd = np.zeros(n, dtype=np.uint64)
+    rev = np.zeros(n, dtype=np.uint64)
+    invalid = np.zeros(n, dtype=bool)
+    for j in range(k):
+        c = codes[j : j + n]
+        invalid |= c > 3
+        c = (c & 3).astype(np.uint64)
+        fwd |= c << np.uint64(2 * (k - 1 - j))
+        rev |= (np.uint64(3) - c) << np.uint64(2 * j)
+
+    canonical = np.minimum(fwd, rev)
+    hashes = ((canonical * _HASH_MULTIPLIER) >> np.uint64(32)).astype(np.uint32)
+    hashes[hashes == INVALID_HASH] -= np.uint32(1)
+    hashes[invalid] = INVALID_HASH
+    return hashes
+
+
+def minimizers(seq: bytes, k: int = KMER_SIZE, w: int = WINDOW_SIZE) -> np.ndarray:
+    """
+    Returns the sorted, unique (k, w)-minimizer hashes of a sequence
+    """
+    sketches = []
+    step = BLOCK_SIZE
+    overlap = k + w - 2
+    for i in range(0, max(len(seq) - overlap, 1), step):
+        hashes = kmer_hashes(encode_bases(seq[i : i + step + overlap]), k)
+        if len(hashes) >= w:
+            sketches.append(np.unique(sliding_window_view(hashes, w).min(axis=1)))
+        elif len(hashes) > 0:
+            sketches.append(hashes.min(keepdims=True))
+
+    sketch = np.unique(np.concatenate(sketches)) if sketches else np.empty(0, dtype=np.uint32)
+    return sketch[sketch != INVALID_HASH]
+
+
+def sketch_fasta(fasta_filename: str, k: int = KMER_SIZE, w: int = WINDOW_SIZE) -> np.ndarray:
+    """
+    Build the minimizer sketch of all sequences in a FASTA file
+    """
+    sketches = []
+    lines = []
+    with open(fasta_filename, "rb") as fasta_file:
+        for line in fasta_file:
+            if line.startswith(b">"):
+                if lines:
+                    sketches.append(minimizers(b"".join(lines), k, w))
+                lines = []
+            else:
+                lines.append(line.rstrip())
+    if lines:
+        sketches.append(minimizers(b"".join(lines), k, w))
+
+    return np.unique(np.concatenate(sketches)) if sketches else np.empty(0, dtype=np.uint32)
+
+
+def route_reads(sequences: List[bytes], sketches: List[np.ndarray], k: int = KMER_SIZE) -> np.ndarray:
+    """
+    Returns a boolean matrix (sketches x reads) that is True if any k-mer of a read is found in a sketch
+    """
+    # Concatenate reads separated by an unknown base so that no k-mer spans two reads
+    codes = encode_bases(b"N".join(sequences))
+    hashes = kmer_hashes(codes, k)
+
+    # Read ordinal of each k-mer start position
+    lengths = np.fromiter((len(s) + 1 for s in sequences), dtype=np.int64, count=len(sequences))
+    read_ids = np.repeat(np.arange(len(sequences)), lengths)[: len(hashes)]
+
+    valid = hashes != INVALID_HASH
+    hashes, read_ids = hashes[valid], read_ids[valid]
+
+    routes = np.zeros((len(sketches), len(sequences)), dtype=bool)
+    for i, sketch in enumerate(sketches):
+        if len(sketch) == 0:
+            continue
+        pos = np.searchsorted(sketch, hashes)
+        hits = sketch[np.minimum(pos, len(sketch) - 1)] == hashes
+        routes[i, read_ids[hits]] = True
+    return routes
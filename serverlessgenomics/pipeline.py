@@ -2,12 +2,15 @@ from __future__ import annotations
 
 import logging
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 import lithops
 import uuid
 
 from .lithopswrapper import LithopsInvokerWrapper
+from .localinvoker import LocalInvoker
+from .profiles import validate_stage_profiles
+from .storage import LocalStorage, ObjectStorage, S3Storage
 from .utils import (
     S3Path,
     guess_sra_accession_from_fastq_path,
@@ -28,6 +31,8 @@ class PipelineParameters:
     fasta_path: S3Path
     # Number of chunks to split FASTA input file into
     fasta_chunks: Optional[int] = None
+    # Storage path for a BED file with target regions, None will process the whole reference
+    regions: Optional[S3Path] = None
     # ---------------------------------------------
 
     # ---- FASTQ parameters (sequence read) ----
@@ -37,16 +42,30 @@ class PipelineParameters:
     sra_accession: Optional[str] = None
     # Number of chunks to split fastq input file into
     fastq_chunks: Optional[int] = None
+    # Parallel fastq-dump processes to extract each SRA chunk, None will use as many as multiprocessing.cpu_count
+    sra_dump_threads: Optional[int] = None
+    # Local directory for cached SRA metadata, or with metadata fixtures for offline runs (see
+    # sra.get_sra_metadata_batch). None will use a directory in the system temporary directory
+    sra_metadata_dir: Optional[str] = None
     # ---------------------------------------------
 
     # ---- Alignment mapper parameters ----
     # Parallel threads for gem3-mapper, None will use as many as multiprocessing.cpu_count
     gem_mapper_threads: Optional[int] = None
+    # Split each FASTQ chunk by the FASTA chunks its reads can map to (using minimizer sketches), instead of
+    # aligning every FASTQ chunk against every FASTA chunk. Lossy: reads are not aligned to chunks without an exact
+    # k-mer hit if other chunks have one
+    read_routing: bool = False
     # -------------------------------------
 
     # Variant Calling parameters
     # TODO what is tolerance? (ask Lucio)
     tolerance: int = 0
+    # Parallel merge and SiNPle processes in each reducer (over contiguous sub-ranges of its positions), None will
+    # use as many as multiprocessing.cpu_count
+    reduce_processes: Optional[int] = None
+    # Reducer outputs are uploaded while they are generated, in multipart upload parts of this size (bytes)
+    reduce_part_size: int = 64 * 1024 * 1024
 
     # Debug parameters
     # fastq chunks to be processed
@@ -60,8 +79,42 @@ class PipelineParameters:
     # Skip Reduce Stage
     skip_reduce: bool = False
 
+    # Object downloads in functions are split in ranged GETs of this size (bytes), run concurrently
+    download_part_size: int = 64 * 1024 * 1024
+    download_concurrency: int = 16
+
+    # Storage client settings: connection pool size, TCP keep-alive and retry policy (botocore retry mode)
+    storage_max_pool_connections: int = 64
+    storage_tcp_keepalive: bool = True
+    storage_max_attempts: int = 10
+    storage_retry_mode: str = "adaptive"
+    # Push row selection down to the storage service (S3 Select), disable it for S3 compatible services that do not
+    # support it (e.g. MinIO), rows are then filtered by the functions
+    storage_select_pushdown: bool = True
+
     # Lithops settings
     lithops_settings: dict = None
+    # Speculative execution of stragglers in alignment and reduce maps: once this fraction of the tasks of a map are
+    # finished, tasks running for longer than speculative_multiplier x the median task time are launched again and
+    # the first copy to finish is used. None disables speculative execution
+    speculative_fraction: Optional[float] = None
+    speculative_multiplier: float = 3.0
+    # Resource profiles per stage, as a dict of function name (e.g. "gem_indexer", "align_mapper", "reduce_function")
+    # -> dict of runtime_memory (MiB), timeout (s), ephemeral_storage (MiB) and max_concurrency. Stages without
+    # profile use the executor defaults. See profiles.suggest_stage_profiles to size them from a previous run
+    stage_profiles: Optional[Dict[str, dict]] = None
+    # Measure the resources used by the functions (CPU time, peak memory, /tmp usage, disk and network bytes) for
+    # each stats timer, sampling memory and /tmp usage every this number of seconds. None disables it. Usage is
+    # aggregated per stage in the "resources" value of the pipeline stats
+    resource_sampling_interval: Optional[float] = None
+
+    # Execution engine: "lithops" runs the pipeline functions in the cloud, "local" runs them in a pool of processes
+    # on this machine and keeps the intermediate data in local_storage_root instead of the storage bucket
+    engine: str = "lithops"
+    # Number of local worker processes, defaults to the number of CPUs
+    local_workers: Optional[int] = None
+    # Root directory of the local object storage, with a subdirectory per bucket
+    local_storage_root: str = "~/.serverless-genomics/storage"
 
     # Bucket name with write permissions to store preprocessed, intermediate and output data
     storage_bucket: str = "serverless-genomics"
@@ -69,6 +122,10 @@ class PipelineParameters:
     fastqgz_idx_prefix: str = "fastqgz-indexes/"
     # Prefix for storing cached faidx indexes
     faidx_prefix: str = "faidx-indexes/"
+    # Prefix for storing cached SRA metadata
+    sra_metadata_prefix: str = "sra-metadata/"
+    # Prefix for storing .sra files prefetched from SRA
+    sra_prefix: str = "sra-files/"
     # Prefix for storing cached reference genome indexes
     gem_index_prefix: str = "gem-indexes/"
     # Prefix for output data results
@@ -92,9 +149,10 @@ class PipelineRun:
     # Preprocessing
     fastq_chunks = None
     fasta_chunks = None
-    gem_chunk_ids = None
+    gem_keys = None
 
     # Alignment mapping
+    routed_reads = None
     alignment_maps = None
     corrected_indexes = None
     aligned_mpileups = None
@@ -106,10 +164,34 @@ class Lithops:
     Dataclass to encapsulate Lithops function executor and storage clients from a single session
     """
 
-    storage: lithops.Storage
+    storage: ObjectStorage
     invoker: LithopsInvokerWrapper
 
 
+def new_lithops(pipeline_params: PipelineParameters) -> Lithops:
+    """
+    Create the function executor and storage clients of the execution engine selected in the parameters
+    """
+    if pipeline_params.engine == "local":
+        storage = LocalStorage(pipeline_params.local_storage_root)
+        invoker = LocalInvoker(
+            storage,
+            pipeline_params.local_workers,
+            pipeline_params.stage_profiles,
+            pipeline_params.resource_sampling_interval,
+        )
+        return Lithops(storage=storage, invoker=invoker)
+
+    invoker = LithopsInvokerWrapper(
+        pipeline_params.lithops_settings,
+        pipeline_params.speculative_fraction,
+        pipeline_params.speculative_multiplier,
+        pipeline_params.stage_profiles,
+        pipeline_params.resource_sampling_interval,
+    )
+    return Lithops(storage=S3Storage(lithops.Storage(), pipeline_params), invoker=invoker)
+
+
 def validate_parameters(params: dict) -> PipelineParameters:
     """
     Validate and populate missing input parameters. Returns a correct PipelineParameters
@@ -122,6 +204,11 @@ def validate_parameters(params: dict) -> PipelineParameters:
         raise KeyError("fasta_chunks")
 
     params["fasta_path"] = S3Path.from_uri(params["fasta_path"])
+    validate_stage_profiles(params.get("stage_profiles"))
+    if params.get("engine", "lithops") not in ("lithops", "local"):
+        raise ValueError(f"Unknown execution engine {params['engine']}, use 'lithops' or 'local'")
+    if params.get("regions") is not None:
+        params["regions"] = S3Path.from_uri(params["regions"])
 
     if "fastq_path" in params:
         # Get fastq sequence read from S3
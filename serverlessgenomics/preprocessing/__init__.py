@@ -1,3 +1,6 @@
 from .fasta import prepare_fasta_chunks
 from .fastq import prepare_fastq_chunks
 from .gem import prepare_gem_chunks
+from .sketch import prepare_sketch_chunks
+
+__all__ = ["prepare_fasta_chunks", "prepare_fastq_chunks", "prepare_gem_chunks", "prepare_sketch_chunks"]
@@ -3,7 +3,13 @@ from __future__ import annotations
 import logging
 from typing import TYPE_CHECKING
 
-from ..datasource.sources.fasta import generate_faidx_from_s3, get_fasta_byte_ranges
+from ..datasource.sources.bed import load_regions
+from ..datasource.sources.fasta import (
+    generate_faidx_from_s3,
+    get_fasta_byte_ranges,
+    get_fasta_chunk_targets,
+    load_faidx,
+)
 
 if TYPE_CHECKING:
     from ..pipeline import PipelineParameters, Lithops
@@ -28,6 +34,32 @@ def prepare_fasta_chunks(pipeline_params: PipelineParameters, lithops: Lithops):
         )
         fasta_chunks = fasta_chunks[r0:r1]
 
+    if pipeline_params.regions is not None:
+        fasta_chunks = filter_fasta_chunks_by_regions(pipeline_params, lithops, fasta_chunks)
+
     logger.info("Generated %d chunks for %s", len(fasta_chunks), pipeline_params.fasta_path.as_uri())
 
     return fasta_chunks
+
+
+def filter_fasta_chunks_by_regions(pipeline_params: PipelineParameters, lithops: Lithops, fasta_chunks: list[dict]):
+    """
+    Discard FASTA chunks that do not overlap any target region, and annotate the remaining chunks
+    with their target intervals (chunk-local coordinates) under the "targets" key
+    """
+    regions = load_regions(pipeline_params, lithops.storage)
+    faidx = load_faidx(pipeline_params, lithops.storage)
+
+    target_chunks = []
+    for fa_ch in fasta_chunks:
+        targets = get_fasta_chunk_targets(fa_ch, faidx, regions)
+        if targets:
+            target_chunks.append({**fa_ch, "targets": targets})
+
+    logger.info(
+        "Using %d of %d FASTA chunks overlapping target regions %s",
+        len(target_chunks),
+        len(fasta_chunks),
+        pipeline_params.regions.as_uri(),
+    )
+    return target_chunks
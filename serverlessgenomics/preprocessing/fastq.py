@@ -5,8 +5,9 @@ from math import ceil
 from typing import TYPE_CHECKING, Set
 
 from ..datasource.sources.fastqgz import check_fastqgz_index, get_ranges_from_line_pairs
-from ..datasource.sources.sra import get_sra_metadata
+from ..datasource.sources.sra import get_sra_metadata, get_sra_storage_key, prefetch_sra
 from ..datasource.datasources import FASTQSource
+from ..utils import try_head_object
 
 if TYPE_CHECKING:
     from ..pipeline import PipelineParameters, Lithops
@@ -58,7 +59,8 @@ def prepare_fastq_chunks(pipeline_params: PipelineParameters, lithops: Lithops):
         logger.info("Generated %d chunks for %s", len(fastq_chunks), pipeline_params.fastq_path)
     elif pipeline_params.sra_accession is not None:
         # fastq-dump works by number of reads, number of lines = number of reads * 4
-        num_reads = get_sra_metadata(pipeline_params)
+        num_reads = get_sra_metadata(pipeline_params, lithops.storage)["spots"]
+        prepare_sra_file(pipeline_params, lithops)
         reads_batch = ceil(num_reads / pipeline_params.fastq_chunks)
         read_pairs = [
             (reads_batch * i + (1 if i == 0 else 0), (reads_batch * i) + reads_batch)
@@ -92,3 +94,15 @@ def prepare_fastq_chunks(pipeline_params: PipelineParameters, lithops: Lithops):
         fastq_chunks = fastq_chunks[r0:r1]
 
     return fastq_chunks
+
+
+def prepare_sra_file(pipeline_params: PipelineParameters, lithops: Lithops):
+    """
+    Prefetch the .sra file of the SRA accession into the storage bucket, if it is not already there
+    """
+    sra_key = get_sra_storage_key(pipeline_params)
+    if try_head_object(lithops.storage, pipeline_params.storage_bucket, sra_key) is not None:
+        logger.info("Using cached SRA file %s for %s", sra_key, pipeline_params.sra_accession)
+        return
+    logger.info("Prefetching %s into storage (%s)", pipeline_params.sra_accession, sra_key)
+    lithops.invoker.call(prefetch_sra, (pipeline_params,))
@@ -1,78 +1,150 @@
 from __future__ import annotations
 
+import json
 import logging
 import multiprocessing
 import os
-import re
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from time import time
-from typing import TYPE_CHECKING, Set
-from lithops.storage.utils import StorageNoSuchKeyError
+from typing import TYPE_CHECKING
 
 from ..datasource import fetch_fasta_chunk
 from ..datasource.sources.gem import (
     get_gem_chunk_storage_key,
-    get_gem_chunk_storage_prefix,
+    get_gem_manifest_key,
+    hash_fasta_chunk_file,
+    hash_file,
 )
-from ..utils import force_delete_local_path
+from ..storage import get_pipeline_storage
+from ..utils import force_delete_local_path, try_get_object, try_head_object
 from ..stats import Stats
 
 if TYPE_CHECKING:
-    from typing import List
+    from typing import Dict, List, Optional, Tuple
     from ..pipeline import PipelineParameters, Lithops
     from lithops import Storage
 
 logger = logging.getLogger(__name__)
 
+# Object metadata key with the SHA-256 checksum of a GEM file
+GEM_CHECKSUM_METADATA = "sha256"
+# Concurrent HEAD requests to verify cached GEM files
+GEM_VERIFY_CONCURRENCY = 32
 
-def prepare_gem_chunks(pipeline_params: PipelineParameters, fasta_chunks: list[dict], lithops: Lithops) -> Set[int]:
+
+def prepare_gem_chunks(
+    pipeline_params: PipelineParameters, fasta_chunks: list[dict], lithops: Lithops
+) -> Tuple[Dict[int, str], List[Stats]]:
     """
-    Generate GEM indexed file metadata
+    Generate GEM indexed file metadata, indexing only the chunks without a verified GEM file in storage.
+    Returns a dict of FASTA chunk id -> GEM file key, and the stats of the indexing functions.
+    The GEM file key and content hash of each FASTA chunk are also set in its "gem_key" and "chunk_hash" fields.
     """
-    # Check if all GEM files exist for the input FASTA file and specified number of chunks
-    gems_prefix = get_gem_chunk_storage_prefix(pipeline_params)
+    manifest_key = get_gem_manifest_key(pipeline_params)
+    fasta_path = pipeline_params.fasta_path
+    fasta_etag = lithops.storage.head_object(fasta_path.bucket, fasta_path.key).get("etag")
+    manifest = load_gem_manifest(pipeline_params, lithops.storage, fasta_etag)
+    manifest, missing_fasta_chunks = reconcile_gem_chunks(pipeline_params, fasta_chunks, manifest, lithops.storage)
+
+    stats = []
+    if not missing_fasta_chunks:
+        # All requested chunks are already in storage
+        logger.info('Using %d cached GEM files in storage (manifest="%s")', len(fasta_chunks), manifest_key)
+    else:
+        logger.info(
+            "Going to index %d GEM chunks (%d cached)",
+            len(missing_fasta_chunks),
+            len(fasta_chunks) - len(missing_fasta_chunks),
+        )
+        iterdata = generate_gem_indexer_iterdata(pipeline_params, missing_fasta_chunks)
+        results = lithops.invoker.map(gem_indexer, iterdata)
+        entries, stats = zip(*results)
+        for entry in entries:
+            manifest[entry["chunk_id"]] = entry
+        put_gem_manifest(pipeline_params, lithops.storage, manifest, fasta_etag)
 
-    # Find cached gem files for this FASTA file and chunk size
-    cached_gems_keys = lithops.storage.list_keys(bucket=pipeline_params.storage_bucket, prefix=gems_prefix)
-    cached_gem_chunk_ids = []
+    gem_keys = {}
+    for fa_ch in fasta_chunks:
+        fa_ch["gem_key"] = gem_keys[fa_ch["chunk_id"]] = manifest[fa_ch["chunk_id"]]["key"]
+        fa_ch["chunk_hash"] = manifest[fa_ch["chunk_id"]]["hash"]
+    return gem_keys, list(stats)
 
-    for cached_gems_key in cached_gems_keys:
-        basename = os.path.basename(cached_gems_key)
-        matches = re.findall(r"\d+", basename)
-        assert len(matches) == 1
-        chunk_id = int(matches.pop())
-        cached_gem_chunk_ids.append(chunk_id)
 
-    cached_gem_chunk_ids = set(cached_gem_chunk_ids)
-    requested_gems_ids = {fq_ch["chunk_id"] for fq_ch in fasta_chunks}
+def reconcile_gem_chunks(
+    pipeline_params: PipelineParameters, fasta_chunks: List[dict], manifest: Dict[int, dict], storage: Storage
+) -> Tuple[Dict[int, dict], List[dict]]:
+    """
+    Compare the GEM manifest with the requested FASTA chunks and the GEM files in storage.
+    A chunk is missing if it has no manifest entry, its entry is for another byte range, or its GEM file does not
+    exist or does not have the size and checksum recorded at index time.
+    Returns the manifest without the entries of missing chunks, and the FASTA chunks to index.
+    """
+    candidates = [fa_ch for fa_ch in fasta_chunks if _manifest_entry_matches(manifest.get(fa_ch["chunk_id"]), fa_ch)]
 
-    # Compare cached gem file set and requested gem file set
-    if requested_gems_ids.issubset(cached_gem_chunk_ids):
-        # All requested chunks are already in storage
-        logger.info('Using %d cached GEM files in storage (prefix="%s")', len(requested_gems_ids), gems_prefix)
-        return cached_gem_chunk_ids, {}
-
-    # Generate missing gem files
-    if not cached_gem_chunk_ids:
-        # All chunks are missing
-        iterdata = generate_gem_indexer_iterdata(pipeline_params, fasta_chunks)
-        logger.debug("All GEM chunks are missing (%d in total)", len(requested_gems_ids))
-    else:
-        # Only some chunks are missing
-        missing_chunks_ids = requested_gems_ids - cached_gem_chunk_ids
-        logger.debug("Some GEM chunks are missing (%s)", missing_chunks_ids.__repr__())
-        missing_fasta_chunks = []
-        for fa_ch in fasta_chunks:
-            if fa_ch["chunk_id"] not in missing_chunks_ids:
-                missing_fasta_chunks.append(fa_ch)
-        iterdata = generate_gem_indexer_iterdata(pipeline_params, missing_fasta_chunks)
+    def _verify(fa_ch):
+        entry = manifest[fa_ch["chunk_id"]]
+        head = try_head_object(storage, pipeline_params.storage_bucket, entry["key"])
+        return head is not None and _gem_object_matches(head, entry)
+
+    with ThreadPoolExecutor(max_workers=max(min(GEM_VERIFY_CONCURRENCY, len(candidates)), 1)) as pool:
+        verified = {fa_ch["chunk_id"] for fa_ch, ok in zip(candidates, pool.map(_verify, candidates)) if ok}
 
-    logger.info("Going to index %d GEM chunks", len(iterdata))
-    results = lithops.invoker.map(gem_indexer, iterdata)
-    gem_keys, stats = zip(*results)
+    stale = [fa_ch["chunk_id"] for fa_ch in candidates if fa_ch["chunk_id"] not in verified]
+    if stale:
+        logger.warning("GEM files of chunks %s do not match the manifest, they will be indexed again", stale)
+    missing_fasta_chunks = [fa_ch for fa_ch in fasta_chunks if fa_ch["chunk_id"] not in verified]
+    missing_ids = {fa_ch["chunk_id"] for fa_ch in missing_fasta_chunks}
+    manifest = {chunk_id: entry for chunk_id, entry in manifest.items() if chunk_id not in missing_ids}
+    logger.debug("GEM chunks to index: %s", [fa_ch["chunk_id"] for fa_ch in missing_fasta_chunks])
+    return manifest, missing_fasta_chunks
 
-    return gem_keys, stats
+
+def load_gem_manifest(pipeline_params: PipelineParameters, storage: Storage, fasta_etag: str) -> Dict[int, dict]:
+    """
+    Read the GEM manifest of the pipeline reference and number of chunks, as a dict of chunk id -> entry.
+    Entries have the chunk byte range (offset_base, last_byte), its content hash, and the GEM file key, size and
+    SHA-256 checksum. Manifests written for a different version of the reference (ETag) are discarded.
+    """
+    body = try_get_object(storage, pipeline_params.storage_bucket, get_gem_manifest_key(pipeline_params))
+    if body is None:
+        return {}
+    manifest = json.loads(body)
+    if manifest.get("fasta_etag") != fasta_etag:
+        logger.info("GEM manifest is for another version of %s, discarding it", pipeline_params.fasta_path.as_uri())
+        return {}
+    return {int(chunk_id): entry for chunk_id, entry in manifest["chunks"].items()}
+
+
+def put_gem_manifest(pipeline_params: PipelineParameters, storage: Storage, manifest: Dict[int, dict], fasta_etag: str):
+    body = {
+        "fasta_path": pipeline_params.fasta_path.as_uri(),
+        "fasta_etag": fasta_etag,
+        "fasta_chunks": pipeline_params.fasta_chunks,
+        "chunks": {str(chunk_id): entry for chunk_id, entry in sorted(manifest.items())},
+    }
+    storage.put_object(
+        bucket=pipeline_params.storage_bucket,
+        key=get_gem_manifest_key(pipeline_params),
+        body=json.dumps(body).encode("utf-8"),
+    )
+
+
+def _manifest_entry_matches(entry: Optional[dict], fasta_chunk: dict) -> bool:
+    # An entry is only valid for the same chunk byte range (the chunk planning may change between versions)
+    return (
+        entry is not None
+        and entry["offset_base"] == fasta_chunk["offset_base"]
+        and entry["last_byte"] == fasta_chunk["last_byte"]
+    )
+
+
+def _gem_object_matches(head: dict, entry: dict) -> bool:
+    # Size and checksum of a stored GEM file (head_object response) match those recorded at index time
+    return int(head["content-length"]) == entry.get("size") and head.get(
+        f"x-amz-meta-{GEM_CHECKSUM_METADATA}"
+    ) == entry.get("sha256")
 
 
 def generate_gem_indexer_iterdata(pipeline_params: PipelineParameters, fasta_chunks: List[dict]) -> List[dict]:
@@ -90,19 +162,16 @@ def generate_gem_indexer_iterdata(pipeline_params: PipelineParameters, fasta_chu
 
 
 def gem_indexer(pipeline_params: PipelineParameters, fasta_chunk_id: int, fasta_chunk: dict, storage: Storage):
+    """
+    Lithops callee function
+    Index a FASTA chunk with gem-indexer and upload the GEM file to its content addressed key, unless a GEM file for
+    identical chunk content is already stored. Returns the GEM manifest entry of the chunk.
+    """
     stats = Stats()
     stats.set_value("fasta_chunk_id", fasta_chunk_id)
 
     # Initialize names
     gem_index_filename = os.path.join(f"chunk{str(fasta_chunk_id).zfill(4)}.gem")
-    gem_index_key = get_gem_chunk_storage_key(pipeline_params, fasta_chunk_id)
-
-    # Check if gem file already exists
-    try:
-        storage.head_object(bucket=pipeline_params.storage_bucket, key=gem_index_key)
-        return gem_index_key, stats
-    except StorageNoSuchKeyError:
-        pass
 
     # Make temp dir and ch into it, save cwd to restore it later
     tmp_dir = tempfile.mkdtemp()
@@ -116,6 +185,25 @@ def gem_indexer(pipeline_params: PipelineParameters, fasta_chunk_id: int, fasta_
             fetch_fasta_chunk(fasta_chunk, fasta_chunk_filename, storage, pipeline_params.fasta_path)
         stats.set_value("fasta_chunk_size", os.path.getsize(fasta_chunk_filename))
 
+        with stats.timeit("hash_fasta_chunk"):
+            chunk_hash = hash_fasta_chunk_file(fasta_chunk_filename)
+        gem_index_key = get_gem_chunk_storage_key(pipeline_params, chunk_hash)
+        entry = {
+            "chunk_id": fasta_chunk_id,
+            "offset_base": fasta_chunk["offset_base"],
+            "last_byte": fasta_chunk["last_byte"],
+            "hash": chunk_hash,
+            "key": gem_index_key,
+        }
+
+        # Check if a gem file for the same content already exists (e.g. indexed by an interrupted run)
+        head = try_head_object(storage, pipeline_params.storage_bucket, gem_index_key)
+        if head is not None and f"x-amz-meta-{GEM_CHECKSUM_METADATA}" in head:
+            entry["size"] = int(head["content-length"])
+            entry["sha256"] = head[f"x-amz-meta-{GEM_CHECKSUM_METADATA}"]
+            stats.set_value("cached", True)
+            return entry, stats
+
         # gem-indexer already appends .gem to output file, so we delete it from the process call arguments
         cmd = [
             "gem-indexer",
@@ -134,13 +222,19 @@ def gem_indexer(pipeline_params: PipelineParameters, fasta_chunk_id: int, fasta_
         # TODO apparently 1 is return code for success (why)
         assert out.returncode == 1
 
-        # Upload the gem file to storage
-        gem_index_key = get_gem_chunk_storage_key(pipeline_params, fasta_chunk_id)
+        # Upload the gem file to storage, with its checksum to verify it when it is reused
+        entry["size"] = os.path.getsize(gem_index_filename)
+        entry["sha256"] = hash_file(gem_index_filename)
         with stats.timeit("upload_gem_index"):
-            storage.upload_file(file_name=gem_index_filename, bucket=pipeline_params.storage_bucket, key=gem_index_key)
-        stats.set_value("gem_index_size", os.path.getsize(gem_index_filename))
-
-        return gem_index_key, stats
+            get_pipeline_storage(storage, pipeline_params).upload_file(
+                gem_index_filename,
+                pipeline_params.storage_bucket,
+                gem_index_key,
+                metadata={GEM_CHECKSUM_METADATA: entry["sha256"]},
+            )
+        stats.set_value("gem_index_size", entry["size"])
+
+        return entry, stats
     finally:
         os.chdir(cwd)
         force_delete_local_path(tmp_dir)
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import io
+import logging
+import os
+import tempfile
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from ..datasource import fetch_fasta_chunk
+from ..datasource.sources.gem import get_sketch_chunk_storage_key
+from ..minimizers import sketch_fasta
+from ..stats import Stats
+from ..utils import force_delete_local_path, try_head_object
+
+if TYPE_CHECKING:
+    from typing import List
+    from ..pipeline import PipelineParameters, Lithops
+    from lithops import Storage
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_sketch_chunks(pipeline_params: PipelineParameters, fasta_chunks: List[dict], lithops: Lithops):
+    """
+    Generate minimizer sketches for FASTA chunks, used to route reads to the chunks they can map to.
+    Sketches are stored next to the GEM files and keyed by the content hash of the FASTA chunk ("chunk_hash" field),
+    so they must be prepared after the GEM chunks.
+    """
+    objects_prefix = os.path.join(pipeline_params.gem_index_prefix, "objects")
+    cached_keys = set(lithops.storage.list_keys(bucket=pipeline_params.storage_bucket, prefix=objects_prefix))
+
+    missing_fasta_chunks = [
+        fa_ch
+        for fa_ch in fasta_chunks
+        if get_sketch_chunk_storage_key(pipeline_params, fa_ch["chunk_hash"]) not in cached_keys
+    ]
+    if not missing_fasta_chunks:
+        logger.info('Using %d cached sketch files in storage (prefix="%s")', len(fasta_chunks), objects_prefix)
+        return []
+
+    logger.info("Going to sketch %d FASTA chunks", len(missing_fasta_chunks))
+    iterdata = [{"pipeline_params": pipeline_params, "fasta_chunk": fa_ch} for fa_ch in missing_fasta_chunks]
+    results = lithops.invoker.map(sketch_builder, iterdata)
+    _, stats = zip(*results)
+    return stats
+
+
+def sketch_builder(pipeline_params: PipelineParameters, fasta_chunk: dict, storage: Storage):
+    """
+    Lithops callee function
+    Build the minimizer sketch of a FASTA chunk and upload it to storage
+    """
+    stats = Stats()
+    stats.set_value("fasta_chunk_id", fasta_chunk["chunk_id"])
+    sketch_key = get_sketch_chunk_storage_key(pipeline_params, fasta_chunk["chunk_hash"])
+
+    # Check if sketch file already exists
+    if try_head_object(storage, pipeline_params.storage_bucket, sketch_key) is not None:
+        return sketch_key, stats
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fasta_chunk_filename = os.path.join(tmp_dir, f"chunk_{str(fasta_chunk['chunk_id']).zfill(4)}.fasta")
+        with stats.timeit("fetch_fasta_chunk"):
+            fetch_fasta_chunk(fasta_chunk, fasta_chunk_filename, storage, pipeline_params.fasta_path)
+        stats.set_value("fasta_chunk_size", os.path.getsize(fasta_chunk_filename))
+
+        with stats.timeit("sketch_fasta"):
+            sketch = sketch_fasta(fasta_chunk_filename)
+        stats.set_value("sketch_minimizers", len(sketch))
+
+        buff = io.BytesIO()
+        np.save(buff, sketch)
+        stats.set_value("sketch_size", buff.tell())
+        with stats.timeit("upload_sketch"):
+            storage.put_object(bucket=pipeline_params.storage_bucket, key=sketch_key, body=buff.getvalue())
+
+        return sketch_key, stats
+    finally:
+        force_delete_local_path(tmp_dir)
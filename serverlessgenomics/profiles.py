@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import logging
+import math
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Settings of a stage profile:
+#  - runtime_memory: function memory in MiB
+#  - timeout: function timeout in seconds
+#  - ephemeral_storage: /tmp size in MiB, a hint for the runtime deployment (it can not be set per invocation)
+#  - max_concurrency: maximum number of functions of the stage running at once
+STAGE_PROFILE_KEYS = ("runtime_memory", "timeout", "ephemeral_storage", "max_concurrency")
+
+# Stage stats keys that do not follow the "<function name>_stats" convention
+_STATS_KEY_FUNCTIONS = {"gem_stats": "gem_indexer", "sketch_stats": "sketch_builder"}
+
+# Memory available to a function apart from the data it handles (runtime, libraries, binaries)
+BASE_RUNTIME_MEMORY = 512
+# Memory sizes are rounded up to multiples of this value (MiB)
+MEMORY_STEP = 256
+
+
+def validate_stage_profiles(stage_profiles: Optional[dict]):
+    """
+    Check that stage profiles are a dict of function name -> dict of known profile settings
+    """
+    if stage_profiles is None:
+        return
+    for function_name, profile in stage_profiles.items():
+        unknown = set(profile) - set(STAGE_PROFILE_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown settings {sorted(unknown)} in stage profile {function_name}")
+
+
+def suggest_stage_profiles(
+    stats: dict, memory_factor: float = 3.0, timeout_factor: float = 2.0
+) -> Dict[str, Dict[str, int]]:
+    """
+    Suggest stage profiles from the stats (as returned by Stats.dump_dict) of a previous pipeline run.
+    For each stage, memory is sized from the largest input or output observed in its functions (values ending in
+    "_size", times memory_factor), ephemeral storage from the sum of those sizes, and timeout from the slowest
+    function (times timeout_factor).
+    """
+    stages = {}
+    collect_stage_stats(stats, stages)
+
+    profiles = {}
+    for function_name, workers in stages.items():
+        elapsed = [w["timers"]["function"]["elapsed"] for w in workers if "elapsed" in w["timers"].get("function", {})]
+        sizes = [_data_sizes(w) for w in workers]
+
+        profile = {}
+        if sizes:
+            peak_size = max(max(ws, default=0) for ws in sizes)
+            memory = BASE_RUNTIME_MEMORY + memory_factor * peak_size / 1024**2
+            profile["runtime_memory"] = MEMORY_STEP * math.ceil(memory / MEMORY_STEP)
+            profile["ephemeral_storage"] = max(512, math.ceil(max(sum(ws) for ws in sizes) / 1024**2))
+        if elapsed:
+            profile["timeout"] = max(60, math.ceil(timeout_factor * max(elapsed)))
+        profiles[function_name] = profile
+        logger.debug("Suggested profile for %s (%d functions): %s", function_name, len(workers), profile)
+
+    return profiles
+
+
+def collect_stage_stats(stats, stages: dict):
+    """
+    Find the lists of function stats ("<function name>_stats" values) in a nested stats dump
+    """
+    if isinstance(stats, dict):
+        for key, value in stats.items():
+            if key.endswith("_stats") and isinstance(value, list) and all(is_stats_dump(v) for v in value):
+                function_name = stats_key_function(key)
+                stages.setdefault(function_name, []).extend(v for v in value if "cached" not in v["values"])
+            else:
+                collect_stage_stats(value, stages)
+    elif isinstance(stats, list):
+        for value in stats:
+            collect_stage_stats(value, stages)
+
+
+def stats_key_function(key: str) -> str:
+    """
+    Name of the function whose stats are stored under a "<function name>_stats" key
+    """
+    return _STATS_KEY_FUNCTIONS.get(key, key[: -len("_stats")])
+
+
+def is_stats_dump(value) -> bool:
+    return isinstance(value, dict) and "timers" in value and "values" in value
+
+
+def _data_sizes(worker_stats: dict) -> list:
+    return [v for k, v in worker_stats["values"].items() if k.endswith("_size") and isinstance(v, (int, float))]
@@ -1,29 +1,66 @@
 import logging
-from typing import Tuple
+from typing import List, Tuple
 import lithops as deflithops
 import boto3
 from pprint import pprint
 
+from ..datasource.sources.bed import intersect_intervals, merge_intervals
+from ..mapping.map_caller import _batch_map
 from ..pipeline import PipelineParameters, PipelineRun, Lithops
 from ..stats import Stats
-from ..utils import split_data_result
+from ..utils import get_storage_tmp_prefix, split_data_result, try_head_object
 from .reduce_functions import (
     complete_multipart,
     create_multipart,
     create_multipart_keys,
+    create_multiparts,
     distribute_indexes,
     final_merge,
     finish,
     keys_by_fasta_split,
     reduce_function,
+    MAX_MULTIPART_PARTS,
 )
 
 logger = logging.getLogger(__name__)
 
 
+def get_reducer_ranges(indexes: Tuple[int], targets: List[Tuple[int, int]] = None) -> List[dict]:
+    """
+    Position ranges of the reducers of a fasta split, one for each range of the distributed indexes.
+
+    Args:
+        indexes (Tuple[int]): Last position of each range, as returned by distribute_indexes
+        targets (List[Tuple[int, int]], optional): Sorted, merged target intervals of the fasta split. If provided,
+            each range gets the target intervals it overlaps, clipped to it, and ranges without targets are skipped
+
+    Returns:
+        List[dict]: Reducer ranges, with their start, end and targets (None if all positions are reduced)
+    """
+    ranges = []
+    start = 1
+    for index in indexes:
+        end = int(index)
+        if targets is None:
+            ranges.append({"start": start, "end": end, "targets": None})
+        else:
+            clipped = intersect_intervals(targets, start, end)
+            if clipped:
+                # Rows outside the targets are not selected
+                ranges.append({"start": clipped[0][0], "end": clipped[-1][1], "targets": clipped})
+        start = end + 1
+    if len(ranges) > MAX_MULTIPART_PARTS:
+        # Each reducer uploads at least one part of the multipart upload of the fasta split
+        raise ValueError(
+            f"{len(ranges)} reducers for a fasta split, more than the {MAX_MULTIPART_PARTS} parts of a multipart "
+            "upload, use more fasta chunks"
+        )
+    return ranges
+
+
 def create_iterdata_reducer(
     intermediate_keys: dict,
-    distributed_indexes: Tuple[Tuple[str]],
+    reducer_ranges: Tuple[List[dict]],
     multipart_ids: Tuple[str],
     multipart_keys: Tuple[str],
     pipeline_params: PipelineParameters,
@@ -33,7 +70,7 @@ def create_iterdata_reducer(
 
     Args:
         intermediate_keys (Tuple[str]): Keys distributed by fasta split
-        distributed_indexes (Tuple[Tuple[str]]): Indexes that each reducer should process
+        reducer_ranges (Tuple[List[dict]]): Ranges that each reducer should process, as returned by get_reducer_ranges
         multipart_ids (Tuple[str]): Multipart Upload IDs
         multipart_keys (Tuple[str]): Multipart Upload Keys
         pipeline_params (PipelineParameters): Pipeline Parameters
@@ -43,108 +80,227 @@ def create_iterdata_reducer(
     """
     iterdata = []
 
-    for keys, indexes, mpu_id, mpu_key in zip(intermediate_keys, distributed_indexes, multipart_ids, multipart_keys):
-        start = 1
-        n_part = 1
-
-        for index in indexes:
+    for keys, ranges, mpu_id, mpu_key in zip(intermediate_keys, reducer_ranges, multipart_ids, multipart_keys):
+        # Part numbers of the multipart upload are split evenly between its reducers
+        parts_per_reducer = max(MAX_MULTIPART_PARTS // len(ranges), 1)
+        for n_part, reducer_range in enumerate(ranges, start=1):
             data = {
                 "keys": intermediate_keys[keys],
-                "range": {"start": start, "end": int(index)},
+                "range": {"start": reducer_range["start"], "end": reducer_range["end"]},
                 "mpu_id": mpu_id,
                 "n_part": n_part,
                 "mpu_key": mpu_key,
                 "pipeline_params": pipeline_params,
+                "parts_per_reducer": parts_per_reducer,
+                "targets": reducer_range["targets"],
             }
             iterdata.append(data)
-            n_part += 1
-            start = int(index) + 1
 
     return iterdata
 
 
+def get_target_ranges(pipeline_run: PipelineRun) -> dict:
+    """
+    Merge the target intervals of every FASTA chunk into position ranges by fasta split
+    """
+    return {
+        fa_ch["chunk_id"]: merge_intervals([iv for ivs in fa_ch["targets"].values() for iv in ivs])
+        for fa_ch in pipeline_run.fasta_chunks
+    }
+
+
 def run_reducer(pipeline_params: PipelineParameters, pipeline_run: PipelineRun, lithops: Lithops):
-    stats = Stats()
+    return run_batch_reducer([(pipeline_params, pipeline_run)], lithops)[0]
+
+
+def run_batch_reducer(runs: List[Tuple[PipelineParameters, PipelineRun]], lithops: Lithops) -> List[Stats]:
+    """
+    Execute the reduce phase for many pipeline runs at once, packing the invocations of every run into shared map
+    calls. Returns a Stats instance for each run.
+    """
+    runs_stats = [Stats() for _ in runs]
 
     # TODO: Fix errors with lithops cache and multipart upload ids
 
     logger.debug("START OF REDUCE STAGE")
-    with stats.timeit("prepare_reduce"):
-        # 1 Organize the keys generated by the map phase by fasta split
-        intermediate_keys = keys_by_fasta_split(pipeline_run.aligned_mpileups.values())
+    final_keys = {}
+    runs_multipart_keys = {}
+    pending_splits = {}
+    for i, ((pipeline_params, pipeline_run), stats) in enumerate(zip(runs, runs_stats)):
+        final_sinple_key = f"serverless-genomics.tmp.varcall-{pipeline_run.run_id}/final.alignment"
+        if try_head_object(lithops.storage, pipeline_params.storage_bucket, final_sinple_key) is not None:
+            logger.info("Final output %s already exists, skipping reduce stage", final_sinple_key)
+            continue
+        final_keys[i] = final_sinple_key
 
-        # 2 Create the keys for the multipart uploads
-        multipart_keys = create_multipart_keys(pipeline_params, pipeline_run)
+        with stats.timeit("prepare_reduce"):
+            # 1 Organize the keys generated by the map phase by fasta split
+            intermediate_keys = keys_by_fasta_split(pipeline_run.aligned_mpileups.values())
 
-        # 3 Create the multipart uploads and get their IDs
-        multipart_ids = []
-        for key in multipart_keys:
-            multipart_ids.append(create_multipart(pipeline_params, key, lithops.storage))
+            # 2 Create the keys for the multipart uploads
+            multipart_keys = create_multipart_keys(pipeline_params, pipeline_run, intermediate_keys.keys())
+            runs_multipart_keys[i] = multipart_keys
 
-        # 4 Select the indexes that each reducer will process
-        indexes_iterdata = []
-        for fasta_chunk, keys in intermediate_keys.items():
-            data = {"pipeline_params": pipeline_params, "fasta_chunk": fasta_chunk, "keys": keys}
-            indexes_iterdata.append(data)
+            # Completion manifest: fasta splits with a completed multipart upload from a previous run are not reduced
+            # again
+            prefix = get_storage_tmp_prefix(pipeline_run.run_id, "multipart_uploads")
+            completed_keys = set(lithops.storage.list_keys(bucket=pipeline_params.storage_bucket, prefix=prefix))
+            pending = [(fa, key) for fa, key in zip(intermediate_keys, multipart_keys) if key not in completed_keys]
 
-    logger.debug("DISTRIBUTING INDEXES BETWEEN REDUCERS")
-    with stats.timeit("distribute_indexes"):
-        result = lithops.invoker.map(distribute_indexes, indexes_iterdata)
-    distributed_indexes, distribute_indexes_stats = zip(*result)
-    stats.set_value("distribute_indexes_stats", [s.dump_dict() for s in distribute_indexes_stats])
+        if len(pending) < len(multipart_keys):
+            logger.info(
+                "Skipping %d of %d fasta splits already reduced",
+                len(multipart_keys) - len(pending),
+                len(multipart_keys),
+            )
+        if pending:
+            pending_splits[i] = ({fa: intermediate_keys[fa] for fa, _ in pending}, [key for _, key in pending])
 
-    # 5 Launch the reducers
-    logger.debug("EXECUTING REDUCE FUNCTION")
-    reducer_iterdata = create_iterdata_reducer(
-        intermediate_keys,
-        distributed_indexes,
-        multipart_ids,
-        multipart_keys,
-        pipeline_params,
-    )
+    if pending_splits:
+        reduce_fasta_splits(
+            [runs[i] for i in pending_splits],
+            lithops,
+            list(pending_splits.values()),
+            [runs_stats[i] for i in pending_splits],
+        )
 
-    with stats.timeit("reduce_function"):
-        result = lithops.invoker.map(reduce_function, reducer_iterdata)
-    reducer_output, reduce_function_stats = zip(*result)
-    stats.set_value("reduce_function_stats", [s.dump_dict() for s in reduce_function_stats])
+    merge_iterdata = {}
+    for i, final_sinple_key in final_keys.items():
+        (pipeline_params, pipeline_run), stats = runs[i], runs_stats[i]
 
-    # 6 Complete the multipart uploads that the reducers created
-    with stats.timeit("complete_multipart"):
-        complete_multipart(
-            multipart_keys, multipart_ids, reducer_output, pipeline_params, lithops.storage.storage_handler.s3_client
-        )
+        # Fasta splits without target positions are stored empty, and left out of the final file
+        with stats.timeit("list_multipart_outputs"):
+            prefix = get_storage_tmp_prefix(pipeline_run.run_id, "multipart_uploads")
+            sizes = {
+                obj["Key"]: obj["Size"]
+                for obj in lithops.storage.list_objects(bucket=pipeline_params.storage_bucket, prefix=prefix)
+            }
+        merge_keys = [key for key in runs_multipart_keys[i] if sizes.get(key)]
+        if not merge_keys:
+            logger.info("No variants to merge, writing empty final output %s", final_sinple_key)
+            lithops.storage.put_object(bucket=pipeline_params.storage_bucket, key=final_sinple_key, body=b"")
+            continue
 
-    # 7 Create a multipart upload key and ID for the final file
-    final_sinple_key = f"serverless-genomics.tmp.varcall-{pipeline_run.run_id}/final.alignment"
-    with stats.timeit("create_multipart"):
-        final_id = create_multipart(pipeline_params, final_sinple_key, lithops.storage)
-
-    # 8 Merge files created in stage 6 into one single file
-    n_parts = len(multipart_keys)
-    part = 1
-    merge_iterdata = []
-    while part <= n_parts:
-        data = {
-            "mpu_id": final_id,
-            "mpu_key": final_sinple_key,
-            "key": multipart_keys[part - 1],
-            "n_part": part,
-            "pipeline_params": pipeline_params,
+        # 7 Create a multipart upload key and ID for the final file
+        with stats.timeit("create_multipart"):
+            final_id = create_multipart(pipeline_params, final_sinple_key, lithops.storage)
+
+        # 8 Merge files created in stage 6 into one single file
+        merge_iterdata[i] = [
+            {
+                "mpu_id": final_id,
+                "mpu_key": final_sinple_key,
+                "key": key,
+                "n_part": part,
+                "pipeline_params": pipeline_params,
+            }
+            for part, key in enumerate(merge_keys, start=1)
+        ]
+
+    if merge_iterdata:
+        logger.debug("EXECUTING FINAL MERGE")
+        merge_stats = [runs_stats[i] for i in merge_iterdata]
+        results = _batch_map(lithops, final_merge, list(merge_iterdata.values()), merge_stats, "final_merge")
+        for i, stats, run_results in zip(merge_iterdata, merge_stats, results):
+            pipeline_params = runs[i][0]
+            final_merge_results, final_merge_stats = zip(*run_results)
+            stats.set_value("final_merge_stats", [s.dump_dict() for s in final_merge_stats])
+
+            # 8 Complete the previous multipart upload
+            with stats.timeit("finish"):
+                finish(
+                    final_keys[i],
+                    merge_iterdata[i][0]["mpu_id"],
+                    final_merge_results,
+                    pipeline_params,
+                    lithops.storage,
+                )
+
+    logger.debug("END OF REDUCE STAGE")
+    return runs_stats
+
+
+def reduce_fasta_splits(
+    runs: List[Tuple[PipelineParameters, PipelineRun]],
+    lithops: Lithops,
+    runs_splits: List[Tuple[dict, List[str]]],
+    runs_stats: List[Stats],
+):
+    """
+    Reduce the intermediate keys of each fasta split into its multipart upload key, for the intermediate keys and
+    multipart upload keys by fasta split of every run
+    """
+    # 3 Select the indexes that each reducer will process
+    indexes_iterdata = [
+        [
+            {"pipeline_params": pipeline_params, "fasta_chunk": fasta_chunk, "keys": keys}
+            for fasta_chunk, keys in intermediate_keys.items()
+        ]
+        for (pipeline_params, _), (intermediate_keys, _) in zip(runs, runs_splits)
+    ]
+
+    logger.debug("DISTRIBUTING INDEXES BETWEEN REDUCERS")
+    results = _batch_map(lithops, distribute_indexes, indexes_iterdata, runs_stats, "distribute_indexes")
+
+    reducer_iterdata = {}
+    runs_multiparts = {}
+    for i, (run_results, (pipeline_params, pipeline_run), (intermediate_keys, multipart_keys), stats) in enumerate(
+        zip(results, runs, runs_splits, runs_stats)
+    ):
+        distributed_indexes, distribute_indexes_stats = zip(*run_results)
+        stats.set_value("distribute_indexes_stats", [s.dump_dict() for s in distribute_indexes_stats])
+
+        target_ranges = get_target_ranges(pipeline_run) if pipeline_params.regions is not None else None
+        reducer_ranges = {
+            fasta_chunk: get_reducer_ranges(indexes, target_ranges[fasta_chunk] if target_ranges is not None else None)
+            for fasta_chunk, indexes in zip(intermediate_keys, distributed_indexes)
         }
-        merge_iterdata.append(data)
-        part += 1
-
-    logger.debug("EXECUTING FINAL MERGE")
-    with stats.timeit("final_merge"):
-        result = lithops.invoker.map(final_merge, merge_iterdata)
-    final_merge_results, final_merge_stats = zip(*result)
-    stats.set_value("final_merge_stats", [s.dump_dict() for s in final_merge_stats])
-
-    # 8 Complete the previous multipart upload
-    with stats.timeit("finish"):
-        finish(
-            final_sinple_key, final_id, final_merge_results, pipeline_params, lithops.storage.storage_handler.s3_client
+
+        # Fasta splits whose positions are all outside the targets have nothing to reduce, their output is empty
+        skipped_keys = [key for fa, key in zip(intermediate_keys, multipart_keys) if not reducer_ranges[fa]]
+        if skipped_keys:
+            logger.info("Skipping %d fasta splits without target positions", len(skipped_keys))
+            for key in skipped_keys:
+                lithops.storage.put_object(bucket=pipeline_params.storage_bucket, key=key, body=b"")
+        pending = [(fa, key) for fa, key in zip(intermediate_keys, multipart_keys) if reducer_ranges[fa]]
+        if not pending:
+            continue
+        intermediate_keys = {fa: intermediate_keys[fa] for fa, _ in pending}
+        multipart_keys = [key for _, key in pending]
+
+        with stats.timeit("create_multipart_uploads"):
+            # 4 Create the multipart uploads and get their IDs
+            multipart_ids = create_multiparts(pipeline_params, multipart_keys, lithops.storage)
+        runs_multiparts[i] = (multipart_keys, multipart_ids)
+
+        reducer_iterdata[i] = create_iterdata_reducer(
+            intermediate_keys,
+            [reducer_ranges[fa] for fa in intermediate_keys],
+            multipart_ids,
+            multipart_keys,
+            pipeline_params,
         )
 
-    logger.debug("END OF REDUCE STAGE")
-    return stats
+    if not reducer_iterdata:
+        return
+
+    # 5 Launch the reducers
+    logger.debug("EXECUTING REDUCE FUNCTION")
+    reduce_stats = [runs_stats[i] for i in reducer_iterdata]
+    results = _batch_map(
+        lithops, reduce_function, list(reducer_iterdata.values()), reduce_stats, "reduce_function", speculative=True
+    )
+    for i, stats, run_results in zip(reducer_iterdata, reduce_stats, results):
+        reducer_output, reduce_function_stats = zip(*run_results)
+        stats.set_value("reduce_function_stats", [s.dump_dict() for s in reduce_function_stats])
+
+        # 6 Complete the multipart uploads that the reducers created
+        multipart_keys, multipart_ids = runs_multiparts[i]
+        with stats.timeit("complete_multipart"):
+            complete_multipart(
+                multipart_keys,
+                multipart_ids,
+                [part for parts in reducer_output for part in parts],
+                runs[i][0],
+                lithops.storage,
+            )
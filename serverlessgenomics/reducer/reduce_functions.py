@@ -1,17 +1,48 @@
+import bisect
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 import os
-from subprocess import Popen, PIPE, STDOUT
-from typing import Tuple
+import shutil
+from subprocess import CalledProcessError, Popen, PIPE, STDOUT, DEVNULL
+from typing import BinaryIO, List, Tuple
 from time import time
 from sys import getsizeof
 from pprint import pprint
 
 from lithops import Storage
+from ..datasource.sources.bed import overlaps
 from ..pipeline import PipelineParameters, PipelineRun
 from ..stats import Stats
+from ..storage import ObjectStorage, get_pipeline_storage
 
+# Share of the function memory used by sort in mpileup_merge_reducev3.sh, split between the reducer processes
+REDUCE_SORT_BUFFER_PERCENT = 75
+# S3 multipart upload limits
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_MULTIPART_PARTS = 10_000
 
-def reduce_function(keys, range, mpu_id, n_part, mpu_key, pipeline_params: PipelineParameters, storage: Storage):
+_READ_BLOCK_SIZE = 1024 * 1024
+
+
+def reduce_function(
+    keys,
+    range,
+    mpu_id,
+    n_part,
+    mpu_key,
+    pipeline_params: PipelineParameters,
+    storage: Storage,
+    parts_per_reducer: int = 1,
+    targets: List[Tuple[int, int]] = None,
+):
+    """
+    Lithops callee function
+    Merge and call variants on the mpileup rows of a position range, and upload the output to the multipart upload of
+    its fasta split. The output is streamed in parts of pipeline_params.reduce_part_size bytes, numbered from
+    (n_part - 1) * parts_per_reducer + 1. Returns the list of uploaded parts.
+    If targets (sorted, merged position intervals inside the range) are given, rows outside them are dropped.
+    """
     stats = Stats()
     stats.start_timer("function")
     stats.set_value("keys", keys)
@@ -19,72 +50,216 @@ def reduce_function(keys, range, mpu_id, n_part, mpu_key, pipeline_params: Pipel
     stats.set_value("mpu_id", mpu_id)
     stats.set_value("n_part", n_part)
     stats.set_value("mpu_key", mpu_key)
+    stats.set_value("targets", len(targets) if targets is not None else None)
 
-    s3 = storage.get_client()
+    storage = get_pipeline_storage(storage, pipeline_params)
 
     # Change working directory to /tmp
     wd = os.getcwd()
     os.chdir("/tmp")
 
-    # S3 SELECT query to get the rows where the second column is in the selected range
-    expression = "SELECT * FROM s3object s WHERE cast(s._2 as int) BETWEEN %s AND %s" % (range["start"], range["end"])
-    input_serialization = {
-        "CSV": {"RecordDelimiter": "\n", "FieldDelimiter": "\t"},
-        "CompressionType": "NONE",
-    }
-
-    # Execute S3 SELECT
-    mpileup_data = ""
-    for k in keys:
-        key_stat = Stats()
-        key_stat.set_value("key", k)
-        try:
-            with key_stat.timeit("s3_select"):
-                resp = s3.select_object_content(
-                    Bucket=pipeline_params.storage_bucket,
-                    Key=k,
-                    ExpressionType="SQL",
-                    Expression=expression,
-                    InputSerialization=input_serialization,
-                    OutputSerialization={"CSV": {"FieldDelimiter": "\t"}},
-                )
-        except:
-            raise ValueError("ERROR IN KEY: " + k)
-
-        for event in resp["Payload"]:
-            if "Records" in event:
-                records = event["Records"]["Payload"].decode("UTF-8")
-                key_stat.set_value("data_size", len(records))
-                mpileup_data = mpileup_data + records
-                del records
-
-        stats.set_value(k, key_stat.dump_dict())
-
-    stats.set_value("mpileup_data_size", len(mpileup_data))
-
-    # Str -> bytes
-    mpileup_data = mpileup_data.encode("UTF-8")
-
-    # Execute the script to merge and reduce
-    with stats.timeit("mpileup_merge_reduce"):
-        p = Popen(
-            ["bash", "/function/bin/mpileup_merge_reducev3.sh", "/function/bin/", "75%"],
+    # Shard the range into contiguous position sub-ranges, merged and called by parallel script processes
+    start, end = range["start"], range["end"]
+    num_shards = max(min(pipeline_params.reduce_processes or multiprocessing.cpu_count(), end - start + 1), 1)
+    shard_bounds = get_shard_bounds(start, end, num_shards)
+    stats.set_value("num_shards", num_shards)
+
+    procs, output = _start_shard_processes(num_shards)
+    shard_procs = procs[:num_shards]
+
+    try:
+        # Select the rows where the second column is in the selected range, sending each row to the process of its
+        # sub-range
+        mpileup_data_size = 0
+        for k in keys:
+            key_stat = Stats()
+            key_stat.set_value("key", k)
+            try:
+                with key_stat.timeit("s3_select"):
+                    records_blocks = storage.select_rows(pipeline_params.storage_bucket, k, 2, start, end)
+            except:
+                raise ValueError("ERROR IN KEY: " + k)
+
+            data_size = 0
+            pending = b""
+            for block in records_blocks:
+                records = pending + block
+                # Records may be split between blocks, keep the last incomplete line for the next one
+                cut = records.rfind(b"\n") + 1
+                pending = records[cut:]
+                data_size += cut
+                _write_shards(records[:cut], shard_bounds, shard_procs, targets)
+            if pending:
+                data_size += len(pending)
+                _write_shards(pending + b"\n", shard_bounds, shard_procs, targets)
+            key_stat.set_value("data_size", data_size)
+            mpileup_data_size += data_size
+
+            stats.set_value(k, key_stat.dump_dict())
+
+        stats.set_value("mpileup_data_size", mpileup_data_size)
+
+        # The script processes merge and reduce their sub-ranges, and their output, merged in sequence and position
+        # order, is uploaded as it fills parts
+        with stats.timeit("mpileup_merge_reduce"):
+            for p in shard_procs:
+                p.stdin.close()
+            writer = MultipartPartWriter(
+                storage,
+                pipeline_params.storage_bucket,
+                mpu_key,
+                mpu_id,
+                first_part=(n_part - 1) * parts_per_reducer + 1,
+                max_parts=parts_per_reducer,
+                part_size=pipeline_params.reduce_part_size,
+            )
+            shutil.copyfileobj(output, writer, _READ_BLOCK_SIZE)
+            for p in procs:
+                p.wait()
+            # Output of failed processes is incomplete, the last part is not uploaded
+            _check_returncodes(procs)
+            parts = writer.close()
+        stats.set_value("sinple_out_size", writer.size)
+        stats.set_value("num_parts", len(parts))
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.kill()
+        output.close()
+
+    os.chdir(wd)
+    stats.stop_timer("function")
+    return parts, stats
+
+
+def get_shard_bounds(start: int, end: int, num_shards: int) -> List[int]:
+    """
+    First position of each reducer shard but the first one, splitting [start, end] in contiguous sub-ranges
+    """
+    return [start + (end - start + 1) * i // num_shards for i in range(1, num_shards)]
+
+
+def _start_shard_processes(num_shards: int) -> Tuple[List[Popen], BinaryIO]:
+    """
+    Start the merge and reduce script processes of the shards, each with an even share of the sort buffer.
+    Returns the processes, shard processes first, and their output: the stdout of the single shard process, or of
+    the process that merges the outputs of the shards.
+    """
+    buffer_size = f"{max(REDUCE_SORT_BUFFER_PERCENT // num_shards, 1)}%"
+    args = ["bash", "/function/bin/mpileup_merge_reducev3.sh", "/function/bin/", buffer_size]
+    if num_shards == 1:
+        proc = Popen(args, stdout=PIPE, stdin=PIPE, stderr=DEVNULL)
+        return [proc], proc.stdout
+
+    # Shards split the range by position only, so a shard may have rows of several sequences. Their outputs (rows
+    # starting with the sequence and position of the input rows) are merged in the order of the script sort
+    pipes = [os.pipe() for _ in range(num_shards)]
+    try:
+        procs = [Popen(args, stdout=write_fd, stdin=PIPE, stderr=DEVNULL) for _, write_fd in pipes]
+        read_fds = [read_fd for read_fd, _ in pipes]
+        merge = Popen(
+            ["sort", "-m", "-k1,1", "-k2,2n", f"--batch-size={num_shards}", *(f"/dev/fd/{fd}" for fd in read_fds)],
             stdout=PIPE,
-            stdin=PIPE,
-            stderr=PIPE,
+            stderr=DEVNULL,
+            pass_fds=read_fds,
         )
-        sinple_out = p.communicate(input=mpileup_data)[0]
-    sinple_out = sinple_out.decode("UTF-8")
+    finally:
+        # The processes have their own copies of the pipe ends
+        for fds in pipes:
+            for fd in fds:
+                os.close(fd)
+    return procs + [merge], merge.stdout
 
-    # Upload part
-    with stats.timeit("upload_part"):
-        part = s3.upload_part(
-            Body=sinple_out, Bucket=pipeline_params.storage_bucket, Key=mpu_key, UploadId=mpu_id, PartNumber=n_part
-        )
 
-    os.chdir(wd)
-    stats.stop_timer("function")
-    return {"PartNumber": n_part, "ETag": part["ETag"], "mpu_id": mpu_id}, stats
+def _check_returncodes(procs: List[Popen]):
+    for p in procs:
+        if p.returncode != 0:
+            raise CalledProcessError(p.returncode, p.args)
+
+
+def _write_shards(lines: bytes, shard_bounds: List[int], procs: List[Popen], targets: List[Tuple[int, int]] = None):
+    """
+    Write mpileup lines to the stdin of the process of the sub-range that contains their position (second column),
+    dropping the lines outside the targets if given
+    """
+    shards = [[] for _ in procs]
+    for line in lines.splitlines(keepends=True):
+        if not line.strip():
+            continue
+        position = int(line.split(b"\t", 2)[1])
+        if targets is not None and not overlaps(targets, position, position):
+            continue
+        shards[bisect.bisect_right(shard_bounds, position)].append(line)
+    for p, shard in zip(procs, shards):
+        if shard:
+            p.stdin.write(b"".join(shard))
+
+
+class MultipartPartWriter:
+    """
+    Write-only file-like object that uploads its data as consecutive parts of a multipart upload while it is
+    written, keeping at most one part (plus the minimum part size) in memory.
+    All parts but the last one are part_size bytes. Parts are never smaller than the S3 minimum part size, except
+    when all the data fits in one part. Once the last available part number is reached, the rest of the data is
+    buffered and uploaded in that part.
+    """
+
+    def __init__(
+        self,
+        storage: ObjectStorage,
+        bucket: str,
+        key: str,
+        mpu_id: str,
+        first_part: int,
+        max_parts: int,
+        part_size: int,
+    ):
+        self.__storage = storage
+        self.__bucket = bucket
+        self.__key = key
+        self.__mpu_id = mpu_id
+        self.__next_part = first_part
+        self.__last_part = first_part + max_parts - 1
+        self.__part_size = max(part_size, MIN_PART_SIZE)
+        self.__buf = bytearray()
+        self.__parts = []
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.__buf += data
+        self.size += len(data)
+        # Keep enough data for a valid last part
+        while len(self.__buf) >= self.__part_size + MIN_PART_SIZE and self.__next_part < self.__last_part:
+            self.__upload(bytes(self.__buf[: self.__part_size]))
+            del self.__buf[: self.__part_size]
+        return len(data)
+
+    def close(self) -> List[dict]:
+        """
+        Upload the remaining data and return the uploaded parts, for complete_multipart
+        """
+        # A reducer uploads at least one part, even if it is empty
+        if self.__buf or not self.__parts:
+            self.__upload(bytes(self.__buf))
+            self.__buf = bytearray()
+        return self.__parts
+
+    def __upload(self, body: bytes):
+        n_part = self.__next_part
+        etag = upload_part_once(self.__storage, self.__bucket, self.__key, self.__mpu_id, n_part, body)
+        self.__parts.append({"PartNumber": n_part, "ETag": etag, "mpu_id": self.__mpu_id})
+        self.__next_part += 1
+
+
+def upload_part_once(storage: ObjectStorage, bucket: str, key: str, mpu_id: str, n_part: int, body) -> str:
+    """
+    Upload a multipart upload part, unless another invocation (e.g. a speculative copy of the same task) already
+    uploaded it. Returns the ETag of the stored part, so the part list of the driver always matches the stored data.
+    """
+    etag = storage.get_part_etag(bucket, key, mpu_id, n_part)
+    if etag is not None:
+        return etag
+    return storage.upload_part(bucket, key, mpu_id, n_part, body)
 
 
 def distribute_indexes(
@@ -106,13 +281,7 @@ def distribute_indexes(
     stats.set_value("fasta_chunk", fasta_chunk)
     stats.set_value("keys", keys)
 
-    s3 = storage.get_client()
-
-    expression = "SELECT cast(s._2 as int) FROM s3object s"
-    input_serialization = {
-        "CSV": {"RecordDelimiter": "\n", "FieldDelimiter": "\t"},
-        "CompressionType": "NONE",
-    }
+    storage = get_pipeline_storage(storage, pipeline_params)
 
     count_indexes = {}
 
@@ -122,20 +291,8 @@ def distribute_indexes(
             key_stats = Stats()
             key_stats.set_value("key", key)
             with key_stats.timeit("s3_select"):
-                resp = s3.select_object_content(
-                    Bucket=pipeline_params.storage_bucket,
-                    Key=key,
-                    ExpressionType="SQL",
-                    Expression=expression,
-                    InputSerialization=input_serialization,
-                    OutputSerialization={"CSV": {}},
-                )
-
-            data = ""
-            for event in resp["Payload"]:
-                if "Records" in event:
-                    records = event["Records"]["Payload"].decode("UTF-8")
-                    data = data + records
+                # Positions (second column) of the rows
+                data = b"".join(storage.select_column(pipeline_params.storage_bucket, key, 2)).decode("UTF-8")
             data = data.split("\n")
             data.pop()  # Last value is empty
 
@@ -202,14 +359,12 @@ def final_merge(
     stats.set_value("sinple_out_size", len(sinple_out))
 
     # Upload part
-    s3 = storage.get_client()
+    storage = get_pipeline_storage(storage, pipeline_params)
     with stats.timeit("upload_part"):
-        part = s3.upload_part(
-            Body=sinple_out, Bucket=pipeline_params.storage_bucket, Key=mpu_key, UploadId=mpu_id, PartNumber=n_part
-        )
+        etag = upload_part_once(storage, pipeline_params.storage_bucket, mpu_key, mpu_id, n_part, sinple_out)
 
     stats.stop_timer("function")
-    return {"PartNumber": n_part, "ETag": part["ETag"], "mpu_id": mpu_id}, stats
+    return {"PartNumber": n_part, "ETag": etag, "mpu_id": mpu_id}, stats
 
 
 def finish(
@@ -217,7 +372,7 @@ def finish(
     mpu_id: str,
     parts: Tuple[dict],
     pipeline_params: PipelineParameters,
-    s3: Storage,
+    storage: ObjectStorage,
 ):
     """
     Complete the final multipart upload
@@ -227,7 +382,7 @@ def finish(
         mpu_id (str): Multipart upload ID
         parts (Tuple[dict]): Multipart upload parts
         pipeline_params (PipelineParameters): Pipeline parameters
-        s3 (Storage): Lithops storage instance
+        storage (ObjectStorage): Pipeline storage instance
     """
     mpu_part = []
     remove = 0
@@ -239,12 +394,7 @@ def finish(
         else:
             break
 
-    s3.complete_multipart_upload(
-        Bucket=pipeline_params.storage_bucket,
-        Key=key,
-        UploadId=mpu_id,
-        MultipartUpload={"Parts": mpu_part},
-    )
+    storage.complete_multipart_upload(pipeline_params.storage_bucket, key, mpu_id, mpu_part)
 
 
 def complete_multipart(
@@ -252,7 +402,7 @@ def complete_multipart(
     mpu_ids: Tuple[str],
     parts: Tuple[dict],
     pipeline_params: PipelineParameters,
-    s3: Storage,
+    storage: ObjectStorage,
 ):
     """
     Complete a list of multipart uploads.
@@ -262,9 +412,11 @@ def complete_multipart(
         mpu_ids (Tuple[str]): IDs to the multipart uploads
         parts (Tuple[dict]): Parts of each multipart upload
         pipeline_params (PipelineParameters): Pipeline Parameters
-        s3 (Storage): Lithops storage instance
+        storage (ObjectStorage): Pipeline storage instance
     """
-    for key, mpu_id in zip(keys, mpu_ids):
+    # Group parts by multipart upload, reducer outputs are in the same order as the keys
+    mpu_parts = []
+    for mpu_id in mpu_ids:
         mpu_part = []
         remove = 0
 
@@ -275,15 +427,16 @@ def complete_multipart(
             else:
                 break
 
-        s3.complete_multipart_upload(
-            Bucket=pipeline_params.storage_bucket,
-            Key=key,
-            UploadId=mpu_id,
-            MultipartUpload={"Parts": mpu_part},
-        )
-
+        mpu_parts.append(mpu_part)
         parts = parts[remove:]
 
+    def _complete(key, mpu_id, mpu_part):
+        storage.complete_multipart_upload(pipeline_params.storage_bucket, key, mpu_id, mpu_part)
+
+    with ThreadPoolExecutor(max_workers=pipeline_params.storage_max_pool_connections) as pool:
+        # Consume results to propagate exceptions
+        list(pool.map(_complete, keys, mpu_ids, mpu_parts))
+
 
 def keys_by_fasta_split(keys: Tuple[str]) -> dict:
     """
@@ -305,26 +458,29 @@ def keys_by_fasta_split(keys: Tuple[str]) -> dict:
     return key_dict
 
 
-def create_multipart_keys(pipeline_params: PipelineParameters, pipeline_run: PipelineRun) -> Tuple[str]:
+def create_multipart_keys(
+    pipeline_params: PipelineParameters, pipeline_run: PipelineRun, fasta_chunk_ids: Tuple[int]
+) -> Tuple[str]:
     """
     Create the keys that will be used for the multipart uploads
 
     Args:
         pipeline_params (PipelineParameters): Pipeline parameters
+        pipeline_run (PipelineRun): Pipeline run state
+        fasta_chunk_ids (Tuple[int]): Fasta splits with intermediate keys, in reduce order
 
     Returns:
         Tuple[str]: List of keys
     """
     keys = []
-    for i in range(pipeline_params.fasta_chunks):
-        if (pipeline_params.fasta_chunk_range is None) or (i in pipeline_params.fasta_chunk_range):
-            keys.append(f"serverless-genomics.tmp.varcall-{pipeline_run.run_id}/multipart_uploads/fa{i}.sinple")
+    for i in fasta_chunk_ids:
+        keys.append(f"serverless-genomics.tmp.varcall-{pipeline_run.run_id}/multipart_uploads/fa{i}.sinple")
     return keys
 
 
 def create_multipart(pipeline_params: PipelineParameters, key: str, storage: Storage) -> str:
     """
-    Create a S3 multipart upload instance
+    Create a multipart upload instance
 
     Args:
         pipeline_params (PipelineParameters): Pipeline Parameters
@@ -334,6 +490,21 @@ def create_multipart(pipeline_params: PipelineParameters, key: str, storage: Sto
     Returns:
         str: Multipart Upload ID
     """
-    s3 = storage.get_client()
-    mpu = s3.create_multipart_upload(Bucket=pipeline_params.storage_bucket, Key=key)
-    return mpu["UploadId"]
+    storage = get_pipeline_storage(storage, pipeline_params)
+    return storage.create_multipart_upload(pipeline_params.storage_bucket, key)
+
+
+def create_multiparts(pipeline_params: PipelineParameters, keys: Tuple[str], storage: Storage) -> Tuple[str]:
+    """
+    Create S3 multipart upload instances concurrently
+
+    Args:
+        pipeline_params (PipelineParameters): Pipeline Parameters
+        keys (Tuple[str]): Keys for the multipart uploads
+        storage (Storage): Lithops storage instance
+
+    Returns:
+        Tuple[str]: Multipart Upload IDs, in the same order as keys
+    """
+    with ThreadPoolExecutor(max_workers=pipeline_params.storage_max_pool_connections) as pool:
+        return list(pool.map(lambda key: create_multipart(pipeline_params, key, storage), keys))
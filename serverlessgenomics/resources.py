@@ -0,0 +1,248 @@
+"""
+Resource usage of the pipeline functions, measured for each timer of their stats.
+
+When the pipeline runs with resource_sampling_interval, every timer started inside a function records the CPU time
+(user and system, including the subprocesses that finished, e.g. gem-mapper, sort or SiNPle), the disk and network
+bytes, and the peak memory (RSS of the function process and its children) and /tmp usage, which a background thread
+samples while timers are running. Network bytes are counted for the whole network namespace of the function: in a
+function container they are its storage traffic, but in a shared namespace (e.g. the local engine, or concurrent
+invocations in one container) they include the traffic of other processes. Peak /tmp usage is the growth of the used
+bytes of the /tmp file system since the start of the timer, which also includes other writers of that file system.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from .profiles import collect_stage_stats, is_stats_dump
+
+if TYPE_CHECKING:
+    from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Metrics that add up between sections and invocations, the rest are peaks
+ADDITIVE_METRICS = (
+    "cpu_user_s",
+    "cpu_sys_s",
+    "disk_read_bytes",
+    "disk_write_bytes",
+    "network_rx_bytes",
+    "network_tx_bytes",
+)
+PEAK_METRICS = ("peak_rss_bytes", "peak_tmp_bytes")
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler(interval: float) -> ResourceSampler:
+    """
+    Resource sampler of this process, started on first use
+    """
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = ResourceSampler(interval)
+        return _sampler
+
+
+class ResourceSampler:
+    """
+    Measure the resource usage of sections of a function. Counters are read at the start and end of each section,
+    and memory and /tmp usage are sampled every interval seconds while there are open sections.
+    """
+
+    def __init__(self, interval: float):
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__sections = {}
+        self.__next_id = 0
+        self.__thread = threading.Thread(target=self.__run, name="resource-sampler", daemon=True)
+        self.__thread.start()
+
+    def start_section(self) -> int:
+        usage = sample_usage()
+        # /tmp usage is relative to the start of the section
+        section = {"start": read_counters(), "start_tmp_bytes": usage["peak_tmp_bytes"], **usage}
+        with self.__lock:
+            section_id = self.__next_id
+            self.__next_id += 1
+            self.__sections[section_id] = section
+        return section_id
+
+    def stop_section(self, section_id: int) -> dict:
+        """
+        Resource usage of a section since start_section
+        """
+        counters, usage = read_counters(), sample_usage()
+        with self.__lock:
+            section = self.__sections.pop(section_id)
+        resources = {metric: counters[metric] - section["start"][metric] for metric in counters}
+        resources.update({metric: max(section[metric], usage[metric]) for metric in PEAK_METRICS})
+        resources["peak_tmp_bytes"] = max(resources["peak_tmp_bytes"] - section["start_tmp_bytes"], 0)
+        return resources
+
+    def __run(self):
+        while True:
+            time.sleep(self.__interval)
+            with self.__lock:
+                if not self.__sections:
+                    continue
+            usage = sample_usage()
+            with self.__lock:
+                for section in self.__sections.values():
+                    for metric in PEAK_METRICS:
+                        section[metric] = max(section[metric], usage[metric])
+
+
+def read_counters() -> dict:
+    """
+    Cumulative CPU seconds of the process and its waited for children, and disk and network bytes. Disk bytes are
+    from /proc/self/io (children are included once waited for). Network bytes are from /proc/net/dev, which has no
+    per process counters: they are the traffic of all the processes in the network namespace, on all its interfaces
+    except loopback. Counters are 0 where /proc is not available.
+    """
+    times = os.times()
+    counters = {
+        "cpu_user_s": times.user + times.children_user,
+        "cpu_sys_s": times.system + times.children_system,
+        "disk_read_bytes": 0,
+        "disk_write_bytes": 0,
+        "network_rx_bytes": 0,
+        "network_tx_bytes": 0,
+    }
+    try:
+        with open("/proc/self/io") as f:
+            io_counters = dict(line.split(": ") for line in f.read().splitlines())
+        counters["disk_read_bytes"] = int(io_counters["read_bytes"])
+        counters["disk_write_bytes"] = int(io_counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        with open("/proc/net/dev") as f:
+            # Two header lines, then "interface: rx_bytes rx_packets ... tx_bytes ..."
+            for line in f.read().splitlines()[2:]:
+                interface, fields = line.split(":", 1)
+                fields = fields.split()
+                if interface.strip() != "lo":
+                    counters["network_rx_bytes"] += int(fields[0])
+                    counters["network_tx_bytes"] += int(fields[8])
+    except (OSError, ValueError, IndexError):
+        pass
+    return counters
+
+
+def sample_usage() -> dict:
+    """
+    Current RSS of the process and its running descendants, and used bytes of the /tmp file system
+    """
+    return {"peak_rss_bytes": _process_tree_rss(os.getpid()), "peak_tmp_bytes": _tmp_usage()}
+
+
+def _process_tree_rss(pid: int) -> int:
+    try:
+        pids = os.listdir("/proc")
+    except OSError:
+        return 0
+    children = {}
+    for other_pid in pids:
+        if not other_pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{other_pid}/stat") as f:
+                # The command name may contain spaces, fields after it are space separated (ppid is the second)
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(other_pid))
+
+    rss, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                rss += int(f.read().split()[1]) * _PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            pass
+        pending.extend(children.get(current, []))
+    return rss
+
+
+def _tmp_usage() -> int:
+    try:
+        return shutil.disk_usage(tempfile.gettempdir()).used
+    except OSError:
+        return 0
+
+
+def aggregate_stage_resources(*stats: dict) -> Dict[str, dict]:
+    """
+    Resource usage of the functions of each stage found in stats dumps (as returned by Stats.dump_dict): totals of
+    the CPU seconds and bytes, peaks of memory and /tmp usage, CPU utilization (CPU seconds per second, i.e. busy
+    cores), and the same metrics for each timer section of the functions. Stages without resource data are skipped.
+    """
+    stages = {}
+    for stats_dump in stats:
+        collect_stage_stats(stats_dump, stages)
+
+    aggregated = {}
+    for function_name, invocations in stages.items():
+        totals = [t for t in (_invocation_resources(invocation) for invocation in invocations) if t is not None]
+        if not totals:
+            continue
+        sections = {}
+        for invocation in invocations:
+            _collect_sections(invocation, sections)
+        aggregated[function_name] = {
+            "invocations": len(totals),
+            **_aggregate(totals),
+            "peak_rss_bytes_p95": float(np.percentile([t["peak_rss_bytes"] for t in totals], 95)),
+            "sections": {name: _aggregate(section) for name, section in sections.items()},
+        }
+    return aggregated
+
+
+def _invocation_resources(invocation: dict) -> Optional[dict]:
+    """
+    Resources of a whole invocation: its function timer, or its top level sections if it has none
+    """
+    function_timer = invocation["timers"].get("function", {})
+    if "resources" in function_timer:
+        return {"elapsed_s": function_timer["elapsed"], **function_timer["resources"]}
+    sections = [
+        {"elapsed_s": timer["elapsed"], **timer["resources"]}
+        for timer in invocation["timers"].values()
+        if "resources" in timer
+    ]
+    if not sections:
+        return None
+    return _aggregate(sections)
+
+
+def _collect_sections(stats: dict, sections: dict):
+    for name, timer in stats["timers"].items():
+        if name != "function" and "resources" in timer:
+            sections.setdefault(name, []).append({"elapsed_s": timer["elapsed"], **timer["resources"]})
+    for value in stats["values"].values():
+        if is_stats_dump(value):
+            _collect_sections(value, sections)
+
+
+def _aggregate(resources: List[dict]) -> dict:
+    aggregated = {"elapsed_s": sum(r["elapsed_s"] for r in resources)}
+    aggregated.update({metric: sum(r[metric] for r in resources) for metric in ADDITIVE_METRICS})
+    aggregated.update({metric: max(r[metric] for r in resources) for metric in PEAK_METRICS})
+    cpu_s = aggregated["cpu_user_s"] + aggregated["cpu_sys_s"]
+    aggregated["cpu_utilization"] = cpu_s / aggregated["elapsed_s"] if aggregated["elapsed_s"] > 0 else None
+    return aggregated
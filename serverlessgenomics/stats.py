@@ -1,14 +1,26 @@
 from __future__ import annotations
 
+import functools
 import logging
+import os
+import re
+import socket
 
 from lithops import Storage
 import time
 import json
 from copy import deepcopy
 
+from .resources import get_sampler
+
 logger = logging.getLogger(__name__)
 
+# Environment variables set by the invokers for every function invocation, to trace it
+STAGE_ENV = "SERVERLESS_GENOMICS_STAGE"
+INVOKED_AT_ENV = "SERVERLESS_GENOMICS_INVOKED_AT"
+# Seconds between resource usage samples, if set timers measure the resources used (see resources.py)
+SAMPLING_INTERVAL_ENV = "SERVERLESS_GENOMICS_SAMPLING_INTERVAL"
+
 
 class _ContextManagerTimer:
     def __init__(self, key: str, stats: Stats):
@@ -22,14 +34,63 @@ class _ContextManagerTimer:
         self.__stats.stop_timer(self.__key)
 
 
+def invocation_env(stage: str, extra_env: dict = None, sampling_interval: float = None) -> dict:
+    """
+    Environment of the functions of a stage that are invoked now, extra_env plus the stage name and invocation time
+    that Stats instances created in the functions record as their context, and the resource sampling interval
+    """
+    env = {**(extra_env or {}), STAGE_ENV: stage, INVOKED_AT_ENV: str(time.time())}
+    if sampling_interval is not None:
+        env[SAMPLING_INTERVAL_ENV] = str(sampling_interval)
+    return env
+
+
+@functools.lru_cache(maxsize=None)
+def _container_id() -> str:
+    """
+    Identifier of the container (execution environment) the process runs in, the hostname if it is not known
+    """
+    if "AWS_LAMBDA_LOG_STREAM_NAME" in os.environ:
+        return os.environ["AWS_LAMBDA_LOG_STREAM_NAME"]
+    try:
+        with open("/proc/self/cgroup") as f:
+            match = re.search(r"[0-9a-f]{64}", f.read())
+        if match is not None:
+            return match.group(0)[:12]
+    except OSError:
+        pass
+    return socket.gethostname()
+
+
 class Stats:
     def __init__(self):
         self.__timers = {}
         self.__values = {}
+        # Inside an invoked function, where and when it runs
+        self.__context = {}
+        if STAGE_ENV in os.environ:
+            self.__context = {
+                "stage": os.environ[STAGE_ENV],
+                "invoked_at": float(os.environ[INVOKED_AT_ENV]),
+                "host": socket.gethostname(),
+                "container": _container_id(),
+                "pid": os.getpid(),
+            }
+        # Resource sampling interval and open sections of the running timers (instances are returned by the
+        # functions, so they do not keep the sampler of the process)
+        self.__sampling_interval = None
+        self.__sections = {}
+        if SAMPLING_INTERVAL_ENV in os.environ:
+            self.__sampling_interval = float(os.environ[SAMPLING_INTERVAL_ENV])
 
     def start_timer(self, key):
         if key in self.__timers:
             logger.warning("Timer %s was already running, it will restart")
+        if self.__sampling_interval is not None:
+            sampler = get_sampler(self.__sampling_interval)
+            if key in self.__sections:
+                sampler.stop_section(self.__sections.pop(key))
+            self.__sections[key] = sampler.start_section()
         self.__timers[key] = {"t0": time.time(), "t0_perf_counter": time.perf_counter()}
 
     def stop_timer(self, key):
@@ -40,6 +101,9 @@ class Stats:
         self.__timers[key]["t1"] = time.time()
         self.__timers[key]["elapsed"] = time.perf_counter() - self.__timers[key]["t0_perf_counter"]
         del self.__timers[key]["t0_perf_counter"]
+        if key in self.__sections:
+            sampler = get_sampler(self.__sampling_interval)
+            self.__timers[key]["resources"] = sampler.stop_section(self.__sections.pop(key))
 
     def set_value(self, key, value):
         if key in self.__values:
@@ -52,8 +116,16 @@ class Stats:
         else:
             self.__values[key] += delta
 
+    def update_value(self, key, values: dict):
+        if key not in self.__values:
+            self.__values[key] = {}
+        self.__values[key].update(values)
+
     def timeit(self, key):
         return _ContextManagerTimer(key, self)
 
     def dump_dict(self):
-        return {"timers": self.__timers, "values": self.__values}
+        dump = {"timers": self.__timers, "values": self.__values}
+        if self.__context:
+            dump["context"] = self.__context
+        return dump
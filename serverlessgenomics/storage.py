@@ -0,0 +1,361 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from typing import TYPE_CHECKING
+
+from lithops.storage.utils import StorageNoSuchKeyError
+
+from .utils import get_s3_client
+
+if TYPE_CHECKING:
+    from typing import BinaryIO, Iterator, List, Optional
+    import lithops
+    from .pipeline import PipelineParameters
+
+# Block size for copying object bodies
+_COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def get_pipeline_storage(storage, pipeline_params: PipelineParameters = None) -> ObjectStorage:
+    """
+    Pipeline storage interface of a storage instance injected by the executor: Lithops storage is wrapped in an
+    S3Storage, pipeline storage instances (e.g. LocalStorage) are returned as they are
+    """
+    if isinstance(storage, ObjectStorage):
+        return storage
+    return S3Storage(storage, pipeline_params)
+
+
+class ObjectStorage:
+    """
+    Storage interface of the pipeline: the object operations of lithops.Storage (get_object, put_object,
+    head_object, list_keys, list_objects, delete_objects, upload_file, download_file), plus range reads,
+    multipart uploads composed from numbered parts, and TSV row selection.
+    Row selection is filtered on the client from a streamed object, backends that support select pushdown
+    override it to filter in the server.
+    """
+
+    def get_range(self, bucket: str, key: str, start: int, end: int) -> BinaryIO:
+        """
+        Stream of the bytes [start, end) of an object
+        """
+        return self.get_object(bucket, key, stream=True, extra_get_args={"Range": f"bytes={start}-{end - 1}"})
+
+    def select_rows(self, bucket: str, key: str, column: int, start: int, end: int) -> Iterator[bytes]:
+        """
+        Rows of a TSV object whose integer value in column (starting at 1) is between start and end, both included.
+        Yields blocks of rows, a row can be split between blocks.
+        """
+        return _select_tsv(self.get_object(bucket, key, stream=True), column, start, end, project=False)
+
+    def select_column(self, bucket: str, key: str, column: int) -> Iterator[bytes]:
+        """
+        Integer values of a column (starting at 1) of a TSV object, one per line. Yields blocks of lines, a line can
+        be split between blocks.
+        """
+        return _select_tsv(self.get_object(bucket, key, stream=True), column, project=True)
+
+
+class S3Storage(ObjectStorage):
+    """
+    Pipeline storage on S3 or an S3 compatible service (e.g. MinIO), through a Lithops storage instance and a pooled
+    boto3 client for its endpoint. Row selection is pushed down to S3 Select, unless it is disabled in the pipeline
+    parameters for services that do not support it.
+    """
+
+    def __init__(self, storage: lithops.Storage, pipeline_params: PipelineParameters = None):
+        self.__storage = storage
+        self.__s3 = get_s3_client(storage, pipeline_params)
+        self.__select_pushdown = getattr(pipeline_params, "storage_select_pushdown", True)
+
+    def __getattr__(self, name):
+        # Object operations not overridden here are the ones of the Lithops storage
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.__storage, name)
+
+    def get_range(self, bucket: str, key: str, start: int, end: int) -> BinaryIO:
+        return self.__s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}")["Body"]
+
+    def put_object(self, bucket: str, key: str, body, metadata: dict = None):
+        self.__s3.put_object(Bucket=bucket, Key=key, Body=body, Metadata=metadata or {})
+
+    def upload_file(self, file_name: str, bucket: str, key: Optional[str] = None, metadata: dict = None):
+        # Managed transfer, large files are uploaded with concurrent multipart uploads
+        extra_args = {"Metadata": metadata} if metadata else None
+        self.__s3.upload_file(file_name, bucket, key or os.path.basename(file_name), ExtraArgs=extra_args)
+
+    def upload_fileobj(self, fileobj: BinaryIO, bucket: str, key: str, metadata: dict = None):
+        extra_args = {"Metadata": metadata} if metadata else None
+        self.__s3.upload_fileobj(Fileobj=fileobj, Bucket=bucket, Key=key, ExtraArgs=extra_args)
+
+    def download_fileobj(self, bucket: str, key: str, fileobj: BinaryIO):
+        self.__s3.download_fileobj(Bucket=bucket, Key=key, Fileobj=fileobj)
+
+    def create_multipart_upload(self, bucket: str, key: str) -> str:
+        return self.__s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def upload_part(self, bucket: str, key: str, upload_id: str, part_number: int, body) -> str:
+        part = self.__s3.upload_part(Body=body, Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number)
+        return part["ETag"]
+
+    def get_part_etag(self, bucket: str, key: str, upload_id: str, part_number: int) -> Optional[str]:
+        parts = self.__s3.list_parts(
+            Bucket=bucket, Key=key, UploadId=upload_id, PartNumberMarker=part_number - 1, MaxParts=1
+        )
+        for part in parts.get("Parts", []):
+            if part["PartNumber"] == part_number:
+                return part["ETag"]
+        return None
+
+    def complete_multipart_upload(self, bucket: str, key: str, upload_id: str, parts: List[dict]):
+        self.__s3.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+        )
+
+    def select_rows(self, bucket: str, key: str, column: int, start: int, end: int) -> Iterator[bytes]:
+        if not self.__select_pushdown:
+            return super().select_rows(bucket, key, column, start, end)
+        expression = f"SELECT * FROM s3object s WHERE cast(s._{column} as int) BETWEEN {start} AND {end}"
+        return self.__select(bucket, key, expression, {"CSV": {"FieldDelimiter": "\t"}})
+
+    def select_column(self, bucket: str, key: str, column: int) -> Iterator[bytes]:
+        if not self.__select_pushdown:
+            return super().select_column(bucket, key, column)
+        expression = f"SELECT cast(s._{column} as int) FROM s3object s"
+        return self.__select(bucket, key, expression, {"CSV": {}})
+
+    def __select(self, bucket: str, key: str, expression: str, output_serialization: dict) -> Iterator[bytes]:
+        resp = self.__s3.select_object_content(
+            Bucket=bucket,
+            Key=key,
+            ExpressionType="SQL",
+            Expression=expression,
+            InputSerialization={"CSV": {"RecordDelimiter": "\n", "FieldDelimiter": "\t"}, "CompressionType": "NONE"},
+            OutputSerialization=output_serialization,
+        )
+        return (event["Records"]["Payload"] for event in resp["Payload"] if "Records" in event)
+
+
+class LocalStorage(ObjectStorage):
+    """
+    Object storage on the local filesystem, with the subset of the lithops.Storage API used by the pipeline.
+    Objects are files at <root>/<bucket>/<key>, so functions running in local processes exchange intermediate data
+    through the local disk. Object metadata and the parts of multipart uploads are kept in hidden directories of
+    the root, outside of the buckets.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(os.path.expanduser(root))
+
+    def path(self, bucket: str, key: str) -> str:
+        """
+        Local file path of an object
+        """
+        return os.path.join(self.root, bucket, key)
+
+    def __metadata_path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, ".metadata", bucket, key + ".json")
+
+    def __multipart_dir(self, upload_id: str) -> str:
+        return os.path.join(self.root, ".multipart", upload_id)
+
+    def __existing_path(self, bucket: str, key: str) -> str:
+        path = self.path(bucket, key)
+        if not os.path.isfile(path):
+            raise StorageNoSuchKeyError(bucket, key)
+        return path
+
+    def get_object(self, bucket: str, key: str, stream: bool = False, extra_get_args: dict = None):
+        path = self.__existing_path(bucket, key)
+        start, end = 0, None
+        if extra_get_args and "Range" in extra_get_args:
+            # HTTP range "bytes=start-end", end is inclusive and optional
+            first, last = extra_get_args["Range"].replace("bytes=", "").split("-")
+            start, end = int(first), int(last) + 1 if last else None
+
+        f = open(path, "rb")
+        f.seek(start)
+        if stream:
+            return _RangeFile(f, None if end is None else end - start)
+        with f:
+            return f.read() if end is None else f.read(max(end - start, 0))
+
+    def put_object(self, bucket: str, key: str, body, metadata: dict = None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        with _AtomicFile(self.path(bucket, key)) as f:
+            if hasattr(body, "read"):
+                shutil.copyfileobj(body, f, _COPY_BLOCK_SIZE)
+            else:
+                f.write(body)
+        self.__put_metadata(bucket, key, metadata)
+
+    def head_object(self, bucket: str, key: str) -> dict:
+        st = os.stat(self.__existing_path(bucket, key))
+        head = {"content-length": str(st.st_size), "etag": f'"{st.st_mtime_ns:x}-{st.st_size:x}"'}
+        metadata_path = self.__metadata_path(bucket, key)
+        if os.path.isfile(metadata_path):
+            with open(metadata_path, "r") as metadata_file:
+                head.update({f"x-amz-meta-{k}": v for k, v in json.load(metadata_file).items()})
+        return head
+
+    def list_objects(self, bucket: str, prefix: Optional[str] = None) -> List[dict]:
+        bucket_dir = os.path.join(self.root, bucket)
+        objects = []
+        for dirpath, _, filenames in os.walk(bucket_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, bucket_dir)
+                if filename.startswith(".tmp-") or (prefix and not key.startswith(prefix)):
+                    continue
+                st = os.stat(path)
+                objects.append({"Key": key, "Size": st.st_size, "LastModified": st.st_mtime})
+        return sorted(objects, key=lambda obj: obj["Key"])
+
+    def list_keys(self, bucket: str, prefix: Optional[str] = None) -> List[str]:
+        return [obj["Key"] for obj in self.list_objects(bucket, prefix)]
+
+    def delete_objects(self, bucket: str, key_list: List[str]):
+        for key in key_list:
+            for path in (self.path(bucket, key), self.__metadata_path(bucket, key)):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def upload_file(self, file_name: str, bucket: str, key: Optional[str] = None, metadata: dict = None):
+        with open(file_name, "rb") as f:
+            self.put_object(bucket, key or os.path.basename(file_name), f, metadata)
+
+    def upload_fileobj(self, fileobj: BinaryIO, bucket: str, key: str, metadata: dict = None):
+        self.put_object(bucket, key, fileobj, metadata)
+
+    def download_file(self, bucket: str, key: str, file_name: Optional[str] = None):
+        shutil.copyfile(self.__existing_path(bucket, key), file_name or os.path.basename(key))
+
+    def download_fileobj(self, bucket: str, key: str, fileobj: BinaryIO):
+        with open(self.__existing_path(bucket, key), "rb") as f:
+            shutil.copyfileobj(f, fileobj, _COPY_BLOCK_SIZE)
+
+    def create_multipart_upload(self, bucket: str, key: str) -> str:
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self.__multipart_dir(upload_id))
+        return upload_id
+
+    def upload_part(self, bucket: str, key: str, upload_id: str, part_number: int, body) -> str:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        with _AtomicFile(os.path.join(self.__multipart_dir(upload_id), str(part_number))) as f:
+            f.write(body)
+        return f'"{hashlib.md5(body).hexdigest()}"'
+
+    def get_part_etag(self, bucket: str, key: str, upload_id: str, part_number: int) -> Optional[str]:
+        part_path = os.path.join(self.__multipart_dir(upload_id), str(part_number))
+        if not os.path.isfile(part_path):
+            return None
+        with open(part_path, "rb") as f:
+            return f'"{hashlib.md5(f.read()).hexdigest()}"'
+
+    def complete_multipart_upload(self, bucket: str, key: str, upload_id: str, parts: List[dict]):
+        """
+        Compose the object from the uploaded parts, in part number order
+        """
+        upload_dir = self.__multipart_dir(upload_id)
+        with _AtomicFile(self.path(bucket, key)) as f:
+            for part in sorted(parts, key=lambda p: p["PartNumber"]):
+                with open(os.path.join(upload_dir, str(part["PartNumber"])), "rb") as part_file:
+                    shutil.copyfileobj(part_file, f, _COPY_BLOCK_SIZE)
+        self.__put_metadata(bucket, key, None)
+        shutil.rmtree(upload_dir)
+
+    def __put_metadata(self, bucket: str, key: str, metadata: Optional[dict]):
+        metadata_path = self.__metadata_path(bucket, key)
+        if metadata:
+            with _AtomicFile(metadata_path) as f:
+                f.write(json.dumps(metadata).encode("utf-8"))
+        elif os.path.isfile(metadata_path):
+            os.remove(metadata_path)
+
+
+class _AtomicFile:
+    """
+    Context manager of a file that is written to a temporary file in the same directory, and renamed to its path
+    when it is closed without errors. Readers never see partial files.
+    """
+
+    def __init__(self, path: str):
+        self.__path = path
+
+    def __enter__(self) -> BinaryIO:
+        os.makedirs(os.path.dirname(self.__path), exist_ok=True)
+        fd, self.__tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.__path), prefix=".tmp-")
+        self.__f = os.fdopen(fd, "wb")
+        return self.__f
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__f.close()
+        if exc_type is None:
+            os.replace(self.__tmp_path, self.__path)
+        else:
+            os.remove(self.__tmp_path)
+
+
+class _RangeFile:
+    """
+    Read-only file object limited to a number of bytes from its current position
+    """
+
+    def __init__(self, f, length: Optional[int]):
+        self.__f = f
+        self.__remaining = length
+
+    def read(self, n: int = -1) -> bytes:
+        if self.__remaining is not None:
+            n = self.__remaining if n < 0 else min(n, self.__remaining)
+        data = self.__f.read(n)
+        if self.__remaining is not None:
+            self.__remaining -= len(data)
+        if not data:
+            self.close()
+        return data
+
+    def close(self):
+        self.__f.close()
+
+
+def _select_tsv(
+    stream: BinaryIO, column: int, start: int = None, end: int = None, project: bool = False
+) -> Iterator[bytes]:
+    """
+    Filter the rows of a TSV stream by the integer value of a column, in blocks of rows.
+    With project, only the values of the column are returned.
+    """
+    pending = b""
+    for block in iter(lambda: stream.read(_COPY_BLOCK_SIZE), b""):
+        block = pending + block
+        # Keep the last incomplete line for the next block
+        cut = block.rfind(b"\n") + 1
+        pending = block[cut:]
+        selected = _select_tsv_lines(block[:cut], column, start, end, project)
+        if selected:
+            yield selected
+    if pending:
+        selected = _select_tsv_lines(pending + b"\n", column, start, end, project)
+        if selected:
+            yield selected
+
+
+def _select_tsv_lines(lines: bytes, column: int, start: Optional[int], end: Optional[int], project: bool) -> bytes:
+    selected = []
+    for line in lines.splitlines(keepends=True):
+        fields = line.split(b"\t", column)
+        if len(fields) < column:
+            continue
+        value = int(fields[column - 1].rstrip(b"\r\n"))
+        if (start is None or value >= start) and (end is None or value <= end):
+            selected.append(b"%d\n" % value if project else line)
+    return b"".join(selected)
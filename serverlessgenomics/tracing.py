@@ -0,0 +1,294 @@
+"""
+Timeline traces of pipeline runs, built from the timers of their stats.
+
+Every timer of the stats dump of a run becomes a span. Lists of function stats ("<function name>_stats" values) are
+the invocations of a stage: each one gets a span from its first timer start to its last timer end, and the time
+between the invocation and the start of the function is its queue time. Traces can be exported in the Chrome trace
+event format, that chrome://tracing and https://ui.perfetto.dev open, and summarized per stage. Usage with the stats
+saved by a previous run:
+
+    python -m serverlessgenomics.tracing stats.json --run-id my-run --trace trace.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from .profiles import is_stats_dump, stats_key_function
+
+if TYPE_CHECKING:
+    from typing import Dict, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Stage of the spans of the pipeline host (the process that invokes the functions)
+DRIVER_STAGE = "driver"
+
+
+@dataclass
+class Span:
+    # Timer name, or the stage name for invocation spans
+    name: str
+    # Function name of the stage, or DRIVER_STAGE
+    stage: str
+    # Pipeline run the span belongs to
+    run_id: Optional[str]
+    # Invocation the span belongs to (mapper_id value of the function stats, or position in its stage), None for
+    # driver spans
+    mapper_id: Optional[Union[str, int]]
+    # Epoch times of the start and end of the span
+    start: float
+    end: float
+    # Whether the span covers a whole function invocation, or a step of it
+    invocation: bool = False
+    # Epoch time the invocation was submitted, if known (host and function clocks may differ)
+    invoked_at: Optional[float] = None
+    # Where the function ran
+    host: Optional[str] = None
+    container: Optional[str] = None
+    pid: Optional[int] = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    @property
+    def queue_time(self) -> Optional[float]:
+        if self.invoked_at is None:
+            return None
+        return max(self.start - self.invoked_at, 0.0)
+
+
+def collect_spans(stats: dict, run_id: str = None) -> List[Span]:
+    """
+    Spans of the timers of a stats dump (as returned by Stats.dump_dict) of a pipeline run
+    """
+    spans = []
+    _collect(stats, spans, run_id, DRIVER_STAGE, None, {})
+    return sorted(spans, key=lambda span: span.start)
+
+
+def _collect(stats: dict, spans: list, run_id: str, stage: str, mapper_id, location: dict, skip_timers=()):
+    for name, timer in stats["timers"].items():
+        if "t1" in timer and name not in skip_timers:
+            spans.append(Span(name, stage, run_id, mapper_id, timer["t0"], timer["t1"], **location))
+
+    for key, value in stats["values"].items():
+        if is_stats_dump(value):
+            # Stats of a step, in the same function
+            _collect(value, spans, run_id, stage, mapper_id, location)
+        elif key.endswith("_stats") and isinstance(value, list) and all(is_stats_dump(v) for v in value):
+            for i, invocation_stats in enumerate(value):
+                _collect_invocation(invocation_stats, spans, run_id, stats_key_function(key), i)
+
+
+def _collect_invocation(stats: dict, spans: list, run_id: str, stage: str, position: int):
+    timers = [timer for timer in stats["timers"].values() if "t1" in timer]
+    if not timers:
+        # Skipped invocations (e.g. outputs already completed)
+        return
+    context = stats.get("context", {})
+    stage = context.get("stage", stage)
+    mapper_id = stats["values"].get("mapper_id", position)
+    location = {key: context.get(key) for key in ("host", "container", "pid")}
+    start, end = min(timer["t0"] for timer in timers), max(timer["t1"] for timer in timers)
+    spans.append(Span(stage, stage, run_id, mapper_id, start, end, True, context.get("invoked_at"), **location))
+    # The function timer spans the whole invocation
+    _collect(stats, spans, run_id, stage, mapper_id, location, skip_timers=("function",))
+
+
+def to_chrome_trace(spans: List[Span]) -> dict:
+    """
+    Chrome trace event format (JSON object format) of spans. Each run and stage is a process of the trace and each
+    invocation a thread, with the time it was queued before it started as a separate event.
+    """
+    if not spans:
+        return {"traceEvents": [], "displayTimeUnit": "ms"}
+    origin = min(min(span.start, span.invoked_at or span.start) for span in spans)
+
+    def _us(t):
+        return round((t - origin) * 1e6, 3)
+
+    events = []
+    pids, tids = {}, {}
+    for span in spans:
+        lane = (span.run_id, span.stage)
+        if lane not in pids:
+            pids[lane] = len(pids) + 1
+            name = span.stage if span.run_id is None else f"{span.run_id} {span.stage}"
+            events.append({"ph": "M", "name": "process_name", "pid": pids[lane], "args": {"name": name}})
+            events.append(
+                {"ph": "M", "name": "process_sort_index", "pid": pids[lane], "args": {"sort_index": pids[lane]}}
+            )
+        pid = pids[lane]
+        if span.mapper_id is None:
+            tid = 0
+        else:
+            tid = tids.setdefault((lane, span.mapper_id), len(tids) + 1)
+
+        args = {"run_id": span.run_id, "stage": span.stage, "mapper_id": span.mapper_id}
+        if span.invocation:
+            args.update({"host": span.host, "container": span.container, "pid": span.pid, "queue_s": span.queue_time})
+            events.append(
+                {"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": f"mapper {span.mapper_id}"}}
+            )
+            if span.queue_time:
+                events.append(
+                    {
+                        "name": "queued",
+                        "cat": "queue",
+                        "ph": "X",
+                        "ts": _us(span.invoked_at),
+                        "dur": round(span.queue_time * 1e6, 3),
+                        "pid": pid,
+                        "tid": tid,
+                        "args": args,
+                    }
+                )
+        events.append(
+            {
+                "name": span.name,
+                "cat": "invocation" if span.invocation else "step",
+                "ph": "X",
+                "ts": _us(span.start),
+                "dur": round(span.duration * 1e6, 3),
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"origin_epoch": origin}}
+
+
+def summarize(spans: List[Span]) -> Dict[str, dict]:
+    """
+    Per run summary of the invocations of each stage (duration and queue time percentiles, peak concurrency) and of
+    the critical path: the last invocation to finish of each stage, which the next stage waits for
+    """
+    invocations = {}
+    for span in spans:
+        if span.invocation:
+            invocations.setdefault(span.run_id, {}).setdefault(span.stage, []).append(span)
+
+    summary = {}
+    for run_id, stages in invocations.items():
+        run_spans = [span for span in spans if span.run_id == run_id]
+        run_start = min(min(s.start, s.invoked_at or s.start) for s in run_spans)
+        run_end = max(s.end for s in run_spans)
+        stage_summaries = {}
+        critical_path = []
+        for stage, stage_spans in sorted(stages.items(), key=lambda item: min(s.start for s in item[1])):
+            durations = np.array([s.duration for s in stage_spans])
+            queue_times = np.array([s.queue_time for s in stage_spans if s.queue_time is not None])
+            stage_summaries[stage] = {
+                "invocations": len(stage_spans),
+                "wall_s": max(s.end for s in stage_spans) - min(s.invoked_at or s.start for s in stage_spans),
+                "max_concurrency": _max_concurrency(stage_spans),
+                "duration_s": _percentiles(durations),
+                "queue_s": _percentiles(queue_times),
+            }
+            last = max(stage_spans, key=lambda s: s.end)
+            critical_path.append(
+                {
+                    "stage": stage,
+                    "mapper_id": last.mapper_id,
+                    "host": last.host,
+                    "queue_s": last.queue_time,
+                    "duration_s": last.duration,
+                }
+            )
+        functions_s = sum(step["duration_s"] + (step["queue_s"] or 0) for step in critical_path)
+        summary[run_id] = {
+            "wall_s": run_end - run_start,
+            "stages": stage_summaries,
+            "critical_path": critical_path,
+            # Time of the run outside the critical path invocations, spent in the driver
+            "driver_s": max(run_end - run_start - functions_s, 0.0),
+        }
+    return summary
+
+
+def _percentiles(values: np.ndarray) -> dict:
+    if len(values) == 0:
+        return {"p50": None, "p95": None, "max": None}
+    p50, p95 = np.percentile(values, [50, 95])
+    return {"p50": float(p50), "p95": float(p95), "max": float(values.max())}
+
+
+def _max_concurrency(spans: List[Span]) -> int:
+    # Sweep of the start (+1) and end (-1) events, ends first on ties
+    events = sorted([(s.start, 1) for s in spans] + [(s.end, -1) for s in spans])
+    running = peak = 0
+    for _, delta in events:
+        running += delta
+        peak = max(peak, running)
+    return peak
+
+
+def format_summary(summary: Dict[str, dict]) -> str:
+    def _fmt(value):
+        return "-" if value is None else f"{value:.2f}"
+
+    lines = []
+    for run_id, run_summary in summary.items():
+        lines.append(f"Run {run_id}: {run_summary['wall_s']:.2f} s")
+        lines.append(
+            f"  {'stage':<28}{'n':>6}{'conc':>6}{'wall s':>9}{'p50 s':>9}{'p95 s':>9}{'max s':>9}"
+            f"{'queue p50':>11}{'queue max':>11}"
+        )
+        for stage, stage_summary in run_summary["stages"].items():
+            duration, queue = stage_summary["duration_s"], stage_summary["queue_s"]
+            lines.append(
+                f"  {stage:<28}{stage_summary['invocations']:>6}{stage_summary['max_concurrency']:>6}"
+                f"{stage_summary['wall_s']:>9.2f}{_fmt(duration['p50']):>9}{_fmt(duration['p95']):>9}"
+                f"{_fmt(duration['max']):>9}{_fmt(queue['p50']):>11}{_fmt(queue['max']):>11}"
+            )
+        lines.append("  Critical path:")
+        for step in run_summary["critical_path"]:
+            lines.append(
+                f"    {step['stage']} mapper {step['mapper_id']} on {step['host'] or '-'}: "
+                f"queued {_fmt(step['queue_s'])} s, ran {step['duration_s']:.2f} s"
+            )
+        lines.append(f"    driver (outside the critical path invocations): {run_summary['driver_s']:.2f} s")
+    return "\n".join(lines)
+
+
+def export_trace(spans: List[Span], filename: str) -> Dict[str, dict]:
+    """
+    Write the Chrome trace of spans to filename, and return their summary
+    """
+    with open(filename, "w") as f:
+        json.dump(to_chrome_trace(spans), f)
+    summary = summarize(spans)
+    logger.info("Trace of %d spans written to %s\n%s", len(spans), filename, format_summary(summary))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Timeline trace and summary of the stats of a pipeline run")
+    parser.add_argument("stats", help="JSON file with the stats of the run (Stats.dump_dict of the pipeline)")
+    parser.add_argument("--run-id", help="run ID to tag the spans with")
+    parser.add_argument("--trace", help="write the Chrome trace (Perfetto) JSON to this file")
+    parser.add_argument("--summary", help="write the summary as JSON to this file")
+    args = parser.parse_args(argv)
+
+    with open(args.stats) as f:
+        spans = collect_spans(json.load(f), args.run_id)
+    if args.trace is not None:
+        with open(args.trace, "w") as f:
+            json.dump(to_chrome_trace(spans), f)
+    summary = summarize(spans)
+    if args.summary is not None:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+    print(format_summary(summary))
+
+
+if __name__ == "__main__":
+    main()
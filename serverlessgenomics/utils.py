@@ -11,7 +11,9 @@ from typing import TYPE_CHECKING, Union
 from dataclasses import asdict
 from pprint import pformat
 
+import boto3
 import lithops
+from botocore.config import Config
 from lithops.storage.utils import StorageNoSuchKeyError
 
 # from .preprocessing.preprocess_fasta import create_fasta_chunk_for_runtime
@@ -139,6 +141,61 @@ def try_head_object(storage: lithops.Storage, bucket: str, key: str):
         return None
 
 
+# Storage clients of this process, keyed by backend, endpoint, credentials and connection settings. Kept at module
+# level so that warm functions and all driver code paths reuse the same connection pool
+_s3_clients = {}
+
+
+def get_s3_client(storage: lithops.Storage, pipeline_params: PipelineParameters = None):
+    """
+    Get a pooled boto3 S3 client for the same endpoint and credentials as a Lithops storage instance, with the pool
+    size, keep-alive and retry settings of the pipeline parameters (or their defaults if they are not available)
+    """
+    from .pipeline import PipelineParameters
+
+    defaults = PipelineParameters.__dataclass_fields__
+    settings = tuple(
+        getattr(pipeline_params, name, defaults[name].default)
+        for name in (
+            "storage_max_pool_connections",
+            "storage_tcp_keepalive",
+            "storage_max_attempts",
+            "storage_retry_mode",
+        )
+    )
+    # Connection settings of the active storage backend section of the Lithops config (e.g. aws_s3, minio or ceph).
+    # Credentials set there, or in the aws section, are used, otherwise the default chain (e.g. function role)
+    config = getattr(storage, "config", {})
+    backend = getattr(storage, "backend", None)
+    backend_config = {**config.get("aws", {}), **config.get(backend, {})}
+    credentials = tuple(backend_config.get(name) for name in ("access_key_id", "secret_access_key", "session_token"))
+    key = (
+        backend,
+        backend_config.get("endpoint"),
+        backend_config.get("region") or backend_config.get("region_name"),
+        credentials,
+        settings,
+    )
+    if key not in _s3_clients:
+        max_pool_connections, tcp_keepalive, max_attempts, retry_mode = settings
+        base_client = storage.get_client()
+        access_key_id, secret_access_key, session_token = credentials
+        _s3_clients[key] = boto3.client(
+            "s3",
+            endpoint_url=base_client.meta.endpoint_url,
+            region_name=base_client.meta.region_name,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            aws_session_token=session_token,
+            config=Config(
+                max_pool_connections=max_pool_connections,
+                tcp_keepalive=tcp_keepalive,
+                retries={"max_attempts": max_attempts, "mode": retry_mode},
+            ),
+        )
+    return _s3_clients[key]
+
+
 def try_get_object(
     storage: lithops.Storage,
     bucket: str,
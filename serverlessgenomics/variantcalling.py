@@ -1,25 +1,26 @@
 import logging
 
-import lithops
-
-from .mapping.map_caller import run_full_alignment
+from .mapping.map_caller import run_full_alignment, run_batch_alignment
 from .preprocessing import (
     prepare_fastq_chunks,
     prepare_fasta_chunks,
     prepare_gem_chunks,
+    prepare_sketch_chunks,
 )
-from .reducer.reduce_caller import run_reducer
+from .datasource.sources.sra import get_sra_metadata_batch
+from .reducer.reduce_caller import run_batch_reducer, run_reducer
+from .resources import aggregate_stage_resources
 from .stats import Stats
+from .tracing import collect_spans, export_trace
 
 from .pipeline import (
     PipelineParameters,
     PipelineRun,
-    Lithops,
     validate_parameters,
     new_pipeline_run,
+    new_lithops,
 )
 from .utils import setup_logging, get_storage_tmp_prefix
-from .lithopswrapper import LithopsInvokerWrapper
 
 logger = logging.getLogger(__name__)
 
@@ -34,9 +35,7 @@ class VariantCallingPipeline:
         self.state: PipelineRun = new_pipeline_run(self.parameters, run_id)
         self.global_stat = Stats()
 
-        invoker = LithopsInvokerWrapper(self.parameters.lithops_settings)
-        storage = lithops.Storage()
-        self.lithops = Lithops(storage=storage, invoker=invoker)
+        self.lithops = new_lithops(self.parameters)
 
     def preprocess(self):
         """
@@ -51,11 +50,15 @@ class VariantCallingPipeline:
         self.state.fasta_chunks = fasta_chunks
 
         with self.global_stat.timeit("prepare_gem_chunks"):
-            self.state.gem_chunk_ids, gem_stats = prepare_gem_chunks(
-                self.parameters, self.state.fasta_chunks, self.lithops
-            )
+            self.state.gem_keys, gem_stats = prepare_gem_chunks(self.parameters, self.state.fasta_chunks, self.lithops)
         self.global_stat.set_value("gem_stats", [s.dump_dict() for s in gem_stats])
 
+        if self.parameters.read_routing:
+            with self.global_stat.timeit("prepare_sketch_chunks"):
+                sketch_stats = prepare_sketch_chunks(self.parameters, self.state.fasta_chunks, self.lithops)
+            self.global_stat.set_value("sketch_stats", [s.dump_dict() for s in sketch_stats])
+        self.__aggregate_resources()
+
     def alignment(self):
         """
         Alignment map pipeline step
@@ -63,6 +66,7 @@ class VariantCallingPipeline:
         with self.global_stat.timeit("run_full_alignment"):
             stats = run_full_alignment(self.parameters, self.state, self.lithops)
         self.global_stat.set_value("alignment_stats", stats.dump_dict())
+        self.__aggregate_resources()
 
     def reduce(self):
         with self.global_stat.timeit("run_reducer"):
@@ -79,6 +83,27 @@ class VariantCallingPipeline:
                 self.lithops,
             )
         self.global_stat.set_value("reduce_stats", stats.dump_dict())
+        self.__aggregate_resources()
+
+    def __aggregate_resources(self):
+        """
+        Aggregate the resource usage of the functions run so far per stage, if resource sampling is enabled
+        """
+        if self.parameters.resource_sampling_interval is not None:
+            self.global_stat.update_value("resources", aggregate_stage_resources(self.global_stat.dump_dict()))
+
+    def trace_spans(self):
+        """
+        Spans of every stage and function invocation of the run, see tracing.collect_spans
+        """
+        return collect_spans(self.global_stat.dump_dict(), self.state.run_id)
+
+    def export_trace(self, filename: str) -> dict:
+        """
+        Write the timeline of the run as a Chrome trace (open it in https://ui.perfetto.dev) and return the per stage
+        summary
+        """
+        return export_trace(self.trace_spans(), filename)
 
     def pipeline_stats(self):
         stats, params = PipelineRunStats(), PipelineRunStats()
@@ -110,9 +135,7 @@ class VariantCallingPipeline:
 
     def clean_all(self):
         logger.info("Going to delete all FASTQGZ Indexes")
-        keys = self.lithops.storage.list_keys(
-            self.parameters.storage_bucket, prefix=self.parameters.fastqgz_idx_prefix
-        )
+        keys = self.lithops.storage.list_keys(self.parameters.storage_bucket, prefix=self.parameters.fastqgz_idx_prefix)
         self.lithops.storage.delete_objects(self.parameters.storage_bucket, keys)
 
         logger.info("Going to delete all FAIDX Indexes")
@@ -122,3 +145,126 @@ class VariantCallingPipeline:
         logger.info("Going to delete all GEM Indexes")
         keys = self.lithops.storage.list_keys(self.parameters.storage_bucket, prefix=self.parameters.gem_index_prefix)
         self.lithops.storage.delete_objects(self.parameters.storage_bucket, keys)
+
+        logger.info("Going to delete all cached SRA metadata")
+        keys = self.lithops.storage.list_keys(
+            self.parameters.storage_bucket, prefix=self.parameters.sra_metadata_prefix
+        )
+        self.lithops.storage.delete_objects(self.parameters.storage_bucket, keys)
+
+        logger.info("Going to delete all prefetched SRA files")
+        keys = self.lithops.storage.list_keys(self.parameters.storage_bucket, prefix=self.parameters.sra_prefix)
+        self.lithops.storage.delete_objects(self.parameters.storage_bucket, keys)
+
+
+class VariantCallingBatch:
+    """
+    Run the pipeline for many samples (FASTQ inputs) against the same reference genome.
+    The reference is preprocessed once and the alignment invocations of all samples are packed
+    into shared map calls. Each sample gets its own run ID, final output and stats.
+    """
+
+    def __init__(self, samples, **parameters):
+        batch_id = parameters.pop("run_id", None)
+        sample_keys = {"fastq_path", "sra_accession", "fastq_chunks", "fastq_chunk_range", "run_id"}
+
+        self.runs = []
+        for i, sample in enumerate(samples):
+            assert set(sample).issubset(sample_keys), f"Invalid sample parameters {set(sample) - sample_keys}"
+            sample_params = {**parameters, **sample}
+            run_id = sample_params.pop("run_id", None)
+            if run_id is None and batch_id is not None:
+                run_id = f"{batch_id}-{i}"
+            pipeline_params = validate_parameters(sample_params)
+            self.runs.append((pipeline_params, new_pipeline_run(pipeline_params, run_id)))
+
+        # All samples share the reference genome parameters, use the first sample for the reference stages
+        self.parameters: PipelineParameters = self.runs[0][0]
+        setup_logging(self.parameters.log_level)
+        logger.info("Init Serverless Variant Calling Pipeline batch with %d samples", len(self.runs))
+
+        self.global_stat = Stats()
+        self.sample_stats = {run.run_id: Stats() for _, run in self.runs}
+
+        self.lithops = new_lithops(self.parameters)
+
+    def preprocess(self):
+        """
+        Prepare reference genome once, and FASTQ chunks for every sample
+        """
+        with self.global_stat.timeit("prepare_fasta_chunks"):
+            fasta_chunks = prepare_fasta_chunks(self.parameters, self.lithops)
+
+        with self.global_stat.timeit("prepare_gem_chunks"):
+            gem_keys, gem_stats = prepare_gem_chunks(self.parameters, fasta_chunks, self.lithops)
+        self.global_stat.set_value("gem_stats", [s.dump_dict() for s in gem_stats])
+
+        if self.parameters.read_routing:
+            with self.global_stat.timeit("prepare_sketch_chunks"):
+                sketch_stats = prepare_sketch_chunks(self.parameters, fasta_chunks, self.lithops)
+            self.global_stat.set_value("sketch_stats", [s.dump_dict() for s in sketch_stats])
+
+        # Look up the metadata of all SRA samples in one request, prepare_fastq_chunks reads it from the cache
+        sra_accessions = [p.sra_accession for p, _ in self.runs if p.fastq_path is None]
+        if sra_accessions:
+            with self.global_stat.timeit("get_sra_metadata"):
+                get_sra_metadata_batch(self.parameters, self.lithops.storage, sra_accessions)
+
+        for pipeline_params, run in self.runs:
+            with self.sample_stats[run.run_id].timeit("prepare_fastq_chunks"):
+                run.fastq_chunks = prepare_fastq_chunks(pipeline_params, self.lithops)
+            run.fasta_chunks = fasta_chunks
+            run.gem_keys = gem_keys
+        self.__aggregate_resources()
+
+    def alignment(self):
+        """
+        Alignment map pipeline step for all samples in shared map calls
+        """
+        with self.global_stat.timeit("run_batch_alignment"):
+            runs_stats = run_batch_alignment(self.runs, self.lithops)
+        for (_, run), stats in zip(self.runs, runs_stats):
+            self.sample_stats[run.run_id].set_value("alignment_stats", stats.dump_dict())
+        self.__aggregate_resources()
+
+    def reduce(self):
+        """
+        Reduce pipeline step for all samples in shared map calls
+        """
+        with self.global_stat.timeit("run_batch_reducer"):
+            runs_stats = run_batch_reducer(self.runs, self.lithops)
+        for (_, run), stats in zip(self.runs, runs_stats):
+            self.sample_stats[run.run_id].set_value("reduce_stats", stats.dump_dict())
+        self.__aggregate_resources()
+
+    def __aggregate_resources(self):
+        """
+        Aggregate the resource usage of the functions of all samples per stage, if resource sampling is enabled
+        """
+        if self.parameters.resource_sampling_interval is not None:
+            samples_stats = [stats.dump_dict() for stats in self.sample_stats.values()]
+            resources = aggregate_stage_resources(self.global_stat.dump_dict(), *samples_stats)
+            self.global_stat.update_value("resources", resources)
+
+    def trace_spans(self):
+        """
+        Spans of the shared stages of the batch (without run ID) and of the stages of every sample
+        """
+        spans = collect_spans(self.global_stat.dump_dict())
+        for run_id, stats in self.sample_stats.items():
+            spans.extend(collect_spans(stats.dump_dict(), run_id))
+        return sorted(spans, key=lambda span: span.start)
+
+    def export_trace(self, filename: str) -> dict:
+        """
+        Write the timeline of the batch as a Chrome trace and return the per run and stage summary
+        """
+        return export_trace(self.trace_spans(), filename)
+
+    def run_pipeline(self):
+        """
+        Execute all pipeline steps in order
+        """
+        self.preprocess()
+        self.alignment()
+        self.reduce()
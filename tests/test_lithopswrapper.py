@@ -0,0 +1,95 @@
+import pytest
+
+pytest.importorskip("lithops")
+
+from lithops.wait import ANY_COMPLETED
+
+from serverlessgenomics import lithopswrapper
+from serverlessgenomics.lithopswrapper import LithopsInvokerWrapper
+
+
+class StubFuture:
+    def __init__(self, func, data, done_tick):
+        self.func = func
+        self.data = data
+        self.done_tick = done_tick
+
+    def result(self):
+        return self.func(self.data)
+
+
+class StubExecutor:
+    """
+    Function executor where every invocation finishes after a number of wait polls (ticks), given by
+    ticks(data, copy) for each copy of the same data
+    """
+
+    def __init__(self, ticks):
+        self.ticks = ticks
+        self.tick = 0
+        self.copies = {}
+        self.launch_ticks = {}
+        self.running = set()
+        self.max_running = 0
+
+    def map(self, func, iterdata, *args, **kwargs):
+        futures = []
+        for data in iterdata:
+            copy = self.copies.get(data, 0)
+            self.copies[data] = copy + 1
+            self.launch_ticks.setdefault(data, self.tick)
+            futures.append(StubFuture(func, data, self.tick + self.ticks(data, copy)))
+        self.running.update(futures)
+        self.max_running = max(self.max_running, len(self.running))
+        return futures
+
+    def wait(self, fs, return_when, throw_except, download_results, timeout, show_progressbar):
+        assert return_when == ANY_COMPLETED
+        self.tick += 1
+        done = [f for f in fs if f.done_tick <= self.tick]
+        self.running = {f for f in self.running if f.done_tick > self.tick}
+        return done, [f for f in fs if f.done_tick > self.tick]
+
+    def get_result(self, fs):
+        return [f.result() for f in fs]
+
+
+def square(x):
+    if x < 0:
+        raise ValueError(x)
+    return x * x
+
+
+def new_invoker(monkeypatch, ticks, **kwargs):
+    executor = StubExecutor(ticks)
+    monkeypatch.setattr(lithopswrapper.lithops, "FunctionExecutor", lambda **config: executor, raising=False)
+    return LithopsInvokerWrapper({}, **kwargs), executor
+
+
+def test_speculative_map_relaunches_stragglers(monkeypatch):
+    # The first copy of task 0 never finishes, the straggler copy does
+    invoker, executor = new_invoker(
+        monkeypatch,
+        lambda x, copy: 10**9 if x == 0 and copy == 0 else 1,
+        speculative_fraction=0.5,
+        speculative_multiplier=0.0,
+    )
+    assert invoker.map(square, range(6), speculative=True) == [x * x for x in range(6)]
+    assert executor.copies[0] == 2
+
+
+def test_speculative_map_raises_when_all_copies_fail(monkeypatch):
+    invoker, _ = new_invoker(monkeypatch, lambda x, copy: 1, speculative_fraction=0.5)
+    with pytest.raises(ValueError):
+        invoker.map(square, [1, -1, 2], speculative=True)
+
+
+def test_max_concurrency_sliding_window(monkeypatch):
+    # Task 0 is slow, the other tasks are invoked in the free slot while it runs
+    invoker, executor = new_invoker(
+        monkeypatch, lambda x, copy: 10 if x == 0 else 1, stage_profiles={"square": {"max_concurrency": 2}}
+    )
+    assert invoker.map(square, range(6)) == [x * x for x in range(6)]
+    assert executor.max_running == 2
+    assert all(executor.launch_ticks[x] < 10 for x in range(6))
+    assert all(copies == 1 for copies in executor.copies.values())